@@ -1,3 +1,3 @@
-from .run import cli
+from .cli import cli
  
 cli()
\ No newline at end of file
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+
+import aiohttp
+from yarl import URL
+
+from . import engine, settings
+from .github import ConditionalCache, conditional_headers
+from .rules import EvaluationAborted
+from .scheduler import PollScheduler, RateLimitTracker
+from .state import comments_deleted
+
+
+def get_session(token, concurrency=10, tracker=None):
+    """Get aiohttp session with authorization headers
+
+    Must be called with a running event loop.
+
+    Args:
+        token (str): Top secret GitHub access token
+        concurrency (int): Maximum of open connections
+        tracker (:class:`RateLimitTracker`): Observes every response
+    Returns:
+        :class:`aiohttp.ClientSession`: Session
+    """
+    trace_configs = []
+    if tracker is not None:
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_end(session, context, params):
+            tracker.update(params.response.status, params.response.headers, str(params.url))
+        trace_config.on_request_end.append(on_request_end)
+        trace_configs.append(trace_config)
+
+    return aiohttp.ClientSession(
+        headers={"Authorization": "token " + token, "User-Agent": "testapp"},
+        connector=aiohttp.TCPConnector(limit=concurrency),
+        trace_configs=trace_configs)
+
+
+async def fetch_page(session, url, params=None, cache=None, limit=None):
+    """Fetch one page of a paginated GitHub listing
+
+    Args:
+        session (ClientSession): aiohttp session
+        url (str): URL of the page
+        params (dict): Query parameters
+        cache (:class:`ConditionalCache`): Cache for conditional requests
+        limit (Semaphore): Bounds the number of concurrent requests
+    Returns:
+        tuple: (items, next_url)
+    """
+    full_url = str(URL(url).update_query(params or {}))
+    entry = cache.get(full_url) if cache is not None else None
+    async with limit or _NoLimit():
+        async with session.get(full_url, headers=conditional_headers(entry)) as r:
+            body = await r.read()
+            if r.status == 304 and entry is not None:
+                cache.record(len(body), entry["size"])
+                return entry["data"], entry["next"]
+            if cache is not None:
+                cache.record(len(body))
+            r.raise_for_status()
+            data = json.loads(body.decode("utf-8"))
+            next_url = r.links.get("next", {}).get("url")
+            next_url = str(next_url) if next_url is not None else None
+            if cache is not None:
+                cache.store(full_url, r.headers, len(body), data, next_url)
+            return data, next_url
+
+
+async def fetch_comments(session, repo, issue, cache=None, limit=None, since=None):
+    """Fetch all comments of an issue
+
+    Args:
+        session (ClientSession): aiohttp session
+        repo (tuple): (repository_owner, repository_name)
+        issue (int): Issue's number
+        cache (:class:`ConditionalCache`): Cache for conditional requests
+        limit (Semaphore): Bounds the number of concurrent requests
+        since (str): Only comments updated at or after this ISO 8601 timestamp
+    Returns:
+        list: Comments as JSON dicts
+    """
+    url = "{}/repos/{}/{}/issues/{}/comments".format(settings.API_URL, repo[0], repo[1], issue)
+    params = {"per_page": settings.PER_PAGE}
+    if since:
+        params["since"] = since
+    comments = []
+    while url:
+        page, url = await fetch_page(session, url, params, cache, limit)
+        params = None
+        comments.extend(page)
+    return comments
+
+
+async def add_labels(session, repo, issue, labels, limit=None):
+    """Attach the labels to the issue
+
+    Args:
+        session (ClientSession): aiohttp session
+        repo (tuple): (repository_owner, repository_name)
+        issue (int): Issue's number
+        labels (list): List of labels to attach
+        limit (Semaphore): Bounds the number of concurrent requests
+    Returns:
+        dict: JSON Response or False if there was nothing to attach
+    """
+    if len(labels) == 0:
+        return False
+
+    labels = json.dumps(list(labels))
+    print("Adding labels: {} to {}/{} on issue {}".format(labels, repo[0], repo[1], issue))
+    url = "{}/repos/{}/{}/issues/{}/labels".format(settings.API_URL, repo[0], repo[1], issue)
+    async with limit or _NoLimit():
+        async with session.post(url, data=labels) as r:
+            r.raise_for_status()
+            return await r.json(content_type=None)
+
+
+async def run_rules(rules, function, *args):
+    """Call a function evaluating the rules, in a thread if they are guarded
+
+    The rule guard waits for its child processes for up to the whole
+    budget, which would block the event loop meanwhile.
+
+    Args:
+        rules (RuleSet): Rules the function evaluates
+        function (callable): Function to call with ``args``
+    Returns:
+        Whatever the function returns
+    """
+    if getattr(rules, "guard", None) is None:
+        return function(*args)
+    return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+
+async def process_issue(session, config, repo, issue, cache=None, limit=None,
+                        comment_cache=None):
+    """Apply the rules to an issue and attach the missing labels
+
+    Args:
+        session (ClientSession): aiohttp session
+        config (dict): Configuration, see :py:func:`settings.load_configuration`
+        repo (tuple): (repository_owner, repository_name)
+        issue (dict): Issue as returned by the GitHub API
+        cache (:class:`ConditionalCache`): Cache for conditional requests
+        limit (Semaphore): Bounds the number of concurrent requests
+        comment_cache (:class:`CommentCache`): Labels of already searched
+            comments, only newer comments are fetched and searched
+    Returns:
+        set: Labels attached to the issue
+    """
+    scope = config["scope"]
+    print("Inspecting issue #{} '{}' in a repository '{}' ".format(
+        issue["number"], issue["title"], repo[1]))
+
+    rules = config["rules"]
+    current_labels = [label["name"] for label in issue["labels"]]
+    searched_content = []
+    comment_labels = set()
+    if "issue_body" in scope:
+        searched_content.append(issue["body"])
+    if "issue_comments" in scope and comment_cache is None:
+        comments = await fetch_comments(session, repo, issue["number"], cache, limit)
+        searched_content.extend(comment["body"] for comment in comments)
+    elif "issue_comments" in scope:
+        since, known = comment_cache.get(repo, issue["number"], rules)
+        comments = await fetch_comments(session, repo, issue["number"], cache, limit, since)
+        complete = since is None
+        if not complete and comments_deleted(issue, known, comments):
+            comments = await fetch_comments(session, repo, issue["number"], cache, limit)
+            complete = True
+        # only new and edited comments are searched
+        changed = [comment for comment in comments
+                   if comment["id"] not in known or comment["updated_at"] >= since]
+        searched = await run_rules(rules, lambda: dict(
+            (comment["id"], rules.match(comment["body"])) for comment in changed))
+        comment_labels = comment_cache.update(repo, issue["number"], rules, comments, searched,
+                                              complete)
+
+    guard = getattr(rules, "guard", None)
+    try:
+        match, missing_labels = await run_rules(rules, engine.check_rules, rules,
+                                                searched_content, current_labels,
+                                                config["fallback_label"], comment_labels)
+    except EvaluationAborted as e:
+        # the labels found are right, the issue fails so the next poll evaluates it again
+        await add_labels(session, repo, issue["number"], e.labels, limit)
+        # unless it ran out of the budget every time, see engine.process_issue
+        if guard is None or not guard.aborted((tuple(repo), issue["number"])):
+            raise
+        print("Giving up on issue #{}, rules keep running out of the budget".format(
+            issue["number"]))
+        return e.labels
+    if guard is not None:
+        guard.completed((tuple(repo), issue["number"]))
+    await add_labels(session, repo, issue["number"], missing_labels, limit)
+    return missing_labels
+
+
+async def poll_repository(session, config, repo, cursors, cache=None, limit=None,
+                          comment_cache=None):
+    """Label all issues of the repository updated since the last poll
+
+    Every issue is processed in its own task as soon as the page listing it
+    arrives, so comment fetches and label POSTs of the first page overlap
+    with the download of the next one.
+
+    Args:
+        session (ClientSession): aiohttp session
+        config (dict): Configuration, see :py:func:`settings.load_configuration`
+        repo (tuple): (repository_owner, repository_name)
+        cursors (:class:`CursorStore`): Last processed issue per repository
+        cache (:class:`ConditionalCache`): Cache for conditional requests
+        limit (Semaphore): Bounds the number of concurrent requests
+        comment_cache (:class:`CommentCache`): Labels of already searched comments
+    Returns:
+        int: Number of processed issues
+    """
+    scope = config["scope"]
+    since = cursors.get(repo)
+    url = "{}/repos/{}/{}/issues".format(settings.API_URL, repo[0], repo[1])
+    params = {"per_page": settings.PER_PAGE}
+    if since:
+        params.update({"since": since, "sort": "updated", "direction": "asc"})
+
+    done, failed = [], []
+    tasks = {}
+    while url:
+        issues, url = await fetch_page(session, url, params, cache, limit)
+        params = None
+        for issue in issues:
+            # skip PR if they aren't in the scope and issues processed by the last poll
+            if (issue.get("pull_request", None) and "pull_requests" not in scope or
+                    cursors.is_processed(repo, issue)):
+                done.append(issue)
+                continue
+            task = asyncio.ensure_future(
+                process_issue(session, config, repo, issue, cache, limit, comment_cache))
+            tasks[task] = issue
+
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for issue, result in zip(tasks.values(), results):
+        if isinstance(result, Exception):
+            print(result)
+            failed.append(issue)
+        else:
+            done.append(issue)
+
+    # make sure the failed issues are fetched again next time
+    cursors.advance(repo, done, failed)
+    cursors.save()
+    return len(tasks)
+
+
+async def watch(session, config, repo, cursors, scheduler, cache=None, limit=None,
+                cycles=None, comment_cache=None):
+    """Periodically poll the repository
+
+    Args:
+        session (ClientSession): aiohttp session
+        config (dict): Configuration, see :py:func:`settings.load_configuration`
+        repo (tuple): (repository_owner, repository_name)
+        cursors (:class:`CursorStore`): Last processed issue per repository
+        scheduler (:class:`PollScheduler`): Decides when to poll again
+        cache (:class:`ConditionalCache`): Cache for conditional requests
+        limit (Semaphore): Bounds the number of concurrent requests
+        cycles (int): Stop after this many polls, run forever if None
+        comment_cache (:class:`CommentCache`): Labels of already searched comments
+    """
+    cycle = 0
+    while cycles is None or cycle < cycles:
+        try:
+            processed = await poll_repository(session, config, repo, cursors, cache, limit,
+                                              comment_cache)
+        except Exception as e:
+            print(e)
+            processed = 0
+        cycle += 1
+        delay = scheduler.next_delay(repo, processed)
+        if cycles is None or cycle < cycles:
+            await asyncio.sleep(delay)
+
+
+async def watch_all(config, repos, cursors, concurrency=10, cycles=None, scheduler=None,
+                    comment_cache=None):
+    """Watch all repositories in one event loop over one session
+
+    Args:
+        config (dict): Configuration, see :py:func:`settings.load_configuration`
+        repos (list): List of (repository_owner, repository_name) tuples
+        cursors (:class:`CursorStore`): Last processed issue per repository
+        concurrency (int): Maximum of concurrent requests to GitHub
+        cycles (int): Stop after this many polls, run forever if None
+        scheduler (:class:`PollScheduler`): Decides when to poll again,
+            a scheduler with the configured interval is used if None
+        comment_cache (:class:`CommentCache`): Labels of already searched comments
+    """
+    if scheduler is None:
+        scheduler = PollScheduler(RateLimitTracker(), config["interval"])
+    limit = asyncio.Semaphore(concurrency)
+    cache = ConditionalCache()
+    async with get_session(config["token"], concurrency, scheduler.tracker) as session:
+        await asyncio.gather(*[watch(session, config, repo, cursors, scheduler, cache,
+                                     limit, cycles, comment_cache)
+                               for repo in repos])
+
+
+def main(config, repos, cursors, concurrency=10, cycles=None, scheduler=None,
+         comment_cache=None):
+    """Run :py:func:`watch_all` in a new event loop"""
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(watch_all(config, repos, cursors, concurrency, cycles,
+                                          scheduler, comment_cache))
+    finally:
+        loop.close()
+
+
+class _NoLimit(object):
+    """Stand-in for a semaphore when concurrency is not bounded"""
+
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *exc_info):
+        pass
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Offline microbenchmarks of rule matching, signature validation and
+webhook handling
+
+Every benchmark runs on synthetic, reproducible corpora: issue bodies
+from 1 KB to 1 MB, rule sets from 3 to 1000 patterns of every kind the
+:class:`RuleSet` compiles differently, and pathological regexes which
+backtrack catastrophically. Results can be saved as a baseline and later
+runs compared against it::
+
+    python -m pygithublabeler.bench --save baseline.json
+    python -m pygithublabeler.bench --baseline baseline.json --threshold 0.2
+
+The comparison fails (exit status 1) if the throughput or the median
+latency of any benchmark got worse than the threshold allows.
+"""
+
+import contextlib
+import hashlib
+import hmac
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+
+import click
+
+from . import engine
+from .rules import RuleSet
+
+KB = 1024
+MB = 1024 * KB
+
+BODY_SIZES = (1 * KB, 16 * KB, 256 * KB, 1 * MB)
+RULE_COUNTS = (3, 30, 300, 1000)
+QUICK_BODY_SIZES = (1 * KB, 64 * KB)
+QUICK_RULE_COUNTS = (3, 100)
+
+WORDS = ("the issue crashes when i click on button please fix this robot version error "
+         "stack trace expected behaviour actual steps to reproduce log output").split()
+
+# patterns which backtrack exponentially on a run of "a" they don't match,
+# unless the prefilter of their required literal skips them
+PATHOLOGICAL_PATTERNS = ("(a+)+$", "(a|aa)+$", "(a|a?)+b", "(\\w+\\s?)+$")
+PATHOLOGICAL_LENGTHS = (12, 16, 18)
+QUICK_PATHOLOGICAL_LENGTHS = (12, 16)
+
+SECRET = "benchmark-secret"
+
+
+def make_rules(count, seed=0):
+    """Rule set of every kind of pattern :class:`RuleSet` distinguishes
+
+    Cycles through plain literals (substring scan), prefiltered regexes,
+    regexes with capturing groups and regexes with an inline flag and no
+    usable literal (always evaluated).
+
+    Args:
+        count (int): Number of rules
+        seed (int): Seed of the random generator
+    Returns:
+        list: Rules as dicts with pattern and label
+    """
+    rng = random.Random(seed)
+    kinds = ("robot:lit{}", "robot:re{}[0-9]+", "(robot)-grp{}-\\1", "(?i)urgent{}\\b")
+    rules = []
+    for i in range(count):
+        kind = kinds[i % len(kinds)]
+        rules.append({"pattern": kind.format(i), "label": "label{}".format(rng.randrange(count))})
+    return rules
+
+
+def make_body(size, seed=0, triggers=()):
+    """Issue body of random words
+
+    Args:
+        size (int): Length in characters
+        seed (int): Seed of the random generator
+        triggers (iterable): Strings placed at random positions in the
+            first half of the body, e.g. texts matched by some rules
+    Returns:
+        str: Body
+    """
+    rng = random.Random(seed)
+    words, length = [], 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    for trigger in triggers:
+        words.insert(rng.randrange(len(words) // 2 + 1), trigger)
+    return " ".join(words)[:size]
+
+
+def default_triggers(count):
+    """Texts matching a handful of the rules made by :py:func:`make_rules`"""
+    return ["robot:lit0", "robot:re{}42".format(min(1, count - 1)),
+            "robot-grp{0}-robot".format(min(2, count - 1))][:count]
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    index = int(math.ceil(fraction * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+def measure(func, min_time=0.5, min_runs=3, max_runs=100000, size=None):
+    """Call a function repeatedly and summarize the latencies
+
+    Args:
+        func (callable): Function without arguments
+        min_time (float): Seconds to keep calling it
+        min_runs (int): Calls made even if they take longer than ``min_time``
+        max_runs (int): Calls after which to stop even before ``min_time``
+        size (int): Bytes processed by every call, adds mb_per_s
+    Returns:
+        dict: runs, ops_per_s, p50, p90, p99 and max (seconds)
+    """
+    func()
+    latencies = []
+    started = time.perf_counter()
+    while len(latencies) < min_runs or (len(latencies) < max_runs and
+                                        time.perf_counter() - started < min_time):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    total = sum(latencies) or 1e-9
+    latencies.sort()
+    result = {
+        "runs": len(latencies),
+        "ops_per_s": len(latencies) / total,
+        "p50": percentile(latencies, 0.5),
+        "p90": percentile(latencies, 0.9),
+        "p99": percentile(latencies, 0.99),
+        "max": latencies[-1],
+    }
+    if size:
+        result["mb_per_s"] = size * len(latencies) / total / MB
+    return result
+
+
+def _size_name(size):
+    return "{}MB".format(size // MB) if size >= MB else "{}KB".format(size // KB)
+
+
+def bench_check_rules(size, count):
+    rules = RuleSet(make_rules(count))
+    body = make_body(size, triggers=default_triggers(count))
+    return lambda: engine.check_rules(rules, [body], [], "wontfix")
+
+
+def bench_pathological(pattern, length):
+    rules = RuleSet([{"pattern": pattern, "label": "slow"}])
+    body = "a" * length + "!"
+    return lambda: engine.check_rules(rules, [body], [], "wontfix")
+
+
+def sign(data, secret=SECRET):
+    """X-Hub-Signature header of a payload"""
+    return "sha1=" + hmac.new(secret.encode("utf-8"), msg=data, digestmod=hashlib.sha1).hexdigest()
+
+
+def bench_signature(size):
+    # imported here, only the webhook benchmarks need Flask
+    from .web import validate_signature
+    data = make_body(size).encode("utf-8")
+    headers = {"X-Hub-Signature": sign(data)}
+    return lambda: validate_signature(headers, data, SECRET)
+
+
+class _Response(object):
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return []
+
+
+class _Session(object):
+    """Session answering every label addition without any network"""
+
+    def post(self, url, data=None, **kwargs):
+        return _Response()
+
+
+def bench_hook(size, count=30):
+    # changes the global configuration, benchmarks run in a process of their own
+    from . import settings, web
+    settings.config.update({
+        "scope": ["issue_body", "issue_comments"],
+        "rules": RuleSet(make_rules(count)),
+        "fallback_label": "wontfix",
+        "session": _Session(),
+        "breaker": None,
+    })
+    web.app.config.update({"webhook_token": SECRET, "hook_workers": 0})
+    client = web.app.test_client()
+    body = make_body(size, triggers=default_triggers(count))
+    numbers = iter(range(1, sys.maxsize))
+
+    def post():
+        # a new issue every time, so the delivery isn't a duplicate
+        number = next(numbers)
+        data = json.dumps({"action": "opened",
+                           "issue": {"number": number, "labels": [], "body": body},
+                           "repository": {"full_name": "owner/repo"}}).encode("utf-8")
+        r = client.post("/hook", data=data, content_type="application/json",
+                        headers={"X-Hub-Signature": sign(data),
+                                 "X-GitHub-Delivery": str(number)})
+        assert r.status_code == 200, r.data
+    return post
+
+
+def benchmarks(quick=False):
+    """All benchmarks, set up lazily
+
+    Args:
+        quick (bool): Smaller grid of sizes for a fast run
+    Returns:
+        list: (name, factory, size) tuples, the factory returns the
+        function to measure
+    """
+    sizes = QUICK_BODY_SIZES if quick else BODY_SIZES
+    counts = QUICK_RULE_COUNTS if quick else RULE_COUNTS
+    lengths = QUICK_PATHOLOGICAL_LENGTHS if quick else PATHOLOGICAL_LENGTHS
+    cases = []
+    for size in sizes:
+        for count in counts:
+            cases.append(("check_rules/body={}/rules={}".format(_size_name(size), count),
+                          lambda size=size, count=count: bench_check_rules(size, count), size))
+    for pattern in PATHOLOGICAL_PATTERNS:
+        for length in lengths:
+            cases.append(("pathological/{}/length={}".format(pattern, length),
+                          lambda pattern=pattern, length=length: bench_pathological(
+                              pattern, length), length))
+    for size in sizes:
+        cases.append(("validate_signature/body={}".format(_size_name(size)),
+                      lambda size=size: bench_signature(size), size))
+    for size in sizes:
+        cases.append(("hook/body={}".format(_size_name(size)),
+                      lambda size=size: bench_hook(size), size))
+    return cases
+
+
+def run(quick=False, only=None, min_time=0.5, report=None):
+    """Run the benchmarks
+
+    Args:
+        quick (bool): Smaller grid of sizes
+        only (str): Run only benchmarks whose name contains this string
+        min_time (float): Seconds spent measuring every benchmark
+        report (callable): Called with the name and result of every benchmark
+    Returns:
+        dict: Results keyed by benchmark name
+    """
+    results = {}
+    for name, factory, size in benchmarks(quick):
+        if only and only not in name:
+            continue
+        # progress messages of the labeler would be measured too
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            results[name] = measure(factory(), min_time=min_time, size=size)
+        if report is not None:
+            report(name, results[name])
+    return results
+
+
+def compare(results, baseline, threshold=0.2):
+    """Find benchmarks which got slower than the baseline allows
+
+    Args:
+        results (dict): Results of :py:func:`run`
+        baseline (dict): Results of an earlier run
+        threshold (float): Allowed relative loss of throughput and growth
+            of the median latency, e.g. 0.2 for 20 %
+    Returns:
+        list: Descriptions of the regressions
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result["ops_per_s"] < before["ops_per_s"] * (1 - threshold):
+            regressions.append("{}: throughput {:.1f}/s, baseline {:.1f}/s".format(
+                name, result["ops_per_s"], before["ops_per_s"]))
+        if result["p50"] > before["p50"] * (1 + threshold):
+            regressions.append("{}: median {:.3f} ms, baseline {:.3f} ms".format(
+                name, result["p50"] * 1000, before["p50"] * 1000))
+    return regressions
+
+
+def format_result(name, result):
+    """One line summary of a benchmark"""
+    line = "{:<45} {:>10.1f}/s  p50 {:>9.3f} ms  p90 {:>9.3f} ms  p99 {:>9.3f} ms".format(
+        name, result["ops_per_s"], result["p50"] * 1000, result["p90"] * 1000,
+        result["p99"] * 1000)
+    if "mb_per_s" in result:
+        line += "  {:>8.1f} MB/s".format(result["mb_per_s"])
+    return line
+
+
+@click.command()
+@click.option('--quick', is_flag=True, help='Run a smaller grid of sizes.')
+@click.option('-k', '--only', default=None, help='Run only benchmarks whose name contains this string.')
+@click.option('--min-time', default=0.5, help='Seconds spent measuring every benchmark. Default 0.5')
+@click.option('--save', type=click.Path(dir_okay=False), help='Save the results as a baseline.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), help='Compare the results with a saved baseline.')
+@click.option('--threshold', default=0.2, help='Allowed slowdown against the baseline, 0.2 is 20 %. Default 0.2')
+def main(quick, only, min_time, save, baseline, threshold):
+    """Run the offline microbenchmarks"""
+    results = run(quick, only, min_time,
+                  report=lambda name, result: print(format_result(name, result)))
+    if save:
+        with open(save, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                       "results": results}, f, indent=2, sort_keys=True)
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f)["results"], threshold)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import itertools
+import signal
+import sys
+from collections import OrderedDict
+
+import click
+
+from . import graphql, metrics, settings
+from .engine import fetch_issues, watch_repositories
+from .profiling import RuleProfiler, format_report
+from .scheduler import PollScheduler, RateLimitTracker
+from .state import CommentCache, CursorStore
+
+
+@click.group()
+@click.option('--authconfig', default='auth.cfg', help='Configuration file. Default auth.cfg')
+@click.option('--repo', multiple=True, help='Repository in \'owner/name\' format, can be repeated. Default slowbackspace/testrepo')
+@click.option('--repos-file', type=click.Path(exists=True, dir_okay=False), help='File with one repository in \'owner/name\' format per line')
+@click.option('--scope', default=["all"], help='Scope - issue_body, issue_comments, pull_requests, all. Default all.', multiple=True)
+@click.option('--rules', default='rules.yml', help='Configuration of rules')
+@click.option('--interval', default=5, help='Interval [seconds]. Default 5')
+@click.option('--label', default='wontfix', help='Fallback label. Default wonfix.')
+@click.option('--rule-cache', default=4096, envvar='RULE_CACHE_SIZE', help='Number of memoized rule evaluations, 0 disables the memo. Default 4096')
+@click.option('--rule-cache-ttl', default=3600, envvar='RULE_CACHE_TTL', help='Seconds after which memoized rule evaluations expire, 0 never. Default 3600')
+@click.option('--rules-reload', default=5.0, envvar='RULES_RELOAD_INTERVAL', help='Seconds between checks whether the rules file changed, 0 never reloads. Default 5')
+@click.option('--rule-profile', default=0.0, envvar='RULE_PROFILE_RATE', help='Fraction of the texts for which every rule is profiled, 0 disables the profiler. Default 0')
+@click.option('--rule-timeout', default=0.0, envvar='RULE_TIMEOUT', help='Seconds one rule may run on one text, rules are evaluated in killable processes if set. Default 0 (no limit)')
+@click.option('--rule-budget', default=1.0, envvar='RULE_BUDGET', help='Seconds all rules may run for one issue with --rule-timeout, 0 unlimited. Default 1')
+def cli(authconfig, repo, repos_file, scope, rules, interval, label, rule_cache,
+        rule_cache_ttl, rules_reload, rule_profile, rule_timeout, rule_budget):
+    repo = list(repo)
+    if repos_file:
+        repo.extend(settings.load_repos(repos_file))
+    # keep the order, but poll every repository once
+    repo = list(OrderedDict.fromkeys(repo)) or ["slowbackspace/testrepo"]
+    try:
+        settings.load_configuration(authconfig, repo, scope, rules, interval, label,
+                                    rule_cache, rule_cache_ttl, rules_reload, rule_profile,
+                                    rule_timeout, rule_budget)
+    except settings.ConfigurationError as e:
+        sys.exit(str(e))
+
+
+@cli.command()
+@click.option('--state', default='state.json', help='File with the last processed issue per repository. Default state.json')
+@click.option('--rescan', is_flag=True, help='Ignore the saved state and scan all issues.')
+@click.option('--workers', default=1, help='Number of issues processed concurrently. Default 1')
+@click.option('--repo-workers', default=4, help='Maximum of concurrently processed issues per repository. Default 4')
+@click.option('--engine', default='threads', type=click.Choice(['threads', 'asyncio']), help='Engine used to talk to GitHub. Default threads')
+@click.option('--concurrency', default=10, help='Maximum of concurrent requests of the asyncio engine. Default 10')
+@click.option('--min-interval', default=1, help='Shortest interval for busy repositories [seconds]. Default 1')
+@click.option('--max-interval', default=300, help='Longest interval for idle repositories [seconds]. Default 300')
+@click.option('--backend', default='rest', type=click.Choice(['rest', 'graphql']), help='API used to list issues, graphql fetches issues with their comments in one query. Default rest')
+@click.option('--comment-cache', default=10000, help='Number of issues whose searched comments are remembered, 0 disables the cache. Default 10000')
+@click.option('--metrics-interval', default=60.0, envvar='METRICS_INTERVAL', help='Seconds between summaries of the metrics, 0 disables them. Default 60')
+def console(state, rescan, workers, repo_workers, engine, concurrency, min_interval, max_interval,
+            backend, comment_cache, metrics_interval):
+    """Run the cli app
+    Periodically fetches issues from the GitHub API and attaches missing labels.
+    Only issues updated since the last poll are fetched.
+    The interval adapts to the activity of the repository and GitHub's rate limit.
+    A summary of the metrics is printed every --metrics-interval seconds.
+    With --rule-profile the ranked report of the rules is printed on SIGUSR1.
+    Several repositories (--repo repeated or --repos-file) are watched over one
+    session with one set of compiled rules, always polling the one due first.
+    """
+    settings.watch_rules()
+    config = settings.config
+    session = config["session"]
+    interval = config["interval"]
+    repos = config["repos"]
+    cursors = CursorStore(state)
+    if rescan:
+        for repo in repos:
+            cursors.reset(repo)
+    tracker = RateLimitTracker()
+    scheduler = PollScheduler(tracker, interval, min_interval, max_interval)
+    comment_cache = CommentCache(comment_cache) if comment_cache > 0 else None
+    metrics.registry.ensure_started()
+    if metrics_interval > 0:
+        metrics.Reporter(metrics.registry, metrics_interval).start()
+    if config.get("rule_profiler", None) is not None and hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: print_profile(config["rule_profiler"]))
+
+    if engine == "asyncio":
+        if backend == "graphql":
+            sys.exit("The GraphQL backend works only with the threads engine")
+        try:
+            from . import aio
+        except ImportError:
+            sys.exit("The asyncio engine requires aiohttp, install pygithublabeler[async]")
+        aio.main(config, repos, cursors, concurrency, scheduler=scheduler,
+                 comment_cache=comment_cache)
+        return
+
+    tracker.install(session)
+    executor = None
+    if workers > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        transport = config["transport"]
+        if workers > transport.pool_size:
+            # keep a connection for every worker
+            transport.pool_size = workers
+            transport.mount(session)
+
+    fetch = None
+    if backend == "graphql":
+        fetch = graphql.fetch_issues
+    watch_repositories(session, repos, cursors, scheduler, executor, repo_workers,
+                       comment_cache, fetch=fetch)
+
+
+@cli.command("rules")
+def rules_report():
+    """Show how the rules were optimized"""
+    for line in settings.config["rules"].report():
+        print(line)
+
+
+def print_profile(profiler):
+    """Print the ranked report of the rules in use"""
+    for line in format_report(profiler.report(settings.config["rules"])):
+        print(line)
+
+
+@cli.command()
+@click.argument('texts', nargs=-1, type=click.File())
+@click.option('--limit', default=100, help='Issues per repository profiled if no texts are given. Default 100')
+@click.option('--repeat', default=3, help='Times every text is profiled. Default 3')
+def profile(texts, limit, repeat):
+    """Rank the rules by the time spent in them
+
+    Every rule is evaluated on its own against the TEXTS files, or against
+    the bodies of the issues of the repositories if no file is given.
+    """
+    config = settings.config
+    if texts:
+        contents = [f.read() for f in texts]
+    else:
+        contents = []
+        for repo in config["repos"]:
+            for issue in itertools.islice(fetch_issues(config["session"], repo), limit):
+                contents.append(issue.get("body") or "")
+    profiler = RuleProfiler(1, check_every=0)
+    for _ in range(repeat):
+        for text in contents:
+            profiler.profile(config["rules"], text)
+    print_profile(profiler)
+
+
+@cli.command()
+def web():
+    """Run the web app"""
+    # Flask is imported only when it's needed
+    from .web import app, debug, port
+    app.run(host="0.0.0.0", debug=debug, port=port)
+
+
+if __name__ == '__main__':
+    sys.exit(int(cli() or 0))
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class DeliveryCache(object):
+    """Recently handled webhook deliveries kept in memory
+
+    Every delivery is remembered under several keys (its
+    ``X-GitHub-Delivery`` id and a hash of its content). A delivery is a
+    duplicate if any of its keys was seen within ``ttl`` seconds. The least
+    recently added keys are evicted first.
+
+    The cache can be shared by several threads, but not by processes, see
+    :class:`SQLiteDeliveryCache`.
+
+    Args:
+        max_entries (int): How many keys to remember
+        ttl (float): Seconds after which keys expire, never if 0
+    """
+
+    def __init__(self, max_entries=10000, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _expired(self, added, now):
+        return self.ttl > 0 and now - added >= self.ttl
+
+    def is_duplicate(self, keys):
+        """Check whether a delivery was already seen and remember it if not
+
+        Args:
+            keys (list): Keys identifying the delivery
+        Returns:
+            bool: True if any of the keys was seen before
+        """
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                added = self.entries.get(key)
+                if added is not None and not self._expired(added, now):
+                    self.hits += 1
+                    return True
+            self.misses += 1
+            for key in keys:
+                self.entries.pop(key, None)
+                self.entries[key] = now
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return False
+
+    def forget(self, keys):
+        """Forget a delivery, so it is handled again when redelivered"""
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        """Forget all deliveries"""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Size of the cache and number of duplicates
+
+        Returns:
+            dict: size, max_entries, hits (duplicates) and misses
+        """
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class SQLiteDeliveryCache(DeliveryCache):
+    """Recently handled webhook deliveries kept in a SQLite database
+
+    Works like :class:`DeliveryCache`, but all processes using the same
+    database file share the deliveries, so a delivery handled by one
+    gunicorn worker is recognized by the others. Hits and misses are
+    counted per process.
+
+    Args:
+        filename (str): Path to the database file
+        max_entries (int): How many keys to remember
+        ttl (float): Seconds after which keys expire, never if 0
+    """
+
+    def __init__(self, filename, max_entries=10000, ttl=3600):
+        super(SQLiteDeliveryCache, self).__init__(max_entries, ttl)
+        self.filename = filename
+        self.pid = None
+        self.connection = None
+
+    def _connect(self):
+        # connections can't be shared with forked processes
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.connection = sqlite3.connect(self.filename, timeout=10,
+                                              isolation_level=None,
+                                              check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS deliveries "
+                                    "(key TEXT PRIMARY KEY, added REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS deliveries_added "
+                                    "ON deliveries (added)")
+        return self.connection
+
+    def is_duplicate(self, keys):
+        now = time.time()
+        oldest = now - self.ttl if self.ttl > 0 else 0
+        placeholders = ",".join("?" * len(keys))
+        with self.lock:
+            db = self._connect()
+            # the check and the insert must not interleave with other processes
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT 1 FROM deliveries WHERE added > ? AND key IN ({})"
+                                 .format(placeholders), [oldest] + list(keys)).fetchone()
+                if row is None:
+                    db.executemany("INSERT OR REPLACE INTO deliveries (key, added) "
+                                   "VALUES (?, ?)", [(key, now) for key in keys])
+                    db.execute("DELETE FROM deliveries WHERE added <= ?", (oldest,))
+                    db.execute("DELETE FROM deliveries WHERE key IN (SELECT key FROM "
+                               "deliveries ORDER BY added DESC LIMIT -1 OFFSET ?)",
+                               (self.max_entries,))
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+            if row is not None:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def forget(self, keys):
+        placeholders = ",".join("?" * len(keys))
+        with self.lock:
+            self._connect().execute("DELETE FROM deliveries WHERE key IN ({})"
+                                    .format(placeholders), list(keys))
+
+    def clear(self):
+        with self.lock:
+            self._connect().execute("DELETE FROM deliveries")
+
+    def stats(self):
+        with self.lock:
+            size = self._connect().execute("SELECT COUNT(*) FROM deliveries").fetchone()[0]
+            return {
+                "size": size,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def open_delivery_cache(max_entries=10000, ttl=3600, filename=None):
+    """Create a delivery cache
+
+    Args:
+        max_entries (int): How many keys to remember, 0 disables the cache
+        ttl (float): Seconds after which keys expire, never if 0
+        filename (str): SQLite database shared by processes, the cache is
+            kept in memory if empty
+    Returns:
+        :class:`DeliveryCache`: Cache or None if it is disabled
+    """
+    if max_entries <= 0:
+        return None
+    if filename:
+        return SQLiteDeliveryCache(filename, max_entries, ttl)
+    return DeliveryCache(max_entries, ttl)
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import heapq
+import json
+import os
+import threading
+import time
+
+from . import metrics, settings
+from .github import ConditionalCache, iter_pages
+from .labels import LabelBatcher
+from .rules import EvaluationAborted, RuleSet
+from .state import comments_deleted
+
+
+def fetch_issues(session, repo, cache=None, per_page=None, since=None):
+    """Fetch list of issues for the repository
+    
+    Walks all pages of the listing lazily.
+
+    Args:
+        session (Session): Request's session
+        repo (tuple): (repository_owner, repository_name) 
+        cache (:class:`ConditionalCache`): Cache for conditional requests
+        per_page (int): Number of issues per page, GitHub's default if None
+        since (str): Only issues updated at or after this ISO 8601 timestamp,
+            oldest first
+    Returns:
+        generator: Issues as JSON dicts
+    """
+    repo_owner, repo_name = repo
+    url = "{}/repos/{}/{}/issues".format(settings.API_URL, repo_owner, repo_name)
+    params = {}
+    if per_page:
+        params["per_page"] = per_page
+    if since:
+        params.update({"since": since, "sort": "updated", "direction": "asc"})
+    return iter_pages(session, url, params=params or None, cache=cache)
+
+
+def fetch_comments(session, repo, issue, cache=None, per_page=None, since=None):
+    """Fetch issue's comments
+    
+    Walks all pages of the listing lazily.
+
+    Args:
+        session (Session): Request's session
+        repo (tuple): (repository_owner, repository_name) 
+        issue (int): Issue's number
+        cache (:class:`ConditionalCache`): Cache for conditional requests
+        per_page (int): Number of comments per page, GitHub's default if None
+        since (str): Only comments updated at or after this ISO 8601 timestamp
+    Returns:
+        generator: Comments as JSON dicts
+    """
+    repo_owner, repo_name = repo
+    url = "{}/repos/{}/{}/issues/{}/comments".format(settings.API_URL, repo_owner, repo_name, issue)
+    params = {}
+    if per_page:
+        params["per_page"] = per_page
+    if since:
+        params["since"] = since
+    return iter_pages(session, url, params=params or None, cache=cache)
+
+
+def check_rules(rules, text_list, current_labels, fallback_label, matched=None):
+    """Finds rule's match in a text and returns list of labels to attach.
+    If no rule matches returns False for match and fallback label will be attached.
+    
+    Args:
+        rules (RuleSet): Compiled rules, a plain list of rules is compiled on the fly
+        text_list (list): List of strings to search in
+        current_labels (list): List of already attached labels
+        fallback_label (str): Label to attach if no rule matches
+        matched (set): Labels of rules which matched texts searched before,
+            e.g. comments remembered by :class:`CommentCache`
+    Returns:
+        tuple: (match, labels)
+
+            match (bool): True if any rule matches, False otherwise
+            labels (list): List of labels to attach
+    Raises:
+        EvaluationAborted: If the rule guard didn't evaluate every rule in
+            time, the fallback label isn't attached then
+    """
+    if not isinstance(rules, RuleSet):
+        rules = RuleSet(rules)
+
+    # only rules which can still change the result are evaluated
+    start = time.perf_counter()
+    try:
+        match, labels = rules.decide(text_list, current_labels, matched)
+    finally:
+        metrics.rules_seconds.observe(time.perf_counter() - start)
+    # fallback label
+    if not match:
+        if fallback_label not in current_labels:
+            labels.add(fallback_label)
+    return match, labels
+
+
+def collect_rule_metrics():
+    """Turn statistics of the rules in use into metrics, see
+    :py:meth:`RuleSet.take_stats`"""
+    rules = settings.config.get("rules")
+    if not isinstance(rules, RuleSet):
+        return
+    for rule, evaluations, hits, seconds in rules.take_stats():
+        labels = {"label": rule["label"], "pattern": rule["pattern"]}
+        if evaluations:
+            metrics.rule_evaluations.inc(evaluations, **labels)
+            metrics.rule_seconds.inc(seconds, **labels)
+        if hits:
+            metrics.rule_matches.inc(hits, **labels)
+
+
+metrics.registry.add_collector(collect_rule_metrics)
+
+
+def add_labels(session, repo, issue, labels):
+    """Sends request to Github API to attach the labels to the issue
+
+    Args:
+        session (Session): Request's session
+        repo (tuple): (repository_owner, repository_name) 
+        issue (int): Issue's number
+        labels (list): List of labels to attach
+    Returns:
+        dict: JSON Response
+    """
+    if len(labels) == 0:
+        return False
+
+    # convert labels to list, json.dumps doesn't work with set()
+    labels = json.dumps(list(labels))
+
+    print("Adding labels: {} to {}/{} on issue {}".format(labels, repo[0], repo[1], issue))
+    repo_owner, repo_name = repo
+    url = "{}/repos/{}/{}/issues/{}/labels".format(
+                                                settings.API_URL, repo_owner, repo_name, issue)
+    r = session.post(url, data=labels)
+    r.raise_for_status()
+    return r.json()
+
+
+# label writes of the console and the webhook, add_labels is looked up when
+# called, so it can be replaced
+label_batcher = LabelBatcher(lambda *args: add_labels(*args),
+                             interval=float(os.getenv("LABEL_FLUSH_INTERVAL", 0)),
+                             workers=int(os.getenv("LABEL_FLUSH_WORKERS", 4)))
+
+
+def process_issue(session, repo, issue, cache=None, comment_cache=None):
+    """Apply the rules to an issue and attach the missing labels
+    
+    Uses scope, rules and fallback label from settings.config. Labels are
+    attached through :py:data:`label_batcher`, which skips labels the
+    issue is known to have and may send them later.
+
+    Args:
+        session (Session): Request's session
+        repo (tuple): (repository_owner, repository_name) 
+        issue (dict): Issue as returned by :py:func:`fetch_issues` or
+            :py:func:`graphql.fetch_issues`
+        cache (:class:`ConditionalCache`): Cache for conditional requests
+        comment_cache (:class:`CommentCache`): Labels of already searched
+            comments, only newer comments are fetched and searched
+    Returns:
+        set: Labels attached to the issue
+    """
+    scope = settings.config["scope"]
+    print("Inspecting issue #{} '{}' in a repository '{}' ".format(
+        issue["number"],
+        issue["title"], repo[1])
+    )
+
+    rules = settings.config["rules"]
+    current_labels = [label["name"] for label in issue["labels"]]
+    searched_content = []
+    comment_labels = set()
+
+    # aply rules to issues's body if it's in the scope
+    if "issue_body" in scope:
+        searched_content.append(issue["body"])
+
+    # check comments if needed, the GraphQL backend fetched them with the issue
+    if "issue_comments" in scope and comment_cache is None:
+        comments = issue.get("fetched_comments", None)
+        if comments is None:
+            comments = fetch_comments(session, repo, issue["number"], cache, settings.PER_PAGE)
+        searched_content.extend(comment["body"] for comment in comments)
+    elif "issue_comments" in scope:
+        since, known = comment_cache.get(repo, issue["number"], rules)
+        if "fetched_comments" in issue:
+            comments, complete = issue["fetched_comments"], True
+        else:
+            comments = list(fetch_comments(session, repo, issue["number"], cache,
+                                           settings.PER_PAGE, since))
+            complete = since is None
+            if not complete and comments_deleted(issue, known, comments):
+                comments = list(fetch_comments(session, repo, issue["number"], cache,
+                                               settings.PER_PAGE))
+                complete = True
+        # only new and edited comments are searched
+        searched = dict((comment["id"], rules.match(comment["body"])) for comment in comments
+                        if comment["id"] not in known or comment["updated_at"] >= since)
+        comment_labels = comment_cache.update(repo, issue["number"], rules, comments, searched,
+                                              complete)
+
+    guard = getattr(rules, "guard", None)
+    try:
+        match, missing_labels = check_rules(rules, searched_content, current_labels,
+                                            settings.config["fallback_label"], comment_labels)
+    except EvaluationAborted as e:
+        # the labels found are right, the issue fails so the next poll evaluates it again
+        label_batcher.add(session, repo, issue["number"], e.labels, current_labels)
+        # unless it ran out of the budget every time, it would hold the cursor back for good
+        if guard is None or not guard.aborted((tuple(repo), issue["number"])):
+            raise
+        print("Giving up on issue #{}, rules keep running out of the budget".format(
+            issue["number"]))
+        return e.labels
+    if guard is not None:
+        guard.completed((tuple(repo), issue["number"]))
+    # add labels to the issue, unless they were just added
+    label_batcher.add(session, repo, issue["number"], missing_labels, current_labels)
+    return missing_labels
+
+
+def poll_repository(session, repo, cursors, cache=None, executor=None, limit=None,
+                    comment_cache=None, fetch=None):
+    """Label all issues of the repository updated since the last poll
+    
+    Issues are processed by :py:func:`process_issue`, either one by one or
+    concurrently in the executor. Issues are independent of each other, so
+    the order in which they are finished does not matter.
+
+    Args:
+        session (Session): Request's session
+        repo (tuple): (repository_owner, repository_name) 
+        cursors (:class:`CursorStore`): Last processed issue per repository
+        cache (:class:`ConditionalCache`): Cache for conditional requests
+        executor (Executor): Executor to process issues concurrently,
+            issues are processed one by one if None
+        limit (Semaphore): Caps the number of issues of the repository
+            processed at the same time
+        comment_cache (:class:`CommentCache`): Labels of already searched comments
+        fetch (callable): Function listing the issues, :py:func:`fetch_issues`
+            if None, :py:func:`graphql.fetch_issues` fetches comments too
+    Returns:
+        int: Number of processed issues
+    """
+    fetch = fetch or fetch_issues
+    scope = settings.config["scope"]
+    done, failed = [], []
+    futures = {}
+    processed = 0
+
+    def release(future):
+        limit.release()
+
+    for issue in fetch(session, repo, cache, settings.PER_PAGE, cursors.get(repo)):
+        # skip PR if they aren't in the scope and issues processed by the last poll
+        if (issue.get("pull_request", None) and "pull_requests" not in scope or
+                cursors.is_processed(repo, issue)):
+            done.append(issue)
+            continue
+
+        processed += 1
+        if executor is None:
+            try:
+                process_issue(session, repo, issue, cache, comment_cache)
+                done.append(issue)
+            except Exception as e:
+                print(e)
+                failed.append(issue)
+            continue
+
+        if limit is not None:
+            limit.acquire()
+        future = executor.submit(process_issue, session, repo, issue, cache, comment_cache)
+        if limit is not None:
+            future.add_done_callback(release)
+        futures[future] = issue
+
+    for future in concurrent.futures.as_completed(futures):
+        if future.exception() is not None:
+            print(future.exception())
+            failed.append(futures[future])
+        else:
+            done.append(futures[future])
+
+    if label_batcher.interval > 0:
+        # held labels must be sent before the cursor moves past their issues
+        lost = label_batcher.settle(repo, [issue["number"] for issue in done])
+        failed.extend(issue for issue in done if issue["number"] in lost)
+        done = [issue for issue in done if issue["number"] not in lost]
+
+    # make sure the failed issues are fetched again next time
+    cursors.advance(repo, done, failed)
+    cursors.save()
+    return processed
+
+
+def watch_repositories(session, repos, cursors, scheduler, executor=None, repo_workers=4,
+                       comment_cache=None, cycles=None, fetch=None):
+    """Periodically poll all repositories over one session
+
+    Repositories are polled one at a time, always the one which is due
+    first (ties are broken round-robin), so a busy repository can't starve
+    the others. The delay before the next poll of a repository comes from
+    the scheduler.
+
+    Args:
+        session (Session): Request's session
+        repos (list): List of (repository_owner, repository_name) tuples
+        cursors (:class:`CursorStore`): Last processed issue per repository
+        scheduler (:class:`PollScheduler`): Decides when to poll again
+        executor (Executor): Executor to process issues concurrently,
+            issues are processed one by one if None
+        repo_workers (int): Maximum of concurrently processed issues per repository
+        comment_cache (:class:`CommentCache`): Labels of already searched comments
+        cycles (int): Stop after this many polls of every repository, run
+            forever if None
+        fetch (callable): Function listing the issues, see :py:func:`poll_repository`
+    """
+    # unchanged pages are answered with 304 Not Modified
+    cache = ConditionalCache()
+    limits = dict((repo, threading.BoundedSemaphore(repo_workers)) for repo in repos)
+    pending = [(0, order, repo) for order, repo in enumerate(repos)]
+    polls = dict((repo, 0) for repo in repos)
+    order = len(pending)
+
+    while pending:
+        due, _, repo = heapq.heappop(pending)
+        # wait until the repository is due
+        time.sleep(max(0, due - time.time()))
+        try:
+            processed = poll_repository(session, repo, cursors, cache, executor,
+                                        limits[repo], comment_cache, fetch)
+        except Exception as e:
+            print(e)
+            processed = 0
+
+        polls[repo] += 1
+        delay = scheduler.next_delay(repo, processed)
+        breaker = settings.config.get("breaker", None)
+        if breaker is not None:
+            # don't poll while GitHub is failing
+            delay = max(delay, breaker.blocked_for())
+        if cycles is None or polls[repo] < cycles:
+            heapq.heappush(pending, (time.time() + delay, order, repo))
+            order += 1
+    label_batcher.flush()
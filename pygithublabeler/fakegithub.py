@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import copy
+import glob
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+_ISSUES = re.compile(r"^/repos/([^/]+)/([^/]+)/issues$")
+_COMMENTS = re.compile(r"^/repos/([^/]+)/([^/]+)/issues/(\d+)/comments$")
+_LABELS = re.compile(r"^/repos/([^/]+)/([^/]+)/issues/(\d+)/labels$")
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeGitHub(object):
+    """Local stand-in for the parts of the GitHub API the labeler uses
+
+    Serves issue and comment listings with ``Link`` pagination, ``since``
+    filtering and ``ETag`` validators (answering ``304 Not Modified`` to matching
+    ``If-None-Match`` requests) and accepts label additions. Every request
+    is counted, so tests and benchmarks can measure round-trips and
+    transferred bytes.
+
+    GraphQL queries are answered by replaying recorded exchanges: the
+    response of the first exchange whose variables equal the variables of
+    the query is sent.
+
+    Failures can be injected with :py:meth:`fail`, the next requests are
+    then answered with an error status instead. For load tests every
+    answer can be delayed, a random fraction of requests can fail with
+    ``502`` and a rate limit can be enforced: requests over the limit are
+    refused with ``403`` like GitHub does and every response carries the
+    ``X-RateLimit-*`` headers.
+
+    Args:
+        issues (dict): Lists of issue dicts keyed by ``(owner, name)``
+        comments (dict): Lists of comment dicts keyed by ``(owner, name, number)``
+        per_page (int): Default page size
+        graphql (list): Recorded GraphQL exchanges, dicts with ``variables``
+            and ``response``
+        latency (float): Seconds every answer is delayed
+        error_rate (float): Fraction of requests failing with ``502``
+        rate_limit (int): Requests allowed per window, unlimited if None
+        rate_limit_window (float): Seconds after which the limit resets
+        seed (int): Seed of the random generator picking failing requests
+    """
+
+    def __init__(self, issues=None, comments=None, per_page=30, graphql=None, latency=0,
+                 error_rate=0, rate_limit=None, rate_limit_window=60, seed=0):
+        self.issues = issues or {}
+        self.comments = comments or {}
+        self.per_page = per_page
+        self.graphql = graphql or []
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self.calls = {}
+        self.errors = 0
+        self.rate_limited = 0
+        self.window_start = time.time()
+        self.used = 0
+        self.failures = []
+        self.server = None
+        self.thread = None
+
+    @classmethod
+    def from_cassettes(cls, directory, copies=1, keep_labels=True, **kwargs):
+        """Fake seeded with the issues and comments recorded by betamax
+
+        Args:
+            directory (str): Directory with the cassettes
+            copies (int): Every recorded issue is served this many times
+                under different numbers, to get a bigger repository
+            keep_labels (bool): Serve the issues with their recorded labels,
+                without any labels if False
+            **kwargs: Other arguments of :class:`FakeGitHub`
+        Returns:
+            :class:`FakeGitHub`: Fake, not started yet
+        """
+        issues, comments = {}, {}
+        for filename in sorted(glob.glob(os.path.join(directory, "*.json"))):
+            with open(filename) as f:
+                cassette = json.load(f)
+            for interaction in cassette["http_interactions"]:
+                request, response = interaction["request"], interaction["response"]
+                if request["method"] != "GET" or response["status"]["code"] != 200:
+                    continue
+                path = urlsplit(request["uri"]).path
+                body = json.loads(response["body"]["string"])
+                listing = _ISSUES.match(path)
+                thread = _COMMENTS.match(path)
+                if listing:
+                    known = issues.setdefault(listing.groups(), [])
+                    numbers = set(issue["number"] for issue in known)
+                    known.extend(issue for issue in body if issue["number"] not in numbers)
+                elif thread:
+                    owner, name, number = thread.groups()
+                    comments[(owner, name, int(number))] = body
+
+        for repo, recorded in issues.items():
+            offset = max([issue["number"] for issue in recorded] or [0])
+            served = []
+            for i in range(copies):
+                for issue in recorded:
+                    issue = copy.deepcopy(issue)
+                    key = repo + (issue["number"],)
+                    issue["number"] += i * offset
+                    if not keep_labels:
+                        issue["labels"] = []
+                    if key in comments:
+                        comments[repo + (issue["number"],)] = copy.deepcopy(comments[key])
+                    served.append(issue)
+            issues[repo] = served
+        return cls(issues, comments, **kwargs)
+
+    @property
+    def url(self):
+        """Base URL of the running server"""
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        """Start serving on a random local port in a background thread"""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake._handle(self, "GET")
+
+            def do_POST(self):
+                fake._handle(self, "POST")
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Shut the server down"""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stats(self):
+        """Summary of the served requests
+
+        Returns:
+            dict: requests, not_modified, bytes_sent, calls (requests per
+            endpoint), errors (injected by ``error_rate``) and rate_limited
+        """
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "not_modified": self.not_modified,
+                "bytes_sent": self.bytes_sent,
+                "calls": dict(self.calls),
+                "errors": self.errors,
+                "rate_limited": self.rate_limited,
+            }
+
+    def fail(self, status=503, times=1, headers=None):
+        """Answer the next requests with an error
+
+        Args:
+            status (int): Status of the error responses
+            times (int): Number of requests to fail
+            headers (dict): Extra headers of the error responses, e.g. ``Retry-After``
+        """
+        with self.lock:
+            self.failures.extend([(status, headers)] * times)
+
+    def _handle(self, handler, method):
+        split = urlsplit(handler.path)
+        query = parse_qs(split.query)
+
+        issues = _ISSUES.match(split.path)
+        comments = _COMMENTS.match(split.path)
+        labels = _LABELS.match(split.path)
+        endpoint = "{} {}".format(method, "issues" if issues else "comments" if comments else
+                                  "labels" if labels else split.path)
+
+        with self.lock:
+            self.requests += 1
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            failure = self.failures.pop(0) if self.failures else None
+            if failure is None and self.error_rate and self.random.random() < self.error_rate:
+                self.errors += 1
+                failure = (502, None)
+            handler.rate_limit_headers, exhausted = self._take_rate_limit()
+            if failure is None and exhausted:
+                self.rate_limited += 1
+                failure = (403, None)
+        if self.latency:
+            time.sleep(self.latency)
+        if failure is not None:
+            status, headers = failure
+            message = "API rate limit exceeded" if status == 403 else "Injected failure"
+            self._send(handler, status, {"message": message}, headers)
+            return
+
+        if method == "GET" and issues:
+            items = self.issues.get(issues.groups(), [])
+            if "since" in query:
+                since = query["since"][0]
+                items = [item for item in items if item["updated_at"] >= since]
+            if query.get("sort") == ["updated"]:
+                items = sorted(items, key=lambda item: item["updated_at"],
+                               reverse=query.get("direction") != ["asc"])
+            self._send_page(handler, split.path, query, items)
+        elif method == "GET" and comments:
+            owner, name, number = comments.groups()
+            items = self.comments.get((owner, name, int(number)), [])
+            if "since" in query:
+                since = query["since"][0]
+                items = [item for item in items if item["updated_at"] >= since]
+            self._send_page(handler, split.path, query, items)
+        elif method == "POST" and split.path == "/graphql":
+            length = int(handler.headers.get("Content-Length", 0))
+            variables = json.loads(handler.rfile.read(length).decode("utf-8"))["variables"]
+            for exchange in self.graphql:
+                if exchange["variables"] == variables:
+                    self._send(handler, 200, exchange["response"])
+                    break
+            else:
+                self._send(handler, 200, {"errors": [{"message": "No recorded response for "
+                                                                 "{}".format(variables)}]})
+        elif method == "POST" and labels:
+            owner, name, number = labels.groups()
+            length = int(handler.headers.get("Content-Length", 0))
+            new_labels = json.loads(handler.rfile.read(length).decode("utf-8"))
+            self._send(handler, 200, self._add_labels(owner, name, int(number), new_labels))
+        else:
+            self._send(handler, 404, {"message": "Not Found"})
+
+    def _take_rate_limit(self):
+        """Count a request against the rate limit
+
+        Returns:
+            tuple: (headers, exhausted), X-RateLimit-* headers and whether
+            the request is over the limit
+        """
+        if self.rate_limit is None:
+            return {}, False
+        now = time.time()
+        if now - self.window_start >= self.rate_limit_window:
+            self.window_start = now
+            self.used = 0
+        exhausted = self.used >= self.rate_limit
+        if not exhausted:
+            self.used += 1
+        return {
+            "X-RateLimit-Limit": str(self.rate_limit),
+            "X-RateLimit-Remaining": str(self.rate_limit - self.used),
+            "X-RateLimit-Reset": str(int(self.window_start + self.rate_limit_window)),
+        }, exhausted
+
+    @staticmethod
+    def now():
+        """Current time in the format GitHub uses for timestamps"""
+        return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+    def _find_issue(self, owner, name, number):
+        for issue in self.issues.get((owner, name), []):
+            if issue["number"] == number:
+                return issue
+        return None
+
+    def _add_labels(self, owner, name, number, new_labels):
+        with self.lock:
+            issue = self._find_issue(owner, name, number)
+            if issue is None:
+                return []
+            current = [label["name"] for label in issue["labels"]]
+            for label in new_labels:
+                if label not in current:
+                    issue["labels"].append({"name": label})
+                    issue["updated_at"] = self.now()
+            return list(issue["labels"])
+
+    def _send_page(self, handler, path, query, items):
+        per_page = int(query.get("per_page", [self.per_page])[0])
+        page = int(query.get("page", ["1"])[0])
+        start = (page - 1) * per_page
+        headers = {}
+        if start + per_page < len(items):
+            next_query = dict((key, values[0]) for key, values in query.items())
+            next_query.update({"page": page + 1, "per_page": per_page})
+            headers["Link"] = '<{}{}?{}>; rel="next"'.format(
+                self.url, path, urlencode(sorted(next_query.items())))
+        self._send(handler, 200, items[start:start + per_page], headers)
+
+    def _send(self, handler, status, data, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if status == 200 and handler.command == "GET" and \
+                handler.headers.get("If-None-Match") == etag:
+            status, body = 304, b""
+            with self.lock:
+                self.not_modified += 1
+
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.send_header("ETag", etag)
+        headers = dict(getattr(handler, "rate_limit_headers", None) or {}, **(headers or {}))
+        for key, value in headers.items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+        with self.lock:
+            self.bytes_sent += len(body)
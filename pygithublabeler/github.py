@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import metrics
+
+# server side failures worth retrying, 429 is a secondary rate limit
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_REPOSITORY = re.compile(r"/repos/[^/]+/[^/]+")
+_NUMBER = re.compile(r"/[0-9]+(?=/|$)")
+
+
+def endpoint(url):
+    """Path of a GitHub API URL with the repository and numbers left out,
+    e.g. ``/repos/{owner}/{repo}/issues/{number}/labels``, so metrics of
+    all repositories and issues add up"""
+    path = _REPOSITORY.sub("/repos/{owner}/{repo}", urlsplit(url).path)
+    return _NUMBER.sub("/{number}", path)
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Request refused because GitHub is failing"""
+
+
+class CircuitBreaker(object):
+    """Stops sending requests to GitHub while it is failing
+
+    After ``failures`` failed requests in a row (connection errors,
+    timeouts, ``5xx`` and ``429`` responses which outlived all retries) the
+    circuit opens and every request is refused right away. After
+    ``reset_timeout`` seconds one request is let through: if it succeeds
+    the circuit closes, otherwise it stays open for another timeout.
+
+    The breaker can be shared by several threads.
+
+    Args:
+        failures (int): Failed requests in a row which open the circuit
+        reset_timeout (float): Seconds before a request is tried again
+    """
+
+    #: Seconds to wait before checking again while the trial request is in flight
+    trial_wait = 0.1
+
+    def __init__(self, failures=5, reset_timeout=30):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failed = 0
+        self.opened_at = None
+        self.trial = False
+        self.opened = 0
+
+    def allow(self):
+        """Check whether a request may be sent
+
+        Returns:
+            bool: False while the circuit is open
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.time() - self.opened_at < self.reset_timeout:
+                return False
+            # half open, let one request find out whether GitHub recovered
+            self.trial = True
+            return True
+
+    def record(self, success):
+        """Record the outcome of a request"""
+        with self.lock:
+            self.trial = False
+            if success:
+                self.failed = 0
+                self.opened_at = None
+                return
+            self.failed += 1
+            if self.opened_at is not None or self.failed >= self.failures:
+                if self.opened_at is None:
+                    self.opened += 1
+                self.opened_at = time.time()
+
+    def is_open(self):
+        """True if requests are refused right now"""
+        return self.blocked_for() > 0
+
+    def blocked_for(self):
+        """Seconds until a request is tried again, 0 if the circuit is closed"""
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+            if self.trial:
+                # the outcome of the trial request decides, check again soon
+                return self.trial_wait
+            return max(0, self.opened_at + self.reset_timeout - time.time())
+
+    def stats(self):
+        """State of the circuit
+
+        Returns:
+            dict: open, failed (failures in a row) and opened (how many
+            times the circuit opened)
+        """
+        is_open = self.is_open()
+        with self.lock:
+            return {"open": is_open, "failed": self.failed, "opened": self.opened}
+
+
+class JitterRetry(Retry):
+    """Retry with exponential backoff spread randomly over its upper half,
+    so clients failing together don't retry together"""
+
+    def get_backoff_time(self):
+        backoff = super(JitterRetry, self).get_backoff_time()
+        return random.uniform(backoff / 2, backoff)
+
+    def increment(self, method=None, url=None, response=None, error=None, *args, **kwargs):
+        metrics.github_retries.inc(method=method, endpoint=endpoint(url or ""),
+                                   status=response.status if response is not None else "error")
+        return super(JitterRetry, self).increment(method, url, response, error, *args, **kwargs)
+
+
+class GitHubAdapter(HTTPAdapter):
+    """Transport adapter applying default timeouts and the circuit breaker
+
+    Args:
+        timeout (tuple): Default (connect, read) timeout in seconds
+        breaker (:class:`CircuitBreaker`): Breaker consulted before and fed
+            after every request, no breaker if None
+        **kwargs: Arguments of :class:`requests.adapters.HTTPAdapter`
+    """
+
+    def __init__(self, timeout=None, breaker=None, **kwargs):
+        self.timeout = timeout
+        self.breaker = breaker
+        super(GitHubAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        labels = {"method": request.method, "endpoint": endpoint(request.url)}
+        if self.breaker is not None and not self.breaker.allow():
+            metrics.github_seconds.observe(0, status="circuit_open", **labels)
+            raise CircuitOpenError("GitHub is failing, request to {} refused".format(request.url),
+                                   request=request)
+        start = time.perf_counter()
+        try:
+            response = super(GitHubAdapter, self).send(request, **kwargs)
+        except requests.RequestException:
+            metrics.github_seconds.observe(time.perf_counter() - start, status="error", **labels)
+            if self.breaker is not None:
+                self.breaker.record(False)
+            raise
+        metrics.github_seconds.observe(time.perf_counter() - start,
+                                       status=response.status_code, **labels)
+        if self.breaker is not None:
+            self.breaker.record(response.status_code not in RETRY_STATUSES)
+        return response
+
+
+class Transport(object):
+    """Settings of the HTTP transport to GitHub
+
+    Connections are pooled and kept alive, requests time out, idempotent
+    requests failing with a ``5xx`` or ``429`` are retried with exponential
+    backoff and jitter (waiting as long as ``Retry-After`` asks) and a
+    :class:`CircuitBreaker` stops requests while GitHub keeps failing.
+
+    Args:
+        pool_size (int): Connections kept alive per host
+        connect_timeout (float): Seconds to wait for a connection
+        read_timeout (float): Seconds to wait for a response
+        retries (int): Retries of a failed request, 0 disables retries
+        backoff (float): Backoff factor, the n-th retry waits up to
+            ``backoff * 2 ** (n - 1)`` seconds
+        breaker (:class:`CircuitBreaker`): Circuit breaker, none if None
+    """
+
+    def __init__(self, pool_size=10, connect_timeout=5, read_timeout=30, retries=3,
+                 backoff=0.5, breaker=None):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker
+
+    @classmethod
+    def from_env(cls):
+        """Transport configured by GITHUB_* env variables"""
+        failures = int(os.getenv("GITHUB_BREAKER_FAILURES", 5))
+        breaker = None
+        if failures > 0:
+            breaker = CircuitBreaker(failures, float(os.getenv("GITHUB_BREAKER_RESET", 30)))
+        return cls(pool_size=int(os.getenv("GITHUB_POOL_SIZE", 10)),
+                   connect_timeout=float(os.getenv("GITHUB_CONNECT_TIMEOUT", 5)),
+                   read_timeout=float(os.getenv("GITHUB_READ_TIMEOUT", 30)),
+                   retries=int(os.getenv("GITHUB_RETRIES", 3)),
+                   backoff=float(os.getenv("GITHUB_BACKOFF", 0.5)),
+                   breaker=breaker)
+
+    def adapter(self):
+        """Create a transport adapter with these settings"""
+        retry = JitterRetry(total=self.retries, connect=self.retries, read=self.retries,
+                            status=self.retries, status_forcelist=RETRY_STATUSES,
+                            # adding labels is idempotent too
+                            allowed_methods=frozenset(["GET", "HEAD", "POST"]),
+                            backoff_factor=self.backoff, respect_retry_after_header=True,
+                            raise_on_status=False)
+        return GitHubAdapter(timeout=(self.connect_timeout, self.read_timeout),
+                             breaker=self.breaker, pool_connections=self.pool_size,
+                             pool_maxsize=self.pool_size, max_retries=retry)
+
+    def mount(self, session):
+        """Use these settings for all requests of the session"""
+        adapter = self.adapter()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+
+def get_session(token, custom_session=None, transport=None):
+    """Get requests session with authorization headers
+    
+    Args:
+        token (str): Top secret GitHub access token
+        custom_session: e.g. betamax's session
+        transport (:class:`Transport`): Pooling, timeouts, retries and
+            circuit breaker, requests' defaults if None
+    
+    Returns:
+        :class:`requests.sessions.Session`: Session 
+    """
+    session = custom_session or requests.Session()
+    session.headers = {
+        "Authorization": "token " + token,
+        "User-Agent": "testapp"
+    }
+    if transport is not None:
+        transport.mount(session)
+    return session
+
+
+class ConditionalCache(object):
+    """Cache of GET responses for conditional requests
+
+    Remembers the ``ETag`` and ``Last-Modified`` validators of every fetched
+    page together with its parsed body. The next request for the same URL
+    sends ``If-None-Match``/``If-Modified-Since`` and if GitHub answers
+    ``304 Not Modified`` the cached body is used instead. Not modified
+    responses do not count against the GitHub rate limit.
+
+    The cache can be shared by several threads.
+
+    Args:
+        max_entries (int): How many URLs to remember, least recently used
+            entries are evicted first
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes_received = 0
+        self.bytes_saved = 0
+
+    def headers(self, url):
+        """Conditional request headers for the URL
+
+        Args:
+            url (str): Full URL of the request
+        Returns:
+            dict: Headers to send, empty if the URL is not cached
+        """
+        with self.lock:
+            return conditional_headers(self.entries.get(url))
+
+    def get(self, url):
+        """Get cached entry for the URL and mark it as recently used"""
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+            return entry
+
+    def store(self, url, headers, size, data, next_url):
+        """Remember the response if it carries any validator
+
+        Args:
+            url (str): Full URL of the request
+            headers (dict): Headers of the response
+            size (int): Size of the response body
+            data: Parsed JSON body
+            next_url (str): URL of the next page or None
+        """
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        with self.lock:
+            self.entries[url] = {
+                "etag": etag,
+                "last_modified": last_modified,
+                "data": data,
+                "next": next_url,
+                "size": size,
+            }
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def record(self, received, saved=None):
+        """Count a request made through the cache
+
+        Args:
+            received (int): Size of the received body
+            saved (int): Size of the cached body replayed instead, None if
+                the response was not a 304
+        """
+        with self.lock:
+            self.requests += 1
+            self.bytes_received += received
+            if saved is not None:
+                self.not_modified += 1
+                self.bytes_saved += saved
+
+    def stats(self):
+        """Summary of the requests made through the cache
+
+        Returns:
+            dict: requests, not_modified, bytes_received and bytes_saved
+        """
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "not_modified": self.not_modified,
+                "bytes_received": self.bytes_received,
+                "bytes_saved": self.bytes_saved,
+            }
+
+
+def conditional_headers(entry):
+    """Build conditional request headers from a cache entry"""
+    headers = {}
+    if entry is None:
+        return headers
+    if entry["etag"]:
+        headers["If-None-Match"] = entry["etag"]
+    if entry["last_modified"]:
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def iter_pages(session, url, params=None, cache=None):
+    """Lazily iterate over all items of a paginated GitHub listing
+
+    Follows the ``next`` relation of the ``Link`` header. Pages are fetched
+    only when the caller consumes the items of the previous one.
+
+    Args:
+        session (Session): Request's session
+        url (str): URL of the first page
+        params (dict): Query parameters of the first page
+        cache (:class:`ConditionalCache`): Cache for conditional requests
+    Yields:
+        dict: Items of the listing
+    """
+    while url:
+        full_url = requests.Request("GET", url, params=params).prepare().url
+        entry = cache.get(full_url) if cache is not None else None
+        headers = conditional_headers(entry)
+
+        r = session.get(url, params=params, headers=headers)
+        if r.status_code == 304 and entry is None:
+            # validators sent by someone else and nothing cached, fetch the page for real
+            r = session.get(url, params=params,
+                            headers={"If-None-Match": None, "If-Modified-Since": None})
+        # links to the next pages already contain the query
+        params = None
+
+        if r.status_code == 304 and entry is not None:
+            cache.record(len(r.content), entry["size"])
+            data, url = entry["data"], entry["next"]
+        else:
+            if cache is not None:
+                cache.record(len(r.content))
+            r.raise_for_status()
+            data = r.json()
+            url = r.links.get("next", {}).get("url")
+            if cache is not None:
+                cache.store(full_url, r.headers, len(r.content), data, url)
+
+        for item in data:
+            yield item
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import itertools
+
+from . import settings
+
+ISSUES_QUERY = """
+query($owner: String!, $name: String!, $first: Int!, $after: String, $since: DateTime) {
+  repository(owner: $owner, name: $name) {
+    issues(first: $first, after: $after, states: OPEN,
+           orderBy: {field: UPDATED_AT, direction: ASC}, filterBy: {since: $since}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number
+        title
+        body
+        updatedAt
+        labels(first: 100) { nodes { name } }
+        comments(first: $first) {
+          pageInfo { hasNextPage endCursor }
+          nodes { databaseId body updatedAt }
+        }
+      }
+    }
+  }
+}
+"""
+
+# pull requests can't be filtered by the time of the last update, they are
+# listed newest first until the rest is older than the last poll
+PULL_REQUESTS_QUERY = """
+query($owner: String!, $name: String!, $first: Int!, $after: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(first: $first, after: $after, states: OPEN,
+                 orderBy: {field: UPDATED_AT, direction: DESC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number
+        title
+        body
+        updatedAt
+        url
+        labels(first: 100) { nodes { name } }
+        comments(first: $first) {
+          pageInfo { hasNextPage endCursor }
+          nodes { databaseId body updatedAt }
+        }
+      }
+    }
+  }
+}
+"""
+
+COMMENTS_QUERY = """
+query($owner: String!, $name: String!, $number: Int!, $first: Int!, $after: String) {
+  repository(owner: $owner, name: $name) {
+    issue(number: $number) {
+      comments(first: $first, after: $after) {
+        pageInfo { hasNextPage endCursor }
+        nodes { databaseId body updatedAt }
+      }
+    }
+  }
+}
+"""
+
+PULL_REQUEST_COMMENTS_QUERY = COMMENTS_QUERY.replace("issue(number", "pullRequest(number")
+
+# GitHub's limit of nodes per connection
+MAX_PER_PAGE = 100
+
+
+class GraphQLError(Exception):
+    """GitHub answered a GraphQL query with errors"""
+
+
+def graphql_url():
+    """URL of the GraphQL endpoint belonging to the configured REST API
+
+    Returns:
+        str: ``https://api.github.com/graphql`` or ``https://host/api/graphql``
+        for GitHub Enterprise
+    """
+    api_url = settings.API_URL
+    if api_url.endswith("/api/v3"):
+        return api_url[:-len("/v3")] + "/graphql"
+    return api_url + "/graphql"
+
+
+def run_query(session, query, variables):
+    """Run a GraphQL query
+
+    Args:
+        session (Session): Request's session
+        query (str): GraphQL query
+        variables (dict): Variables of the query
+    Returns:
+        dict: ``data`` of the response
+    Raises:
+        GraphQLError: If the response contains errors
+    """
+    r = session.post(graphql_url(), json={"query": query, "variables": variables})
+    r.raise_for_status()
+    response = r.json()
+    if response.get("errors"):
+        raise GraphQLError("; ".join(error.get("message", "") for error in response["errors"]))
+    return response["data"]
+
+
+def _comment(node):
+    return {"id": node["databaseId"], "body": node["body"], "updated_at": node["updatedAt"]}
+
+
+def _issue(node):
+    issue = {
+        "number": node["number"],
+        "title": node["title"],
+        "body": node["body"],
+        "updated_at": node["updatedAt"],
+        "labels": [{"name": label["name"]} for label in node["labels"]["nodes"]],
+        "fetched_comments": [_comment(comment) for comment in node["comments"]["nodes"]],
+    }
+    if "url" in node:
+        # marks a pull request like the REST API does
+        issue["pull_request"] = {"html_url": node["url"]}
+    return issue
+
+
+def fetch_comments(session, repo, issue, first=MAX_PER_PAGE, after=None, pull_request=False):
+    """Fetch the remaining comments of an issue
+
+    Args:
+        session (Session): Request's session
+        repo (tuple): (repository_owner, repository_name)
+        issue (int): Issue's number
+        first (int): Number of comments per page
+        after (str): Cursor of the last comment already fetched
+        pull_request (bool): True if the issue is a pull request
+    Returns:
+        list: Comments as dicts with id, body and updated_at
+    """
+    query = PULL_REQUEST_COMMENTS_QUERY if pull_request else COMMENTS_QUERY
+    comments = []
+    while True:
+        data = run_query(session, query, {"owner": repo[0], "name": repo[1],
+                                          "number": issue, "first": first, "after": after})
+        node = data["repository"]["pullRequest" if pull_request else "issue"]
+        connection = node["comments"]
+        comments.extend(_comment(node) for node in connection["nodes"])
+        if not connection["pageInfo"]["hasNextPage"]:
+            return comments
+        after = connection["pageInfo"]["endCursor"]
+
+
+def _fetch_pull_requests(session, repo, first, since):
+    """Open pull requests updated at or after ``since``, newest first"""
+    after = None
+    while True:
+        data = run_query(session, PULL_REQUESTS_QUERY, {"owner": repo[0], "name": repo[1],
+                                                        "first": first, "after": after})
+        connection = data["repository"]["pullRequests"]
+        for node in connection["nodes"]:
+            if since is not None and node["updatedAt"] < since:
+                return
+            yield node
+        if not connection["pageInfo"]["hasNextPage"]:
+            return
+        after = connection["pageInfo"]["endCursor"]
+
+
+def _fetch_issue_nodes(session, repo, first, since):
+    """Open issues updated at or after ``since``, oldest first"""
+    after = None
+    while True:
+        data = run_query(session, ISSUES_QUERY, {"owner": repo[0], "name": repo[1],
+                                                 "first": first, "after": after,
+                                                 "since": since})
+        connection = data["repository"]["issues"]
+        for node in connection["nodes"]:
+            yield node
+        if not connection["pageInfo"]["hasNextPage"]:
+            return
+        after = connection["pageInfo"]["endCursor"]
+
+
+def fetch_issues(session, repo, cache=None, per_page=None, since=None):
+    """Fetch open issues of the repository together with their labels and comments
+
+    A drop-in replacement of :py:func:`engine.fetch_issues`: one query
+    returns a whole page of issues including their comments, so
+    :py:func:`engine.process_issue` doesn't fetch comments issue by issue.
+    Only issues with more comments than fit into the page need further
+    queries. GraphQL lists pull requests separately, they are fetched after
+    the issues if ``pull_requests`` is in the configured scope.
+
+    Args:
+        session (Session): Request's session
+        repo (tuple): (repository_owner, repository_name)
+        cache: Unused, GraphQL queries can't be conditional
+        per_page (int): Number of issues per page and of comments fetched
+            with every issue, at most 100
+        since (str): Only issues updated at or after this ISO 8601 timestamp
+    Yields:
+        dict: Issues shaped like the REST API's, with ``fetched_comments``,
+        pull requests with ``pull_request``
+    """
+    first = min(per_page or MAX_PER_PAGE, MAX_PER_PAGE)
+    nodes = _fetch_issue_nodes(session, repo, first, since)
+    if "pull_requests" in settings.config.get("scope", []):
+        nodes = itertools.chain(nodes, _fetch_pull_requests(session, repo, first, since))
+    for node in nodes:
+        issue = _issue(node)
+        comments = node["comments"]["pageInfo"]
+        if comments["hasNextPage"]:
+            issue["fetched_comments"].extend(fetch_comments(
+                session, repo, issue["number"], first, comments["endCursor"],
+                "pull_request" in issue))
+        yield issue
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Time-bounded evaluation of the rules
+
+Patterns are written by users and issue bodies by anyone, and ``re``
+backtracks exponentially on some combinations of both. A running
+``re.search`` can't be interrupted, so a :class:`RuleGuard` evaluates the
+regexes in child processes and kills a child whose rule runs longer than
+the per-rule timeout, or whose request runs out of its budget. The other
+rules are evaluated again by a fresh child. A rule which timed out
+repeatedly is quarantined: it is never evaluated again by this process
+until its pattern changes.
+
+Plain literals are matched in the calling process, they can't backtrack.
+"""
+
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from .rules import RuleSet
+
+# seconds a child may take to start up or to compile the rules
+STARTUP_TIMEOUT = 30
+# how many issues to remember aborted evaluations of
+MAX_ABORTED = 10000
+
+
+class RuleTimeout(Exception):
+    """A child evaluating rules was killed
+
+    Args:
+        index (int): Index of the rule which ran longer than the per-rule
+            timeout, None if the request ran out of its budget
+        seconds (float): How long the rule ran
+    """
+
+    def __init__(self, index, seconds):
+        super(RuleTimeout, self).__init__(index, seconds)
+        self.index = index
+        self.seconds = seconds
+
+
+class Budget(object):
+    """Time left for the rules of one request
+
+    Args:
+        seconds (float): Time for all rules, unlimited if 0
+    """
+
+    def __init__(self, seconds):
+        self.deadline = time.monotonic() + seconds if seconds > 0 else None
+        # set if any rule wasn't evaluated, the result must not be memoized
+        self.aborted = False
+
+    def remaining(self):
+        """Seconds left, infinite if unlimited"""
+        if self.deadline is None:
+            return float("inf")
+        return self.deadline - time.monotonic()
+
+    def extend(self, seconds):
+        """Give back time which wasn't spent on the rules"""
+        if self.deadline is not None:
+            self.deadline += seconds
+
+
+def _serve(conn, progress):
+    """Evaluate rules sent by the parent process until the pipe closes
+
+    ``progress`` holds the index of the rule being evaluated, -1 between
+    rules, so the parent knows which rule to blame.
+    """
+    rules = None
+    conn.send("ready")
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message[0] == "rules":
+            rules = RuleSet(message[1])
+            conn.send("ready")
+            continue
+        _, indexes, text, first = message
+        matched = []
+        for index in indexes:
+            progress.value = index
+            if rules.search(index, text):
+                matched.append(index)
+                if first:
+                    break
+        progress.value = -1
+        conn.send(matched)
+
+
+class RegexProcess(object):
+    """Child process evaluating rules
+
+    Args:
+        context: Multiprocessing context starting the process
+    """
+
+    def __init__(self, context):
+        self.conn, child = context.Pipe()
+        self.progress = context.RawValue("l", -1)
+        self.process = context.Process(target=_serve, args=(child, self.progress),
+                                       name="labeler-regex")
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.fingerprint = None
+        self.ready = False
+
+    def _wait_ready(self):
+        if not self.conn.poll(STARTUP_TIMEOUT):
+            raise OSError("Rule process not ready within {} s".format(STARTUP_TIMEOUT))
+        self.conn.recv()
+
+    def prepare(self, rules=None):
+        """Wait until the child started up and compiled the rules
+
+        Args:
+            rules (RuleSet): Rules to compile, none if None
+        Raises:
+            OSError: If the child isn't ready within ``STARTUP_TIMEOUT``
+        """
+        if not self.ready:
+            self._wait_ready()
+            self.ready = True
+        if rules is not None and self.fingerprint != rules.fingerprint:
+            self.fingerprint = None
+            self.conn.send(("rules", rules.rules))
+            self._wait_ready()
+            self.fingerprint = rules.fingerprint
+
+    def search(self, rules, indexes, text, first, timeout, budget):
+        """Find which of the rules match the text
+
+        Args:
+            rules (RuleSet): Compiled rules
+            indexes (list): Indexes of the rules to evaluate
+            text (str): String to search in
+            first (bool): Stop at the first matching rule
+            timeout (float): Seconds one rule may run
+            budget (:class:`Budget`): Time left for the request
+        Returns:
+            list: Indexes of the matching rules
+        Raises:
+            RuleTimeout: If the child has to be killed
+        """
+        # starting up and compiling the rules isn't the fault of any rule
+        # or request, it isn't charged to the budget
+        start = time.monotonic()
+        self.prepare(rules)
+        budget.extend(time.monotonic() - start)
+        self.conn.send(("search", indexes, text, first))
+
+        current, since = -1, time.monotonic()
+        while True:
+            now = time.monotonic()
+            index = self.progress.value
+            if index != current:
+                current, since = index, now
+            left = budget.remaining()
+            # receiving the text isn't the fault of any rule
+            if current >= 0:
+                left = min(left, timeout - (now - since))
+            if left <= 0:
+                overrun = current >= 0 and now - since >= timeout
+                raise RuleTimeout(current if overrun else None, now - since)
+            # the progress is checked a few times per timeout
+            if self.conn.poll(min(left, max(timeout / 4, 0.001))):
+                return self.conn.recv()
+
+    def kill(self):
+        """Stop the process right away"""
+        self.process.terminate()
+        self.process.join(1)
+        self.conn.close()
+
+
+class RuleGuard(object):
+    """Evaluates rules in killable processes with a time budget
+
+    At most ``processes`` children are started, lazily in every process
+    like the threads of :class:`worker.WorkQueue`, with the ``spawn``
+    method, so they don't inherit threads or locks. A thread waits for a
+    free child as long as its budget allows.
+
+    An issue whose evaluation is aborted ``quarantine_after`` times in a
+    row, because it runs out of its budget without any single rule timing
+    out, is given up: the labels found are taken as the whole answer (see
+    :py:meth:`aborted`).
+
+    Args:
+        timeout (float): Seconds one rule may run on one text
+        budget (float): Seconds all rules may run for one request, see
+            :py:meth:`RuleSet.decide`, unlimited if 0
+        quarantine_after (int): Timeouts after which a rule is quarantined
+        processes (int): Maximum of child processes
+    """
+
+    def __init__(self, timeout=0.1, budget=1.0, quarantine_after=3, processes=2):
+        self.timeout = timeout
+        self.budget_seconds = budget
+        self.quarantine_after = quarantine_after
+        self.processes = processes
+        self.lock = threading.Lock()
+        self.pid = None
+        self.context = multiprocessing.get_context("spawn")
+        self.idle = None
+        self.started = 0
+        self.offenses = {}
+        self.quarantined = OrderedDict()
+        self.aborts = OrderedDict()
+        self.evaluations = 0
+        self.timeouts = 0
+        self.exhausted = 0
+        self.restarts = 0
+        self.given_up = 0
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # children of the parent process can't be used after fork
+            self.pid = os.getpid()
+            self.idle = queue.Queue()
+            self.started = 0
+            # started and warmed up before any budget runs
+            processes = [RegexProcess(self.context) for _ in range(self.processes)]
+            for process in processes:
+                try:
+                    process.prepare()
+                except OSError as e:
+                    print(e)
+                    process.kill()
+                    continue
+                self.started += 1
+                self.idle.put(process)
+
+    def budget(self):
+        """New budget for one request, the children are started first"""
+        self._ensure_started()
+        return Budget(self.budget_seconds)
+
+    def _acquire(self, budget):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.started < self.processes:
+                self.started += 1
+                start = True
+            else:
+                start = False
+        if start:
+            try:
+                return RegexProcess(self.context)
+            except Exception:
+                with self.lock:
+                    self.started -= 1
+                raise
+        remaining = budget.remaining()
+        return self.idle.get(timeout=None if remaining == float("inf") else max(remaining, 0))
+
+    def _discard(self, process):
+        process.kill()
+        with self.lock:
+            self.started -= 1
+            self.restarts += 1
+
+    def _offend(self, rule, seconds, length):
+        key = (rule["label"], rule["pattern"])
+        with self.lock:
+            self.timeouts += 1
+            self.offenses[key] = self.offenses.get(key, 0) + 1
+            quarantine = self.offenses[key] >= self.quarantine_after and key not in self.quarantined
+            if quarantine:
+                reason = "exceeded the timeout of {} s {} times".format(self.timeout,
+                                                                      self.offenses[key])
+                self.quarantined[key] = {"label": rule["label"], "pattern": rule["pattern"],
+                                         "reason": reason, "since": time.time()}
+        print("Rule {} {!r} aborted after {:.3f} s on a text of {} characters".format(
+            rule["label"], rule["pattern"], seconds, length))
+        if quarantine:
+            print("Quarantined rule {} {!r}: {}".format(rule["label"], rule["pattern"], reason))
+
+    def aborted(self, key):
+        """Count an aborted evaluation of an issue
+
+        Args:
+            key (tuple): Identifies the issue, e.g. (repo, number)
+        Returns:
+            bool: True if it was aborted ``quarantine_after`` times in a
+            row and should be given up
+        """
+        with self.lock:
+            count = self.aborts.pop(key, 0) + 1
+            self.aborts[key] = count
+            while len(self.aborts) > MAX_ABORTED:
+                self.aborts.popitem(last=False)
+            if count < self.quarantine_after:
+                return False
+            self.given_up += 1
+            return True
+
+    def completed(self, key):
+        """Forget the aborted evaluations of an issue evaluated in full"""
+        with self.lock:
+            self.aborts.pop(key, None)
+
+    def is_quarantined(self, rule):
+        """Check whether a rule is never evaluated"""
+        return (rule["label"], rule["pattern"]) in self.quarantined
+
+    def evaluate(self, rules, text, skip=None, first=False, budget=None):
+        """Find labels of the rules matching the text, within the budget
+
+        Rules which time out and quarantined rules don't match. If any rule
+        wasn't evaluated, ``budget.aborted`` is set.
+
+        Args:
+            rules (RuleSet): Compiled rules
+            text (str): String to search in
+            skip (set): Labels whose rules aren't evaluated
+            first (bool): Stop at the first matching rule
+            budget (:class:`Budget`): Time left for the request, a new
+                budget if None
+        Returns:
+            set: Labels of the matching rules
+        """
+        self._ensure_started()
+        budget = budget or self.budget()
+        labels = set()
+        candidates = []
+        for index, rule in enumerate(rules):
+            label = rule["label"]
+            if skip and label in skip:
+                continue
+            literal = rules.prefilters[index]
+            if literal is not None and literal not in text:
+                continue
+            if rules.kinds[index] == "literal":
+                labels.add(label)
+                if first:
+                    return labels
+            elif not self.is_quarantined(rule):
+                candidates.append(index)
+        candidates = [index for index in candidates if rules[index]["label"] not in labels]
+
+        with self.lock:
+            self.evaluations += 1
+        failures = 0
+        while candidates:
+            if budget.remaining() <= 0:
+                break
+            try:
+                process = self._acquire(budget)
+            except queue.Empty:
+                break
+            try:
+                matched = process.search(rules, candidates, text, first, self.timeout, budget)
+            except RuleTimeout as e:
+                self._discard(process)
+                budget.aborted = True
+                if e.index is None:
+                    break
+                self._offend(rules[e.index], e.seconds, len(text))
+                # the other rules are evaluated again by another process
+                candidates = [index for index in candidates if index != e.index]
+                continue
+            except (OSError, EOFError) as e:
+                # the child died, a new one gets one more chance
+                print(e)
+                self._discard(process)
+                failures += 1
+                if failures > 1:
+                    break
+                continue
+            self.idle.put(process)
+            labels.update(rules[index]["label"] for index in matched)
+            return labels
+
+        if candidates:
+            budget.aborted = True
+            with self.lock:
+                self.exhausted += 1
+            print("Rule budget of {} s exhausted, {} rules not evaluated".format(
+                self.budget_seconds, len(candidates)))
+        return labels
+
+    def stats(self):
+        """Timeouts and quarantined rules
+
+        Returns:
+            dict: timeout, budget, processes (running), evaluations
+            (texts), timeouts (rules aborted), exhausted (texts whose
+            budget ran out), restarts (of killed processes), given_up
+            (issues aborted too many times in a row) and quarantined
+            rules with the reason
+        """
+        with self.lock:
+            return {
+                "timeout": self.timeout,
+                "budget": self.budget_seconds,
+                "processes": self.started,
+                "evaluations": self.evaluations,
+                "timeouts": self.timeouts,
+                "exhausted": self.exhausted,
+                "restarts": self.restarts,
+                "given_up": self.given_up,
+                "quarantined": list(self.quarantined.values()),
+            }
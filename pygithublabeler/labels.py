@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from . import metrics
+
+
+class LabelBatcher(object):
+    """Write-behind buffer of label additions
+
+    Labels to add are diffed against the labels the issue is known to
+    have: the labels it had when it was last seen and the labels the
+    batcher added within ``ttl`` seconds. Labels already on the issue,
+    already waiting or being sent are skipped, so repeated evaluations of
+    an issue and a webhook racing the console don't send anything.
+
+    With ``interval`` 0 the remaining labels are sent right away by the
+    calling thread. Otherwise they are held and a background thread sends
+    them every ``interval`` seconds, all labels of an issue in one request
+    and at most ``workers`` requests at the same time. Labels which failed
+    to be sent are tried again by the next flushes, at most ``retries``
+    times. The thread is started lazily in every process, like the threads
+    of :class:`worker.WorkQueue`. :py:meth:`settle` waits for the labels of
+    given issues and tells which of them were dropped.
+
+    Args:
+        send (callable): Function adding labels, called with session, repo,
+            issue and a set of labels, see :py:func:`engine.add_labels`
+        interval (float): Seconds between flushes, 0 sends right away
+        workers (int): Maximum of requests sent at the same time
+        ttl (float): Seconds for which added labels are known to be on the
+            issue even if an older copy of the issue says otherwise
+        retries (int): How many times labels failed to be sent are retried
+        max_issues (int): How many issues to remember labels of
+    """
+
+    def __init__(self, send, interval=0, workers=4, ttl=300, retries=3, max_issues=10000):
+        self.send = send
+        self.interval = interval
+        self.workers = workers
+        self.ttl = ttl
+        self.retries = retries
+        self.max_issues = max_issues
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.issues = OrderedDict()
+        self.lost = OrderedDict()
+        self.pending = {}
+        self.in_flight = {}
+        self.pid = None
+        self.executor = None
+        self.requests = 0
+        self.sent = 0
+        self.skipped = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # threads don't survive fork, start them in every process
+            self.pid = os.getpid()
+            self.pending = {}
+            self.in_flight = {}
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+            if self.interval > 0:
+                thread = threading.Thread(target=self._work, name="labeler-label-batcher")
+                thread.daemon = True
+                thread.start()
+
+    def _entry(self, key):
+        entry = self.issues.pop(key, None) or {"seen": set(), "applied": {}}
+        self.issues[key] = entry
+        while len(self.issues) > self.max_issues:
+            self.issues.popitem(last=False)
+        return entry
+
+    def _known(self, key, now):
+        entry = self.issues.get(key)
+        if entry is None:
+            return set()
+        entry["applied"] = dict((label, added) for label, added in entry["applied"].items()
+                                if now - added < self.ttl)
+        return entry["seen"] | set(entry["applied"])
+
+    def add(self, session, repo, issue, labels, current_labels=None):
+        """Add labels to an issue unless it is known to have them
+
+        Args:
+            session (Session): Request's session
+            repo (tuple): (repository_owner, repository_name)
+            issue (int): Issue's number
+            labels (iterable): Labels to attach
+            current_labels (list): Labels the issue has now, the remembered
+                labels are used if None
+        Returns:
+            set: Labels which are sent, or will be sent with the next flush
+        Raises:
+            Exception: Anything raised by ``send`` if the labels are sent
+                right away
+        """
+        if self.interval > 0:
+            self._ensure_started()
+        key = (tuple(repo), issue)
+        labels = set(labels)
+        now = time.time()
+        with self.lock:
+            if current_labels is not None:
+                self._entry(key)["seen"] = set(current_labels)
+            held = self.in_flight.get(key, set())
+            if key in self.pending:
+                held = held | self.pending[key]["labels"]
+            missing = labels - self._known(key, now) - held
+            self.skipped += len(labels) - len(missing)
+            if len(labels) > len(missing):
+                metrics.labels.inc(len(labels) - len(missing), outcome="skipped")
+            if not missing:
+                return missing
+            if self.interval <= 0:
+                self.in_flight.setdefault(key, set()).update(missing)
+            else:
+                entry = self.pending.setdefault(key, {"labels": set(), "attempts": 0})
+                entry["session"] = session
+                entry["labels"].update(missing)
+
+        if self.interval <= 0:
+            self._send(key, session, missing)
+        return missing
+
+    def _send(self, key, session, labels):
+        try:
+            response = self.send(session, key[0], key[1], labels)
+        except Exception:
+            with self.lock:
+                self._done(key, labels)
+                self.failed += 1
+            metrics.labels.inc(len(labels), outcome="failed")
+            raise
+        now = time.time()
+        with self.lock:
+            self._done(key, labels)
+            self.requests += 1
+            self.sent += len(labels)
+            metrics.labels.inc(len(labels), outcome="applied")
+            entry = self._entry(key)
+            for label in labels:
+                entry["applied"][label] = now
+            # GitHub answers with all labels of the issue
+            if isinstance(response, list):
+                entry["seen"] = set(label["name"] for label in response)
+
+    def _done(self, key, labels):
+        remaining = self.in_flight.get(key, set()) - labels
+        if remaining:
+            self.in_flight[key] = remaining
+        else:
+            self.in_flight.pop(key, None)
+
+    def _work(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        """Send all held labels and wait until they are sent"""
+        self._ensure_started()
+        # one flush at a time, so settle() sees finished retries
+        with self.flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            for key, entry in batch.items():
+                self.in_flight.setdefault(key, set()).update(entry["labels"])
+        futures = dict((self.executor.submit(self._send, key, entry["session"], entry["labels"]),
+                        (key, entry)) for key, entry in batch.items())
+
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception() is None:
+                continue
+            print(future.exception())
+            key, entry = futures[future]
+            with self.lock:
+                if entry["attempts"] >= self.retries:
+                    self.dropped += len(entry["labels"])
+                    metrics.labels.inc(len(entry["labels"]), outcome="dropped")
+                    self.lost[key] = True
+                    while len(self.lost) > self.max_issues:
+                        self.lost.popitem(last=False)
+                    continue
+                held = self.pending.setdefault(key, {"labels": set(), "attempts": 0,
+                                                     "session": entry["session"]})
+                held["labels"].update(entry["labels"])
+                held["attempts"] = max(held["attempts"], entry["attempts"] + 1)
+
+    def settle(self, repo, issues):
+        """Send the held labels of the issues and wait until they are sent
+        or dropped after all retries
+
+        Args:
+            repo (tuple): (repository_owner, repository_name)
+            issues (iterable): Numbers of the issues
+        Returns:
+            set: Numbers of the issues whose labels were dropped
+        """
+        keys = set((tuple(repo), issue) for issue in issues)
+        self._ensure_started()
+        while True:
+            with self.flush_lock:
+                self._flush()
+                with self.lock:
+                    waiting = keys & (set(self.pending) | set(self.in_flight))
+                    if not waiting:
+                        lost = [key for key in keys if self.lost.pop(key, None)]
+                        return set(key[1] for key in lost)
+            # back off before the retry
+            time.sleep(min(self.interval, 1))
+
+    def clear(self):
+        """Forget the labels of all issues and the held labels"""
+        with self.lock:
+            self.issues.clear()
+            self.pending.clear()
+            self.lost.clear()
+
+    def stats(self):
+        """Held labels and how many label writes were saved
+
+        Returns:
+            dict: pending (held labels), in_flight, issues (remembered),
+            interval, requests, sent (labels), skipped (labels the issue was known
+            to have or already waiting), failed (requests) and dropped
+            (labels given up after all retries)
+        """
+        with self.lock:
+            return {
+                "pending": sum(len(entry["labels"]) for entry in self.pending.values()),
+                "in_flight": sum(len(labels) for labels in self.in_flight.values()),
+                "issues": len(self.issues),
+                "interval": self.interval,
+                "requests": self.requests,
+                "sent": self.sent,
+                "skipped": self.skipped,
+                "failed": self.failed,
+                "dropped": self.dropped,
+            }
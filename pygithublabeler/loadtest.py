@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""End-to-end load tests against a local stand-in of the GitHub API
+
+A :class:`FakeGitHub` seeded from the betamax cassettes plays GitHub,
+optionally slow (``--latency``), flaky (``--error-rate``) or rate limited
+(``--rate-limit``). Then either signed webhooks are sent to the WSGI app
+served over HTTP, or the console loop polls the fake::
+
+    python -m pygithublabeler.loadtest --latency 0.05 webhooks --count 2000 --concurrency 16
+    python -m pygithublabeler.loadtest --copies 20 --error-rate 0.05 console --cycles 5 --rescan
+
+Both report throughput, p50/p99 latency and the requests GitHub got per
+endpoint. The labeler is configured like in production (transport with
+retries and circuit breaker, label batcher, delivery cache), except that
+the configuration is made up instead of loaded from files.
+"""
+
+import concurrent.futures
+import contextlib
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import click
+import requests
+
+from . import engine, settings
+from .bench import percentile, sign
+from .fakegithub import FakeGitHub
+from .github import Transport, get_session
+from .scheduler import PollScheduler, RateLimitTracker
+from .state import CursorStore
+
+CASSETTES = os.path.join("tests", "fixtures", "cassettes")
+SECRET = "loadtest-secret"
+
+
+def configure(github, rules="rules.yml"):
+    """Point the labeler at the fake
+
+    Args:
+        github (:class:`FakeGitHub`): Running fake
+        rules (str): Rules file
+    Returns:
+        Session: Session with the transport configured by GITHUB_* env
+        variables
+    """
+    transport = Transport.from_env()
+    settings.API_URL = github.url
+    settings.config.update({
+        "rules": settings.load_rules(rules),
+        "scope": settings.get_scope(["all"]),
+        "fallback_label": "wontfix",
+        "transport": transport,
+        "breaker": transport.breaker,
+        "session": get_session("token", transport=transport),
+    })
+    engine.label_batcher.clear()
+    return settings.config["session"]
+
+
+def summarize(latencies, seconds):
+    """Throughput and latency percentiles
+
+    Args:
+        latencies (list): Seconds every operation took
+        seconds (float): Wall time of all operations
+    Returns:
+        dict: count, seconds, throughput (per second), p50, p99 and max
+    """
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "seconds": seconds,
+        "throughput": len(latencies) / seconds if seconds else 0.0,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "max": latencies[-1] if latencies else 0.0,
+    }
+
+
+def webhook_payloads(github):
+    """Endless signed webhook deliveries about the issues of the fake
+
+    Every delivery is unique, so none of them is skipped as a duplicate.
+
+    Args:
+        github (:class:`FakeGitHub`): Fake whose issues the webhooks are about
+    Yields:
+        tuple: (data, headers)
+    """
+    issues = [(repo, issue) for repo in sorted(github.issues) for issue in github.issues[repo]]
+    for i, (repo, issue) in enumerate(itertools.cycle(issues)):
+        payload = {
+            "action": "created" if i % 2 else "opened",
+            "issue": {"number": issue["number"], "labels": issue["labels"],
+                      "body": issue["body"]},
+            "repository": {"full_name": "{}/{}".format(*repo)},
+        }
+        if i % 2:
+            payload["comment"] = {"body": "robot:question #{}".format(i)}
+        else:
+            payload["issue"]["body"] = "{} #{}".format(issue["body"] or "", i)
+        data = json.dumps(payload).encode("utf-8")
+        yield data, {"Content-Type": "application/json", "X-Hub-Signature": sign(data, SECRET),
+                     "X-GitHub-Delivery": "load-{}".format(i)}
+
+
+def run_webhooks(github, count=1000, concurrency=8, rate=0, hook_workers=4, rules="rules.yml"):
+    """Send signed webhooks to the WSGI app served over HTTP
+
+    Args:
+        github (:class:`FakeGitHub`): Running fake
+        count (int): Number of webhooks
+        concurrency (int): Number of clients sending at the same time
+        rate (float): Webhooks per second, as fast as possible if 0
+        hook_workers (int): HOOK_WORKERS of the app, 0 labels before answering
+        rules (str): Rules file
+    Returns:
+        dict: Summary of the answers (see :py:func:`summarize`), statuses,
+        drain_seconds (until the background workers finished) and github
+        (the fake's statistics)
+    """
+    from werkzeug.serving import make_server
+    from . import web
+
+    configure(github, rules)
+    # one line per request would be the bottleneck
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    web.app.config.update({"webhook_token": SECRET, "hook_workers": hook_workers})
+    if hook_workers > 0:
+        web.hook_queue.workers = hook_workers
+    server = make_server("127.0.0.1", 0, web.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:{}/hook".format(server.server_port)
+
+    payloads = webhook_payloads(github)
+    lock = threading.Lock()
+    sent = itertools.count()
+    latencies, statuses = [], Counter()
+    local = threading.local()
+
+    def client():
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        while True:
+            with lock:
+                i = next(sent)
+                if i >= count:
+                    return
+                data, headers = next(payloads)
+            if rate > 0:
+                # open loop, a slow server doesn't slow the senders down
+                time.sleep(max(0, started + i / rate - time.time()))
+            start = time.perf_counter()
+            r = local.session.post(url, data=data, headers=headers)
+            latency = time.perf_counter() - start
+            with lock:
+                latencies.append(latency)
+                statuses[r.status_code] += 1
+
+    try:
+        started = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(client) for _ in range(concurrency)]:
+                future.result()
+        seconds = time.time() - started
+
+        if web.coalescer is not None:
+            web.coalescer.flush()
+        web.hook_queue.join()
+        engine.label_batcher.flush()
+        drain_seconds = time.time() - started - seconds
+    finally:
+        server.shutdown()
+
+    report = summarize(latencies, seconds)
+    report.update({
+        "mode": "webhooks",
+        "statuses": dict((str(status), number) for status, number in sorted(statuses.items())),
+        "drain_seconds": drain_seconds,
+        "github": github.stats(),
+    })
+    return report
+
+
+def run_console(github, cycles=3, workers=4, repo_workers=4, rescan=False, rules="rules.yml"):
+    """Poll all repositories of the fake with the console loop
+
+    Every cycle polls every repository once, see
+    :py:func:`engine.watch_repositories`.
+
+    Args:
+        github (:class:`FakeGitHub`): Running fake
+        cycles (int): Number of cycles
+        workers (int): Number of issues processed concurrently
+        repo_workers (int): Maximum of concurrently processed issues per repository
+        rescan (bool): Scan all issues every cycle, only updated ones otherwise
+        rules (str): Rules file
+    Returns:
+        dict: Summary of the cycle times (see :py:func:`summarize`), issues
+        (served by the fake) and github (the fake's statistics)
+    """
+    session = configure(github, rules)
+    tracker = RateLimitTracker()
+    tracker.install(session)
+    scheduler = PollScheduler(tracker, 0, 0, 0)
+    executor = None
+    if workers > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    repos = sorted(github.issues)
+    cursors = CursorStore()
+
+    started = time.time()
+    times = []
+    for cycle in range(cycles):
+        if rescan:
+            cursors = CursorStore()
+        start = time.perf_counter()
+        engine.watch_repositories(session, repos, cursors, scheduler, executor, repo_workers,
+                                  cycles=1)
+        times.append(time.perf_counter() - start)
+    seconds = time.time() - started
+    if executor is not None:
+        executor.shutdown()
+
+    report = summarize(times, seconds)
+    report.update({
+        "mode": "console",
+        "issues": sum(len(issues) for issues in github.issues.values()),
+        "github": github.stats(),
+    })
+    return report
+
+
+def format_report(report):
+    """Human readable lines of a report"""
+    unit = "webhooks" if report["mode"] == "webhooks" else "cycles"
+    lines = [
+        "{} {} in {:.2f}s, {:.1f}/s".format(report["count"], unit, report["seconds"],
+                                            report["throughput"]),
+        "latency p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms".format(
+            report["p50"] * 1000, report["p99"] * 1000, report["max"] * 1000),
+    ]
+    if report["mode"] == "webhooks":
+        lines.append("statuses {}, background work drained in {:.2f}s".format(
+            report["statuses"], report["drain_seconds"]))
+    else:
+        lines.append("{} issues watched".format(report["issues"]))
+    github = report["github"]
+    lines.append("GitHub got {} requests ({} not modified, {} injected errors, {} rate limited)"
+                 .format(github["requests"], github["not_modified"], github["errors"],
+                         github["rate_limited"]))
+    for endpoint, calls in sorted(github["calls"].items()):
+        lines.append("  {:<20} {}".format(endpoint, calls))
+    return lines
+
+
+@click.group()
+@click.option('--cassettes', default=CASSETTES, type=click.Path(exists=True, file_okay=False), help='Directory with betamax cassettes seeding the fake GitHub. Default tests/fixtures/cassettes')
+@click.option('--copies', default=1, help='Serve every recorded issue this many times. Default 1')
+@click.option('--keep-labels', is_flag=True, help='Serve the issues with their recorded labels.')
+@click.option('--latency', default=0.0, help='Seconds every answer of GitHub is delayed. Default 0')
+@click.option('--error-rate', default=0.0, help='Fraction of requests failing with 502. Default 0')
+@click.option('--rate-limit', default=None, type=int, help='Requests per minute GitHub accepts. Default unlimited')
+@click.option('--rules', default='rules.yml', help='Configuration of rules')
+@click.option('--json', 'as_json', is_flag=True, help='Print the report as JSON.')
+@click.pass_context
+def main(ctx, cassettes, copies, keep_labels, latency, error_rate, rate_limit, rules, as_json):
+    """Load test the labeler against a local fake of the GitHub API"""
+    ctx.obj = {
+        "github": FakeGitHub.from_cassettes(cassettes, copies, keep_labels, latency=latency,
+                                            error_rate=error_rate, rate_limit=rate_limit),
+        "rules": rules,
+        "json": as_json,
+    }
+
+
+def _report(ctx, run, **kwargs):
+    github = ctx.obj["github"]
+    # progress messages of the labeler would drown the report
+    with github, open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        report = run(github, rules=ctx.obj["rules"], **kwargs)
+    if ctx.obj["json"]:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        for line in format_report(report):
+            print(line)
+
+
+@main.command()
+@click.option('--count', default=1000, help='Number of webhooks. Default 1000')
+@click.option('--concurrency', default=8, help='Number of clients sending at the same time. Default 8')
+@click.option('--rate', default=0.0, help='Webhooks per second, 0 sends as fast as possible. Default 0')
+@click.option('--hook-workers', default=4, help='Background workers of the app, 0 labels before answering. Default 4')
+@click.pass_context
+def webhooks(ctx, count, concurrency, rate, hook_workers):
+    """Send signed webhooks to the web app"""
+    _report(ctx, run_webhooks, count=count, concurrency=concurrency, rate=rate,
+            hook_workers=hook_workers)
+
+
+@main.command()
+@click.option('--cycles', default=3, help='Number of polls of every repository. Default 3')
+@click.option('--workers', default=4, help='Number of issues processed concurrently. Default 4')
+@click.option('--repo-workers', default=4, help='Maximum of concurrently processed issues per repository. Default 4')
+@click.option('--rescan', is_flag=True, help='Scan all issues every cycle.')
+@click.pass_context
+def console(ctx, cycles, workers, repo_workers, rescan):
+    """Run the console loop"""
+    _report(ctx, run_console, cycles=cycles, workers=workers, repo_workers=repo_workers,
+            rescan=rescan)
+
+
+if __name__ == '__main__':
+    sys.exit(int(main() or 0))
@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Counters and latency histograms in the Prometheus text format
+
+Metrics are kept in memory of every process. Gunicorn workers don't
+share memory, so with the METRICS_DIR env variable every process writes
+a snapshot of its metrics into that directory every
+METRICS_FLUSH_INTERVAL seconds and ``/metrics`` adds up the snapshots of
+all processes, including the ones which already exited, so counters
+never go backwards. Snapshots of exited processes are folded into one
+aggregate file. Clear the directory when the server is (re)started.
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    # no locking, snapshots of exited processes are kept as they are
+    fcntl = None
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+
+class Counter(object):
+    """Monotonic counter, one value per combination of label values
+
+    Args:
+        name (str): Metric name, should end with ``_total``
+        documentation (str): Help text
+        labelnames (list): Names of the labels
+    """
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        """Increase the counter of the label values"""
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+    def snapshot(self):
+        """Values as a JSON serializable dict"""
+        with self.lock:
+            values = [[list(key), value] for key, value in self.values.items()]
+        return {"type": self.type, "help": self.documentation,
+                "labelnames": list(self.labelnames), "values": values}
+
+
+class Histogram(Counter):
+    """Distribution of observed values, e.g. latencies in seconds
+
+    Args:
+        name (str): Metric name, should end with the unit, e.g. ``_seconds``
+        documentation (str): Help text
+        labelnames (list): Names of the labels
+        buckets (tuple): Upper bounds of the buckets, ``+Inf`` is added
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """Record a value of the label values"""
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                # a count per bucket, +Inf included, and the sum of the values
+                entry = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    def snapshot(self):
+        snapshot = super(Histogram, self).snapshot()
+        snapshot["buckets"] = list(self.buckets)
+        return snapshot
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def merge(snapshots):
+    """Add up snapshots of several processes
+
+    Args:
+        snapshots (list): Snapshots of :py:meth:`Registry.snapshot`
+    Returns:
+        OrderedDict: Metrics by name like in a snapshot, with values keyed
+        by a tuple of label values
+    """
+    merged = OrderedDict()
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.get(name)
+            if target is None:
+                target = merged[name] = dict(metric, values={})
+            for key, value in metric["values"]:
+                key = tuple(key)
+                held = target["values"].get(key)
+                if held is None:
+                    target["values"][key] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    target["values"][key] = [a + b for a, b in zip(held, value)]
+                else:
+                    target["values"][key] = held + value
+    return merged
+
+
+def _snapshot(merged):
+    """Turn merged metrics back into a JSON serializable snapshot"""
+    return OrderedDict((name, dict(metric, values=[[list(key), value] for key, value
+                                                   in sorted(metric["values"].items())]))
+                       for name, metric in merged.items())
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # e.g. running as another user
+        return True
+    return True
+
+
+def render(merged):
+    """Prometheus text exposition of merged metrics
+
+    Args:
+        merged (dict): Metrics returned by :py:func:`merge`
+    Returns:
+        str: Metrics in the text format, version 0.0.4
+    """
+    lines = []
+    for name, metric in merged.items():
+        lines.append("# HELP {} {}".format(name, metric["help"]))
+        lines.append("# TYPE {} {}".format(name, metric["type"]))
+        names = metric["labelnames"]
+        for key, value in sorted(metric["values"].items()):
+            if metric["type"] != "histogram":
+                lines.append("{}{} {}".format(name, _labels(names, key), _number(value)))
+                continue
+            cumulative = 0
+            bounds = list(metric["buckets"]) + [float("inf")]
+            for bound, count in zip(bounds, value[:-1]):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    name, _labels(names, key, [("le", _number(bound))]), _number(cumulative)))
+            lines.append("{}_sum{} {}".format(name, _labels(names, key), _number(value[-1])))
+            lines.append("{}_count{} {}".format(name, _labels(names, key), _number(cumulative)))
+    return "\n".join(lines) + "\n"
+
+
+def summary(merged):
+    """Short human readable summary of merged metrics
+
+    Args:
+        merged (dict): Metrics returned by :py:func:`merge`
+    Returns:
+        list: One line per counter and histogram with any values
+    """
+    lines = []
+    for name, metric in merged.items():
+        names = metric["labelnames"]
+        for key, value in sorted(metric["values"].items()):
+            if metric["type"] != "histogram":
+                lines.append("{}{} {:g}".format(name, _labels(names, key), value))
+                continue
+            count = sum(value[:-1])
+            if not count:
+                continue
+            # the upper bound of the bucket the 99th percentile falls into
+            bounds = list(metric["buckets"]) + [float("inf")]
+            cumulative, p99 = 0, bounds[-1]
+            for bound, number in zip(bounds, value[:-1]):
+                cumulative += number
+                if cumulative >= 0.99 * count:
+                    p99 = bound
+                    break
+            lines.append("{}{} count {} avg {:.1f} ms p99 <= {} ms".format(
+                name, _labels(names, key), count, value[-1] / count * 1000,
+                "inf" if p99 == float("inf") else "{:g}".format(p99 * 1000)))
+    return lines
+
+
+class Registry(object):
+    """All metrics of the labeler
+
+    Metrics recorded before a fork are forgotten by the forked process
+    when :py:meth:`ensure_started` is called there, so nothing is counted
+    twice. With a directory, :py:meth:`ensure_started` also starts a thread
+    writing snapshots of this process into it.
+
+    Args:
+        directory (str): Directory shared by all processes, metrics are
+            not shared if None
+        interval (float): Seconds between snapshots written to the directory
+    """
+
+    def __init__(self, directory=None, interval=5):
+        self.directory = directory
+        self.interval = interval
+        self.metrics = OrderedDict()
+        self.collectors = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        # tells apart processes which got the same pid, one after the other
+        self.token = uuid.uuid4().hex[:12]
+        self.started_pid = None
+
+    def counter(self, name, documentation, labelnames=()):
+        """Create and register a :class:`Counter`"""
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Create and register a :class:`Histogram`"""
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collector):
+        """Call a function before every snapshot, e.g. to turn numbers
+        counted elsewhere into metrics"""
+        self.collectors.append(collector)
+
+    def reset(self):
+        """Forget all recorded values"""
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def ensure_started(self):
+        """Forget values inherited from the parent process and start
+        writing snapshots, unless already done in this process"""
+        if self.started_pid == os.getpid():
+            return
+        with self.lock:
+            if self.started_pid == os.getpid():
+                return
+            self.started_pid = os.getpid()
+            if self.pid != self.started_pid:
+                # the values belong to the parent, which reports them itself
+                self.pid = self.started_pid
+                self.token = uuid.uuid4().hex[:12]
+                self.reset()
+            if self.directory:
+                thread = threading.Thread(target=self._write_periodically,
+                                          name="labeler-metrics-writer")
+                thread.daemon = True
+                thread.start()
+
+    def snapshot(self):
+        """Values of all metrics of this process
+
+        Returns:
+            dict: JSON serializable metrics by name
+        """
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                print(e)
+        return OrderedDict((name, metric.snapshot()) for name, metric in self.metrics.items())
+
+    def _filename(self):
+        if self.pid != os.getpid():
+            # forked without ensure_started, don't share the parent's file
+            self.pid = os.getpid()
+            self.token = uuid.uuid4().hex[:12]
+        return os.path.join(self.directory, "metrics-{}-{}.json".format(self.pid, self.token))
+
+    def write(self):
+        """Write a snapshot of this process into the directory"""
+        filename = self._filename()
+        temporary = filename + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temporary, filename)
+
+    def _write_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except Exception as e:
+                print(e)
+
+    def _snapshots(self):
+        """Snapshot files in the directory, by the pid which wrote them,
+        None for the aggregate"""
+        files = {}
+        for name in sorted(os.listdir(self.directory)):
+            if not (name.startswith("metrics-") and name.endswith(".json")):
+                continue
+            pid = name[len("metrics-"):-len(".json")].split("-")[0]
+            if pid == "aggregate":
+                files[os.path.join(self.directory, name)] = None
+            elif pid.isdigit():
+                files[os.path.join(self.directory, name)] = int(pid)
+        return files
+
+    @staticmethod
+    def _read(filename):
+        try:
+            with open(filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            # written right now by another process, or broken
+            return None
+
+    def _fold(self, files):
+        """Add the snapshots of exited processes to the aggregate file and
+        remove them, the caller holds the exclusive lock"""
+        exited = [filename for filename, pid in files.items()
+                  if pid is not None and pid != os.getpid() and not _is_running(pid)]
+        if not exited:
+            return
+        aggregate = os.path.join(self.directory, "metrics-aggregate.json")
+        snapshots = [self._read(filename) for filename in [aggregate] + exited]
+        temporary = aggregate + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(_snapshot(merge([snapshot for snapshot in snapshots if snapshot])), f)
+        os.replace(temporary, aggregate)
+        for filename in exited:
+            os.remove(filename)
+
+    def collect(self):
+        """Metrics of all processes sharing the directory added up
+
+        Returns:
+            OrderedDict: Metrics, see :py:func:`merge`
+        """
+        if not self.directory:
+            return merge([self.snapshot()])
+        os.makedirs(self.directory, exist_ok=True)
+        self.write()
+        if fcntl is None:
+            snapshots = [self._read(filename) for filename in self._snapshots()]
+            return merge([snapshot for snapshot in snapshots if snapshot])
+
+        # folding must not be seen halfway by another process reading the files
+        with open(os.path.join(self.directory, "metrics.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._fold(self._snapshots())
+                snapshots = [self._read(filename) for filename in self._snapshots()]
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return merge([snapshot for snapshot in snapshots if snapshot])
+
+    def render(self):
+        """Metrics of all processes in the Prometheus text format"""
+        return render(self.collect())
+
+    def summary(self):
+        """Metrics of all processes summarized line by line"""
+        return summary(self.collect())
+
+
+class Reporter(object):
+    """Prints a summary of the metrics periodically
+
+    Args:
+        registry (:class:`Registry`): Metrics to summarize
+        interval (float): Seconds between summaries
+        write (callable): Function called with every line
+    """
+
+    def __init__(self, registry, interval=60, write=print):
+        self.registry = registry
+        self.interval = interval
+        self.write = write
+        self.stopped = threading.Event()
+
+    def start(self):
+        """Start printing in a background thread"""
+        thread = threading.Thread(target=self._report, name="labeler-metrics-reporter")
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def report(self):
+        """Print the summary now"""
+        for line in self.registry.summary():
+            self.write(line)
+
+    def _report(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+
+registry = Registry(os.getenv("METRICS_DIR") or None, float(os.getenv("METRICS_FLUSH_INTERVAL", 5)))
+
+hook_seconds = registry.histogram(
+    "labeler_hook_duration_seconds", "Time spent answering webhooks", ["status"])
+signature_seconds = registry.histogram(
+    "labeler_signature_validation_seconds", "Time spent validating webhook signatures", ["valid"])
+rules_seconds = registry.histogram(
+    "labeler_rule_evaluation_seconds", "Time spent evaluating the rules for one issue")
+rule_seconds = registry.counter(
+    "labeler_rule_seconds_total", "Time spent in the regex of a standalone rule",
+    ["label", "pattern"])
+rule_evaluations = registry.counter(
+    "labeler_rule_evaluations_total", "Searches with the regex of a standalone rule",
+    ["label", "pattern"])
+rule_matches = registry.counter(
+    "labeler_rule_matches_total", "Texts matched by a rule", ["label", "pattern"])
+github_seconds = registry.histogram(
+    "labeler_github_request_duration_seconds", "Requests to GitHub, retries included",
+    ["method", "endpoint", "status"])
+github_retries = registry.counter(
+    "labeler_github_retries_total", "Requests to GitHub retried", ["method", "endpoint", "status"])
+labels = registry.counter(
+    "labeler_labels_total", "Labels applied, skipped (already on the issue or pending), "
+    "failed to be sent and dropped after all retries", ["outcome"])
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Sampling profiler of the labelling rules
+
+A :class:`RuleSet` evaluates as few rules as possible (see
+:py:meth:`RuleSet.decide`), which hides what a single rule costs. For a
+sampled fraction of the texts the profiler evaluates every rule on its own
+and accumulates the time and hits per rule, so a badly written pattern
+shows up even when its prefilter or the rules before it usually spare it.
+The overhead is one random number per text plus the sampled fraction of
+a full evaluation, e.g. 1 % with a rate of 0.01.
+"""
+
+import random
+import statistics
+import threading
+import time
+
+MIN_SAMPLES = 10
+
+
+class RuleProfiler(object):
+    """Samples time and hit rate of every rule over live traffic
+
+    A rule is flagged as slow if it was sampled at least ``MIN_SAMPLES``
+    times and takes on average both ``min_cost`` seconds and ``factor``
+    times as long as the median rule. Newly flagged rules are printed
+    every ``check_every`` samples.
+
+    Args:
+        rate (float): Fraction of the texts profiled, all of them if 1
+        factor (float): How many times slower than the median rule a slow
+            rule is
+        min_cost (float): Average seconds below which no rule is slow
+        check_every (int): Samples between checks for slow rules, 0 never
+            checks
+        seed (int): Seed of the sampling, random if None
+    """
+
+    def __init__(self, rate=0.01, factor=10, min_cost=0.00001, check_every=100, seed=None):
+        self.rate = rate
+        self.factor = factor
+        self.min_cost = min_cost
+        self.check_every = check_every
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.rules = {}
+        self.samples = 0
+        self.characters = 0
+        self.seconds = 0.0
+        self.flagged = set()
+
+    def sample(self):
+        """Decide whether to profile the next text"""
+        return self.rate >= 1 or self.random.random() < self.rate
+
+    def profile(self, rules, text):
+        """Evaluate every rule on its own against the text
+
+        Args:
+            rules (RuleSet): Rules to profile
+            text (str): String to search in
+        """
+        timings = []
+        for index, rule in enumerate(rules):
+            start = time.perf_counter()
+            found = rules.search(index, text)
+            timings.append((rule, rules.kinds[index], time.perf_counter() - start, found))
+
+        with self.lock:
+            self.samples += 1
+            self.characters += len(text)
+            for rule, kind, seconds, found in timings:
+                key = (rule["label"], rule["pattern"])
+                entry = self.rules.get(key)
+                if entry is None:
+                    entry = self.rules[key] = {"label": rule["label"], "pattern": rule["pattern"],
+                                               "samples": 0, "hits": 0, "seconds": 0.0,
+                                               "max": 0.0}
+                entry["kind"] = kind
+                entry["samples"] += 1
+                entry["hits"] += found
+                entry["seconds"] += seconds
+                entry["max"] = max(entry["max"], seconds)
+                self.seconds += seconds
+            check = self.check_every > 0 and self.samples % self.check_every == 0
+        if check:
+            self.check(rules)
+
+    def check(self, rules=None):
+        """Print the rules which became slow since the last check
+
+        Args:
+            rules (RuleSet): Only rules of this set are considered, all
+                rules ever profiled if None
+        Returns:
+            list: Report entries of the newly flagged rules
+        """
+        flagged = [entry for entry in self.report(rules) if entry["slow"]]
+        with self.lock:
+            new = [entry for entry in flagged
+                   if (entry["label"], entry["pattern"]) not in self.flagged]
+            self.flagged.update((entry["label"], entry["pattern"]) for entry in new)
+        for entry in new:
+            print("Slow rule {} {!r}: {:.1f} us per text, {:.0f}x the median rule, "
+                  "{:.0%} of the profiled time".format(entry["label"], entry["pattern"],
+                                                       entry["mean"] * 1e6, entry["ratio"],
+                                                       entry["share"]))
+        return new
+
+    def report(self, rules=None):
+        """Rules ranked by the time spent in them
+
+        Args:
+            rules (RuleSet): Only rules of this set are reported, all rules
+                ever profiled if None
+        Returns:
+            list: Dicts with label, pattern, kind (how the rule set
+            evaluates it), samples, hits, hit_rate, seconds (in total),
+            mean and max (seconds per text), share (of the time of all
+            reported rules), ratio (mean to the median rule) and slow
+        """
+        with self.lock:
+            entries = [dict(entry) for entry in self.rules.values()]
+        if rules is not None:
+            keys = set((rule["label"], rule["pattern"]) for rule in rules)
+            entries = [entry for entry in entries if (entry["label"], entry["pattern"]) in keys]
+        if not entries:
+            return []
+
+        for entry in entries:
+            entry["mean"] = entry["seconds"] / entry["samples"]
+            entry["hit_rate"] = entry["hits"] / entry["samples"]
+        median = statistics.median(entry["mean"] for entry in entries)
+        total = sum(entry["seconds"] for entry in entries)
+        for entry in entries:
+            entry["share"] = entry["seconds"] / total if total else 0.0
+            entry["ratio"] = entry["mean"] / median if median else 0.0
+            entry["slow"] = (entry["samples"] >= MIN_SAMPLES and entry["mean"] >= self.min_cost and
+                             entry["mean"] >= self.factor * median)
+        return sorted(entries, key=lambda entry: entry["seconds"], reverse=True)
+
+    def clear(self):
+        """Forget all samples"""
+        with self.lock:
+            self.rules.clear()
+            self.flagged.clear()
+            self.samples = 0
+            self.characters = 0
+            self.seconds = 0.0
+
+    def stats(self):
+        """Sampling rate and volume
+
+        Returns:
+            dict: rate, samples (profiled texts), characters (of the
+            profiled texts) and seconds (spent evaluating rules on their own)
+        """
+        with self.lock:
+            return {
+                "rate": self.rate,
+                "samples": self.samples,
+                "characters": self.characters,
+                "seconds": self.seconds,
+            }
+
+
+def format_report(report):
+    """Human readable lines of :py:meth:`RuleProfiler.report`"""
+    lines = ["{:>5} {:>6} {:>10} {:>10} {:>7} {:>8}  {}".format(
+        "rank", "share", "mean us", "max us", "hits", "samples", "rule")]
+    for rank, entry in enumerate(report, 1):
+        lines.append("{:>5} {:>6.1%} {:>10.1f} {:>10.1f} {:>7.1%} {:>8}  {} {!r} ({}){}".format(
+            rank, entry["share"], entry["mean"] * 1e6, entry["max"] * 1e6, entry["hit_rate"],
+            entry["samples"], entry["label"], entry["pattern"], entry["kind"],
+            "  SLOW" if entry["slow"] else ""))
+    return lines
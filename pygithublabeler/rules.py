@@ -0,0 +1,633 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# characters with a special meaning outside of a character class
+METACHARACTERS = set(".^$*+?{}[]\\|()")
+# flags which change what a literal substring matches
+LITERAL_UNSAFE_FLAGS = re.IGNORECASE | re.VERBOSE | re.LOCALE
+
+# standalone rules are reordered by their statistics every this many evaluations
+REORDER_EVERY = 256
+
+_WILDCARD_PREFIX = re.compile(r"\.\*\??(?![*+?{])")
+_REPEAT = re.compile(r"\{\d*,?\d*\}")
+# what follows a backslash, three octal digits are a character, fewer digits a group reference
+_ESCAPE = re.compile(r"x[0-9a-fA-F]{0,2}|u[0-9a-fA-F]{0,4}|U[0-9a-fA-F]{0,8}|N\{[^}]*\}?|"
+                     r"0[0-7]{0,2}|[1-7][0-7]{2}|\d{1,2}|.", re.DOTALL)
+
+
+def strip_wildcards(pattern):
+    """Remove leading and trailing ``.*`` wrappers from a pattern
+
+    Patterns are always evaluated with ``re.search``, so a leading or
+    trailing ``.*`` (or ``.*?``) may match the empty string and never
+    changes whether the pattern matches. It only makes the engine
+    backtrack over the whole text.
+
+    Args:
+        pattern (str): Regular expression
+    Returns:
+        str: Equivalent pattern without the wrappers
+    """
+    while True:
+        prefix = _WILDCARD_PREFIX.match(pattern)
+        if prefix:
+            pattern = pattern[prefix.end():]
+            continue
+
+        for suffix in (".*", ".*?"):
+            if pattern.endswith(suffix):
+                start = len(pattern) - len(suffix)
+                # the dot must not be escaped by an odd number of backslashes
+                backslashes = len(pattern[:start]) - len(pattern[:start].rstrip("\\"))
+                if backslashes % 2 == 0:
+                    pattern = pattern[:start]
+                    break
+        else:
+            return pattern
+
+
+def _skip_class(pattern, i):
+    """Return index just after the character class starting at ``pattern[i]``"""
+    i += 1
+    if pattern[i:i + 1] == "^":
+        i += 1
+    if pattern[i:i + 1] == "]":
+        i += 1
+    while i < len(pattern) and pattern[i] != "]":
+        i += 2 if pattern[i] == "\\" else 1
+    return i + 1
+
+
+def _skip_escape(pattern, i):
+    """Return index just after the escape sequence starting at ``pattern[i]``
+
+    The payload of numeric escapes (e.g. ``\\x41``, ``\\012`` or
+    ``\\N{...}``) belongs to the escape and is not literal text.
+    """
+    escape = _ESCAPE.match(pattern, i + 1)
+    return escape.end() if escape else i + 1
+
+
+def extract_literal(pattern, flags=0):
+    """Find a literal substring every match of the pattern must contain
+
+    Only top-level literals of a pattern without top-level alternation are
+    considered, which keeps the analysis simple and always safe. A pattern
+    that consists only of a literal is reported as exact and can be
+    evaluated with a plain substring scan.
+
+    Args:
+        pattern (str): Regular expression
+        flags (int): Flags of the compiled pattern
+    Returns:
+        tuple: (literal, exact)
+
+            literal (str): Longest required literal or None if there is none
+            exact (bool): True if the pattern matches exactly the literal
+    """
+    if flags & LITERAL_UNSAFE_FLAGS or "(?#" in pattern:
+        return None, False
+
+    runs, run = [], []
+    exact = True
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        literal = None
+        if char == "\\":
+            escaped = pattern[i + 1:i + 2]
+            if escaped and not escaped.isalnum():
+                literal = escaped
+            # any other escape ends the literal run, with its payload
+            i = _skip_escape(pattern, i)
+        elif char == "[":
+            i = _skip_class(pattern, i)
+        elif char == "|" and depth == 0:
+            return None, False
+        elif char in "*?" or _REPEAT.match(pattern, i):
+            # the preceding character may be optional
+            if run:
+                run.pop()
+            i = _REPEAT.match(pattern, i).end() if char == "{" else i + 1
+        else:
+            if char == "(":
+                depth += 1
+            elif char == ")":
+                depth -= 1
+            elif char not in METACHARACTERS:
+                literal = char
+            i += 1
+
+        if literal is not None and depth == 0:
+            run.append(literal)
+            continue
+        exact = False
+        if run:
+            runs.append("".join(run))
+            run = []
+    if run:
+        runs.append("".join(run))
+
+    if exact:
+        return "".join(runs), True
+    if not runs:
+        return None, False
+    return max(runs, key=len), False
+
+
+class EvaluationAborted(Exception):
+    """Not every rule was evaluated within the time budget of the rule guard
+
+    Whether a rule matches is then unknown, so neither "no rule matched"
+    nor the labels are the whole answer.
+
+    Args:
+        labels (set): Labels of the rules which did match
+    """
+
+    def __init__(self, labels):
+        super(EvaluationAborted, self).__init__(
+            "Rules not evaluated within the budget, labels found so far: {}".format(
+                sorted(labels)))
+        self.labels = labels
+
+
+class RuleSet(object):
+    """Compiled and optimized set of labelling rules
+
+    Every pattern goes through a compilation stage when the set is built:
+
+    * redundant ``.*`` wrappers are stripped (see :py:func:`strip_wildcards`),
+    * rules which are plain literals are evaluated with a substring scan
+      and never reach the regex engine,
+    * required literals are extracted from the other rules
+      (see :py:func:`extract_literal`) and used as a cheap prefilter,
+    * the other patterns are kept as compiled objects and evaluated one by
+      one behind their prefilter, so every search keeps the fast literal
+      prefix scan of ``re`` (merging them into one big expression loses it
+      and was many times slower on every benchmark).
+
+    The set behaves like a read-only list of the original rule dicts, so
+    it can be used anywhere a list of rules was used before.
+
+    :py:meth:`decide` evaluates only the rules which can still change the
+    outcome for an issue and stops as soon as it is fixed. Standalone rules
+    are tried in the order of their expected cost of finding a match,
+    learned from their hit rate and the time spent in them.
+
+    Results can be memoized by attaching a :class:`MatchMemo` to ``memo``
+    and the cost of every rule sampled by attaching a
+    :class:`profiling.RuleProfiler` to ``profiler``. With a
+    :class:`guard.RuleGuard` attached to ``guard`` the regexes are
+    evaluated in killable processes with a time budget instead.
+
+    Args:
+        rules (list): List of rules, each a dict with ``pattern`` and ``label``
+        memo (:class:`MatchMemo`): Memo of evaluation results
+        profiler (:class:`profiling.RuleProfiler`): Profiler of the rules
+        guard (:class:`guard.RuleGuard`): Time-bounded evaluation of the rules
+    """
+
+    def __init__(self, rules, memo=None, profiler=None, guard=None):
+        self.rules = [dict(rule) for rule in (rules or [])]
+        self.memo = memo
+        self.profiler = profiler
+        self.guard = guard
+        self.fingerprint = hashlib.sha1(json.dumps(
+            [[rule["pattern"], rule["label"]] for rule in self.rules]).encode("utf-8")).hexdigest()
+        self.optimized = [strip_wildcards(rule["pattern"]) for rule in self.rules]
+        self.compiled = [re.compile(pattern) for pattern in self.optimized]
+        self.prefilters = []
+
+        self.literal, self.standalone = [], []
+        self.kinds = []
+        for index, compiled in enumerate(self.compiled):
+            literal, exact = extract_literal(compiled.pattern, compiled.flags)
+            self.prefilters.append(literal)
+            if exact:
+                self.literal.append(index)
+                self.kinds.append("literal")
+            else:
+                self.standalone.append(index)
+                self.kinds.append("standalone")
+
+        self.labels = frozenset(rule["label"] for rule in self.rules)
+        # counted without a lock, they only steer the order of evaluation
+        self.evaluated = 0
+        self.evaluations = [0] * len(self.rules)
+        self.hits = [0] * len(self.rules)
+        self.cost = [0.0] * len(self.rules)
+        self.order = list(self.standalone)
+        # (evaluations, hits, cost) of every rule taken by take_stats, which
+        # is called by the metrics thread and by requests of /metrics
+        self.taken = [(0, 0, 0.0)] * len(self.rules)
+        self.stats_lock = threading.Lock()
+
+    def _reorder(self):
+        """Sort standalone rules by the expected time spent until one matches"""
+        def expected_cost(index):
+            evaluations = self.evaluations[index]
+            average = self.cost[index] / evaluations if evaluations else 0.0
+            # smoothed, a rule is not written off after a few misses
+            return average * (evaluations + 2) / (self.hits[index] + 1)
+        self.order = sorted(self.standalone, key=expected_cost)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __getitem__(self, index):
+        return self.rules[index]
+
+    def search(self, index, text):
+        """Check whether one rule matches the text, on its own
+
+        Args:
+            index (int): Index of the rule
+            text (str): String to search in
+        Returns:
+            bool: True if the rule matches
+        """
+        literal = self.prefilters[index]
+        if literal is not None and literal not in text:
+            return False
+        if self.kinds[index] == "literal":
+            return True
+        return self.compiled[index].search(text) is not None
+
+    def match(self, text):
+        """Find labels of all rules matching the text
+
+        Args:
+            text (str): String to search in
+        Returns:
+            set: Labels of the matching rules
+        Raises:
+            EvaluationAborted: If the guard didn't evaluate every rule
+        """
+        if self.memo is not None:
+            return self.memo.match(self, text)
+        budget = self.guard.budget() if self.guard is not None else None
+        labels = self.evaluate(text, budget=budget)
+        if budget is not None and budget.aborted:
+            raise EvaluationAborted(labels)
+        return labels
+
+    def evaluate(self, text, skip=None, first=False, budget=None):
+        """Find labels of all rules matching the text, bypassing the memo
+
+        Args:
+            text (str): String to search in
+            skip (set): Labels whose rules aren't evaluated
+            first (bool): Stop at the first matching rule
+            budget (:class:`guard.Budget`): Time left for the request if
+                the rules are guarded
+        Returns:
+            set: Labels of the matching rules, only the first one if
+            ``first`` is True
+        """
+        if self.guard is not None:
+            return self.guard.evaluate(self, text, skip, first, budget)
+        labels = set()
+        for index in self.literal:
+            label = self.rules[index]["label"]
+            if skip and label in skip:
+                continue
+            if self.prefilters[index] in text:
+                self.hits[index] += 1
+                labels.add(label)
+                if first:
+                    return labels
+
+        self.evaluated += 1
+        if self.evaluated % REORDER_EVERY == 0:
+            self._reorder()
+        for index in self.order:
+            label = self.rules[index]["label"]
+            if label in labels or skip and label in skip:
+                continue
+            literal = self.prefilters[index]
+            if literal is not None and literal not in text:
+                continue
+            start = time.perf_counter()
+            found = self.compiled[index].search(text) is not None
+            self.cost[index] += time.perf_counter() - start
+            self.evaluations[index] += 1
+            if found:
+                self.hits[index] += 1
+                labels.add(label)
+                if first:
+                    return labels
+        return labels
+
+    def decide(self, text_list, current_labels, matched=None):
+        """Find whether any rule matches the texts and which labels are missing
+
+        Gives the same answer as matching every rule against every text,
+        but rules of labels the issue already has, or which already
+        matched, are evaluated only as long as no rule matched at all, and
+        the remaining texts are skipped once nothing can change. With a
+        memo all rules are evaluated, so the result can be remembered for
+        any issue the text turns up in.
+
+        Args:
+            text_list (list): Strings to search in
+            current_labels (list): Labels the issue already has
+            matched (set): Labels of rules which matched texts searched before
+        Returns:
+            tuple: (match, labels)
+
+                match (bool): True if any rule matches
+                labels (set): Labels of the matching rules the issue doesn't have
+        Raises:
+            EvaluationAborted: If the guard didn't evaluate every rule, with
+                the missing labels of the rules which matched
+        """
+        current = set(current_labels)
+        # the guard's time budget is shared by all texts of the issue
+        budget = self.guard.budget() if self.guard is not None else None
+        found = set(matched or ())
+        match = len(found) > 0
+        # labels whose rules can still change the result
+        wanted = self.labels - current - found
+        for text in text_list:
+            if match and not wanted:
+                break
+
+            labels = self.memo.lookup(self, text) if self.memo is not None else None
+            if labels is None:
+                # rules profiled on their own couldn't be interrupted
+                if self.profiler is not None and self.guard is None and self.profiler.sample():
+                    self.profiler.profile(self, text)
+                # the memo needs every rule, skipping them pays off without it
+                skip = self.labels - wanted if self.memo is None else set()
+                labels = self.evaluate(text, skip=skip, budget=budget)
+                if not skip:
+                    # results missing aborted rules aren't remembered
+                    if self.memo is not None and not (budget is not None and budget.aborted):
+                        self.memo.store(self, text, labels)
+                elif not labels and not match:
+                    # only whether any rule matches at all is still open
+                    labels = self.evaluate(text, skip=wanted, first=True, budget=budget)
+
+            found.update(labels)
+            match = match or len(labels) > 0
+            wanted = wanted - labels
+        if budget is not None and budget.aborted:
+            raise EvaluationAborted(found - current)
+        return match, found - current
+
+    def take_stats(self):
+        """Statistics of the rules gathered since the last call
+
+        Hits are counted for every rule, evaluations and time only for
+        standalone rules, literals cost next to nothing.
+
+        Returns:
+            list: (rule, evaluations, hits, seconds) of the rules which
+            were evaluated or matched since the last call
+        """
+        changes = []
+        with self.stats_lock:
+            for index, rule in enumerate(self.rules):
+                current = (self.evaluations[index], self.hits[index], self.cost[index])
+                taken, self.taken[index] = self.taken[index], current
+                if current != taken:
+                    changes.append((rule, current[0] - taken[0], current[1] - taken[1],
+                                    current[2] - taken[2]))
+        return changes
+
+    def report(self):
+        """Describe how every rule was optimized
+
+        Returns:
+            list: One line per rule
+        """
+        lines = []
+        for index, rule in enumerate(self.rules):
+            pattern, optimized = rule["pattern"], self.optimized[index]
+            literal = self.prefilters[index]
+            if index in self.literal:
+                how = "optimized: substring scan for {!r}".format(literal)
+            elif literal is not None:
+                how = "optimized: prefilter {!r}, regex {!r}".format(literal, optimized)
+            elif pattern != optimized:
+                how = "partially optimized: no required literal, regex {!r}".format(optimized)
+            else:
+                how = "not optimized: no required literal, regex"
+            lines.append("{} {!r}: {}".format(rule["label"], pattern, how))
+        return lines
+
+
+class MatchMemo(object):
+    """LRU memo of rule evaluation results
+
+    Results are keyed by a hash of the text and the fingerprint of the rule
+    set, so entries computed with other rules (e.g. before a reload) are
+    never used. The memo can be shared by several threads and rule sets.
+
+    Args:
+        max_entries (int): How many results to remember
+        ttl (float): Seconds after which a result expires, never if 0
+    """
+
+    def __init__(self, max_entries=4096, ttl=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def match(self, rules, text):
+        """Find labels of all rules matching the text, memoized
+
+        Args:
+            rules (RuleSet): Compiled rules
+            text (str): String to search in
+        Returns:
+            set: Labels of the matching rules
+        Raises:
+            EvaluationAborted: If the guard didn't evaluate every rule, the
+                result isn't remembered
+        """
+        labels = self.lookup(rules, text)
+        if labels is None:
+            budget = rules.guard.budget() if rules.guard is not None else None
+            labels = rules.evaluate(text, budget=budget)
+            if budget is not None and budget.aborted:
+                raise EvaluationAborted(labels)
+            self.store(rules, text, labels)
+        return set(labels)
+
+    @staticmethod
+    def _key(rules, text):
+        return (rules.fingerprint, hashlib.sha1(text.encode("utf-8")).digest())
+
+    def lookup(self, rules, text):
+        """Find a remembered result
+
+        Args:
+            rules (RuleSet): Compiled rules
+            text (str): String searched in
+        Returns:
+            set: Labels of the matching rules or None if not remembered
+        """
+        key = self._key(rules, text)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (not self.ttl or entry[0] > time.time()):
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return set(entry[1])
+            self.misses += 1
+            return None
+
+    def store(self, rules, text, labels):
+        """Remember the labels of all rules matching the text
+
+        Args:
+            rules (RuleSet): Compiled rules
+            text (str): String searched in
+            labels (set): Labels of all matching rules
+        """
+        key = self._key(rules, text)
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, frozenset(labels))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        """Hit and miss counts
+
+        Returns:
+            dict: size, max_entries, hits and misses
+        """
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class RulesWatcher(object):
+    """Reloads rules in the background whenever their file changes
+
+    A background thread polls the modification time, size and inode of
+    the file. When they change, the rules are loaded and compiled in that
+    thread and only the finished :class:`RuleSet` is handed over to
+    ``on_change``, so nobody evaluating the rules ever waits for the
+    compilation or sees a partially loaded rule set. If the new file can't
+    be loaded, the current rules stay in use.
+
+    The thread is started lazily by :py:meth:`ensure_started` in every
+    process, so the watcher keeps working in forked gunicorn workers.
+
+    Args:
+        filename (str): Path to the rules file
+        load (callable): Function loading a :class:`RuleSet` from the file
+        on_change (callable): Function called with every newly loaded
+            :class:`RuleSet`
+        rules (RuleSet): Rules currently loaded from the file
+        interval (float): Seconds between checks of the file
+    """
+
+    def __init__(self, filename, load, on_change, rules, interval=5):
+        self.filename = filename
+        self.load = load
+        self.on_change = on_change
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pid = None
+        self.stopped = threading.Event()
+        self.signature = self._signature()
+        self.fingerprint = rules.fingerprint
+        self.version = 1
+        self.loaded_at = time.time()
+        self.error = None
+
+    def _signature(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def ensure_started(self):
+        """Start the polling thread unless it runs in this process"""
+        with self.lock:
+            if self.pid == os.getpid() or self.stopped.is_set():
+                return
+            # threads don't survive fork, start the thread in every process
+            self.pid = os.getpid()
+            thread = threading.Thread(target=self._watch, name="labeler-rules-watcher")
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stop polling the file"""
+        self.stopped.set()
+
+    def _watch(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def check(self):
+        """Reload the rules if the file changed
+
+        Returns:
+            bool: True if new rules were loaded
+        """
+        signature = self._signature()
+        if signature is None or signature == self.signature:
+            return False
+        try:
+            rules = self.load(self.filename)
+        except Exception as e:
+            print("Unable to reload rules from '{}': {}".format(self.filename, e))
+            with self.lock:
+                self.signature = signature
+                self.error = str(e)
+            return False
+
+        with self.lock:
+            self.signature = signature
+            self.error = None
+            if rules.fingerprint == self.fingerprint:
+                return False
+            self.fingerprint = rules.fingerprint
+            self.version += 1
+            self.loaded_at = time.time()
+        self.on_change(rules)
+        return True
+
+    def stats(self):
+        """Version of the rules in use
+
+        Returns:
+            dict: filename, version (number of loads in this process),
+            fingerprint, loaded_at and error of the last failed reload
+        """
+        with self.lock:
+            return {
+                "filename": self.filename,
+                "version": self.version,
+                "fingerprint": self.fingerprint,
+                "loaded_at": self.loaded_at,
+                "error": self.error,
+            }
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import datetime
+import email.utils
+import re
+import threading
+import time
+
+_REPO_PATH = re.compile(r"/repos/([^/]+)/([^/?]+)")
+
+
+def parse_retry_after(value, now=None):
+    """Seconds to wait according to a ``Retry-After`` header
+
+    Args:
+        value (str): Header value, delay in seconds or an HTTP date
+        now (float): Current time, time.time() if None
+    Returns:
+        float: Seconds to wait, at least 0, None if missing or unparseable
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date is None:
+        return None
+    if date.tzinfo is None:
+        # "-0000" means UTC without saying so
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, date.timestamp() - (time.time() if now is None else now))
+
+
+class RateLimitTracker(object):
+    """Follows GitHub's rate limit through the headers of every response
+
+    Reads ``X-RateLimit-Remaining``/``X-RateLimit-Reset`` and notices when
+    GitHub refuses requests (primary limit exhausted, secondary limit or
+    abuse detection ``403``/``429``, with or without ``Retry-After``). It
+    also counts requests which cost quota (everything but ``304``) per
+    repository.
+
+    Install it on a requests session with :py:meth:`install`, or feed it
+    from any other client with :py:meth:`update`.
+
+    Args:
+        backoff (float): Initial pause after a refusal without any hint how
+            long to wait, doubled on every further refusal
+        max_backoff (float): Maximum of the pause
+    """
+
+    def __init__(self, backoff=60, max_backoff=900):
+        self.initial_backoff = backoff
+        self.max_backoff = max_backoff
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.blocked_until = 0
+        self.costs = {}
+
+    def install(self, session):
+        """Observe every response received by the requests session"""
+        session.hooks["response"].append(self.observe)
+        return session
+
+    def observe(self, response, *args, **kwargs):
+        """Response hook for requests"""
+        body = response.text if response.status_code in (403, 429) else ""
+        self.update(response.status_code, response.headers, response.url, body)
+
+    def update(self, status, headers, url=None, body=""):
+        """Update the state from a response
+
+        Args:
+            status (int): Status code
+            headers (dict): Response headers
+            url (str): URL of the request, used to account the cost to a
+                repository
+            body (str): Body of a refused request, GitHub explains secondary
+                rate limits only there
+        """
+        now = time.time()
+        with self.lock:
+            if headers.get("X-RateLimit-Remaining") is not None:
+                self.remaining = int(headers["X-RateLimit-Remaining"])
+            if headers.get("X-RateLimit-Reset") is not None:
+                self.reset = int(headers["X-RateLimit-Reset"])
+            if headers.get("X-RateLimit-Limit") is not None:
+                self.limit = int(headers["X-RateLimit-Limit"])
+
+            if status in (403, 429):
+                retry_after = parse_retry_after(headers.get("Retry-After"), now)
+                if retry_after is not None:
+                    self.blocked_until = now + retry_after
+                elif self.remaining == 0 and self.reset:
+                    self.blocked_until = self.reset
+                elif status == 429 or "rate limit" in body.lower():
+                    self.blocked_until = now + self.backoff
+                    self.backoff = min(self.backoff * 2, self.max_backoff)
+            elif status < 400:
+                self.backoff = self.initial_backoff
+
+            repo = _REPO_PATH.search(url or "")
+            if repo is not None and status != 304:
+                key = repo.groups()
+                self.costs[key] = self.costs.get(key, 0) + 1
+
+    def take_cost(self, repo):
+        """Number of quota consuming requests for the repository since the
+        last call
+
+        Args:
+            repo (tuple): (repository_owner, repository_name)
+        Returns:
+            int: Number of requests
+        """
+        with self.lock:
+            return self.costs.pop(tuple(repo), 0)
+
+    def blocked_for(self):
+        """Seconds until GitHub accepts requests again, 0 if not blocked"""
+        return max(0, self.blocked_until - time.time())
+
+
+class PollScheduler(object):
+    """Decides how long to wait before polling a repository again
+
+    The interval of every repository adapts to its activity: it is halved
+    after a poll which found updated issues (down to ``min_interval``) and
+    doubled after an idle one (up to ``max_interval``).
+
+    The remaining rate limit budget is spread across all watched
+    repositories: given what one poll of every repository costs, the
+    interval never drops below what the remaining requests can pay for
+    until the limit resets. While GitHub refuses requests, polling waits.
+
+    Args:
+        tracker (:class:`RateLimitTracker`): Source of rate limit information
+        interval (float): Initial interval in seconds
+        min_interval (float): Shortest interval for busy repositories
+        max_interval (float): Longest interval for idle repositories
+    """
+
+    def __init__(self, tracker, interval, min_interval=1, max_interval=300):
+        self.tracker = tracker
+        self.interval = interval
+        self.min_interval = min(min_interval, interval)
+        self.max_interval = max(max_interval, interval)
+        self.intervals = {}
+        self.costs = {}
+
+    def budget_interval(self):
+        """Shortest interval the remaining rate limit budget allows
+
+        Returns:
+            float: Seconds, 0 if the budget isn't known yet
+        """
+        tracker = self.tracker
+        if tracker.remaining is None or tracker.reset is None:
+            return 0
+        seconds_left = max(0, tracker.reset - time.time())
+        cost = sum(self.costs.values())
+        if tracker.remaining <= 0:
+            return seconds_left
+        return seconds_left * cost / tracker.remaining
+
+    def next_delay(self, repo, activity):
+        """Compute the delay before the next poll of the repository
+
+        Args:
+            repo (tuple): (repository_owner, repository_name)
+            activity (int): Number of updated issues found by the last poll
+        Returns:
+            float: Seconds to wait
+        """
+        repo = tuple(repo)
+        self.costs[repo] = self.tracker.take_cost(repo)
+        interval = self.intervals.get(repo, self.interval)
+        if activity:
+            interval = max(self.min_interval, interval / 2.0)
+        else:
+            interval = min(self.max_interval, interval * 2.0)
+        self.intervals[repo] = interval
+        return max(interval, self.budget_interval(), self.tracker.blocked_for())
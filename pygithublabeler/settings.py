@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import configparser
+import os
+
+import yaml
+
+from .github import Transport, get_session
+from .guard import RuleGuard
+from .profiling import RuleProfiler
+from .rules import MatchMemo, RuleSet, RulesWatcher
+
+API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com").rstrip("/")
+PER_PAGE = 100
+# configuration shared by the console, the web app and the engine,
+# filled by load_configuration
+config = {}
+
+
+class ConfigurationError(Exception):
+    """Configuration of the labeler can't be loaded"""
+
+
+def load_authtoken(filename):
+    """Reads authorization token from a file.
+    
+    Args:
+        filename (str): path to the file
+    
+    Returns:
+        str: Top secret webhook token 
+    """
+    config = configparser.ConfigParser()
+    if len(config.read(filename)) == 0:
+        raise IOError("Could not read config file {}.".format(filename))
+
+    token = config['github']['token']
+    return token
+
+
+def load_rules(filename):
+    """Reads rules for labelling from a YAML file and compiles them.
+    
+    Args:
+        filename (str): path to the file
+    
+    Returns:
+        :class:`RuleSet`: compiled rules, empty if the file contains no rules
+    """
+    with open(filename) as f:
+        rules = yaml.safe_load(f)
+        return RuleSet(rules or [])
+
+
+def get_repo(repo):
+    """Parse owner and name of the repository from repository's fullname
+    
+    Args:
+        repo (str): Full name of the repository (owner/name format)
+    
+    Returns:
+        tuple: (owner, name)
+    """
+    repo_owner, repo_name = repo.split("/")
+    return repo_owner, repo_name
+
+
+def load_repos(filename):
+    """Load full names of repositories from a file
+
+    One repository per line in owner/name format, empty lines and lines
+    starting with # are ignored.
+
+    Args:
+        filename (str): Path to the file
+    Returns:
+        list: Full names of the repositories
+    """
+    repos = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                repos.append(line)
+    return repos
+
+
+def get_scope(scope):
+    """Get scope for the labeler
+    
+    Args:
+        scope (list): combination of issue_body, issue_comments, pull_requests or ["all"]
+    
+    Returns:
+        list: list of scopes
+    """
+    if "all" in scope:
+        scope = ["issue_body", "issue_comments", "pull_requests"]
+
+    return scope
+
+
+def load_configuration(authconfig="auth.cfg", repo="slowbackspace/testrepo",
+                        scope=["all"], rules="rules.yml", interval=10,
+                        fallback_label="wontfix", rule_cache=None, rule_cache_ttl=None,
+                        rules_reload=None, rule_profile=None, rule_timeout=None,
+                        rule_budget=None):
+    """Loads configuration and store it in :py:data:`config`
+    
+    Args:
+        authconfig (str): Path to the authorization config
+        repo (str): Full name of the repository (owner/name format) or a
+            list of them, all repositories share one session and the rules
+        scope (list): list of scopes
+        rules (str): Path to the rules config
+        interval (int): How often scan issues
+        fallback_label (str): Label that will be attached if no rule matches
+        rule_cache (int): Number of memoized rule evaluations, 0 disables the
+            memo. RULE_CACHE_SIZE env variable or 4096 if None
+        rule_cache_ttl (int): Seconds after which memoized evaluations expire,
+            never if 0. RULE_CACHE_TTL env variable or 3600 if None
+        rules_reload (float): Seconds between checks whether the rules file
+            changed, the rules are never reloaded if 0. RULES_RELOAD_INTERVAL
+            env variable or 5 if None
+        rule_profile (float): Fraction of the texts for which every rule is
+            profiled, see :class:`profiling.RuleProfiler`, 0 disables the
+            profiler. RULE_PROFILE_RATE env variable or 0 if None
+        rule_timeout (float): Seconds one rule may run on one text, the
+            regexes are evaluated in killable processes if set, see
+            :class:`guard.RuleGuard`. RULE_TIMEOUT env variable or 0 (no
+            limit) if None
+        rule_budget (float): Seconds all rules may run for one issue if
+            rule_timeout is set, 0 unlimited. RULE_BUDGET env variable or 1
+            if None
+    Raises:
+        ConfigurationError: If the configuration can't be loaded
+    """
+    if rule_cache is None:
+        rule_cache = int(os.getenv("RULE_CACHE_SIZE", 4096))
+    if rule_cache_ttl is None:
+        rule_cache_ttl = int(os.getenv("RULE_CACHE_TTL", 3600))
+    if rules_reload is None:
+        rules_reload = float(os.getenv("RULES_RELOAD_INTERVAL", 5))
+    if rule_profile is None:
+        rule_profile = float(os.getenv("RULE_PROFILE_RATE", 0))
+    if rule_timeout is None:
+        rule_timeout = float(os.getenv("RULE_TIMEOUT", 0))
+    if rule_budget is None:
+        rule_budget = float(os.getenv("RULE_BUDGET", 1))
+
+    try:
+        token = load_authtoken(authconfig)
+    except Exception as e:
+        raise ConfigurationError("Unable to read auth configuration from '{}'".format(authconfig))
+    
+    rules_file = rules
+    try:
+        rules = load_rules(rules_file)
+    except Exception as e:
+        raise ConfigurationError("Unable to read rules configuration from '{}'".format(rules_file))
+
+    memo = MatchMemo(rule_cache, rule_cache_ttl) if rule_cache > 0 else None
+    rules.memo = memo
+    profiler = RuleProfiler(rule_profile) if rule_profile > 0 else None
+    rules.profiler = profiler
+    guard = None
+    if rule_timeout > 0:
+        guard = RuleGuard(rule_timeout, rule_budget,
+                          int(os.getenv("RULE_QUARANTINE_AFTER", 3)),
+                          int(os.getenv("RULE_PROCESSES", 2)))
+    rules.guard = guard
+
+    if isinstance(repo, str):
+        repo = [repo]
+    try:
+        repos = [get_repo(name) for name in repo]
+    except ValueError:
+        raise ConfigurationError("Repositories must be in 'owner/name' format")
+
+    transport = config.get("transport", None) or Transport.from_env()
+
+    watcher = config.get("rules_watcher", None)
+    if watcher is not None:
+        watcher.stop()
+    watcher = None
+    if rules_reload > 0:
+        watcher = RulesWatcher(rules_file, load_rules, swap_rules, rules, rules_reload)
+
+    config.update({
+        "token": token,
+        "rule_memo": memo,
+        "rule_profiler": profiler,
+        "rule_guard": guard,
+        "rules_watcher": watcher,
+        "repos": repos,
+        "repo_owner": repos[0][0],
+        "repo_name": repos[0][1],
+        "rules": rules,
+        "interval": interval,
+        "fallback_label": fallback_label,
+        "scope": get_scope(scope),
+        "transport": transport,
+        "breaker": transport.breaker,
+        "session": config.get("session", None) or get_session(token, transport=transport)
+        })
+
+
+def swap_rules(rules):
+    """Replace the rules in use, keeping the rule memo, profiler and guard
+
+    Called by :class:`RulesWatcher` with already compiled rules, whoever
+    reads ``config["rules"]`` gets either the old or the new rule set.
+    Memoized evaluations and cached comments are keyed by the fingerprint
+    of the rules, so they are not reused with the new rules.
+    """
+    rules.memo = config.get("rule_memo", None)
+    rules.profiler = config.get("rule_profiler", None)
+    rules.guard = config.get("rule_guard", None)
+    config["rules"] = rules
+    print("Reloaded {} rules, fingerprint {}".format(len(rules), rules.fingerprint))
+
+
+def watch_rules():
+    """Make sure the rules file is watched in this process"""
+    watcher = config.get("rules_watcher", None)
+    if watcher is not None:
+        watcher.ensure_started()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+class CursorStore(object):
+    """High-water marks of processed issues, persisted in a JSON file
+
+    For every repository the newest ``updated_at`` timestamp of an issue
+    the console has already processed is remembered, so the next poll
+    (even after a restart) asks GitHub only for issues updated since then.
+    GitHub's ``since`` filter is inclusive, so the numbers of issues
+    processed exactly at the high-water mark are remembered too and such
+    issues are not processed again.
+
+    Args:
+        filename (str): Path to the state file, state is kept only in
+            memory if None
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.cursors = {}
+        self.seen = {}
+        self.dirty = False
+        if filename and os.path.exists(filename):
+            with open(filename) as f:
+                state = json.load(f)
+            self.cursors = state.get("cursors", {})
+            self.seen = state.get("seen", {})
+
+    @staticmethod
+    def _key(repo):
+        return "{}/{}".format(*repo)
+
+    def get(self, repo):
+        """Get the high-water mark of the repository
+
+        Args:
+            repo (tuple): (repository_owner, repository_name)
+        Returns:
+            str: ISO 8601 timestamp or None if the repository was never scanned
+        """
+        return self.cursors.get(self._key(repo))
+
+    def set(self, repo, updated_at, seen=()):
+        """Set the high-water mark of the repository
+
+        Args:
+            repo (tuple): (repository_owner, repository_name)
+            updated_at (str): ISO 8601 timestamp
+            seen (list): Numbers of issues processed at exactly this timestamp
+        """
+        key = self._key(repo)
+        seen = sorted(set(seen))
+        if self.cursors.get(key) != updated_at or self.seen.get(key, []) != seen:
+            self.cursors[key] = updated_at
+            self.seen[key] = seen
+            self.dirty = True
+
+    def is_processed(self, repo, issue):
+        """Check whether the issue was already processed in its current version
+
+        Args:
+            repo (tuple): (repository_owner, repository_name)
+            issue (dict): Issue with ``number`` and ``updated_at``
+        Returns:
+            bool: True if the issue can be skipped
+        """
+        key = self._key(repo)
+        return (issue["updated_at"] == self.cursors.get(key) and
+                issue["number"] in self.seen.get(key, []))
+
+    def advance(self, repo, done, failed=()):
+        """Move the high-water mark after a poll
+
+        The mark never moves past an issue which failed, so it is fetched
+        again by the next poll.
+
+        Args:
+            repo (tuple): (repository_owner, repository_name)
+            done (list): Issues processed (or skipped) by the poll
+            failed (list): Issues which failed to be processed
+        """
+        if not done and not failed:
+            return
+        since = self.get(repo)
+        cursor = max([issue["updated_at"] for issue in done] + [since or ""])
+        if failed:
+            cursor = min([cursor] + [issue["updated_at"] for issue in failed])
+        seen = [issue["number"] for issue in done if issue["updated_at"] == cursor]
+        if cursor == since:
+            seen += self.seen.get(self._key(repo), [])
+        failed_numbers = [issue["number"] for issue in failed]
+        self.set(repo, cursor, [number for number in seen if number not in failed_numbers])
+
+    def reset(self, repo):
+        """Forget the high-water mark so the next poll is a full scan"""
+        if self.cursors.pop(self._key(repo), None) is not None:
+            self.seen.pop(self._key(repo), None)
+            self.dirty = True
+
+    def save(self):
+        """Atomically write the state file if anything changed"""
+        if not self.filename or not self.dirty:
+            return
+        tmp = "{}.tmp".format(self.filename)
+        with open(tmp, "w") as f:
+            json.dump({"cursors": self.cursors, "seen": self.seen}, f,
+                      indent=2, sort_keys=True)
+        os.replace(tmp, self.filename)
+        self.dirty = False
+
+
+def comments_deleted(issue, known, comments):
+    """Check whether comments of the issue were deleted since they were cached
+
+    Args:
+        issue (dict): Issue with the number of its comments, as returned by
+            the GitHub API
+        known (dict): Labels of the cached comments, by comment id
+        comments (list): Comments fetched since the cached ones
+    Returns:
+        bool: True if the comments don't add up to the issue's count, only
+        all comments tell which one is gone
+    """
+    count = issue.get("comments")
+    if not isinstance(count, int):
+        return False
+    return len(set(known).union(comment["id"] for comment in comments)) != count
+
+
+class CommentCache(object):
+    """Labels produced by already searched comments of every issue
+
+    For every issue the newest ``updated_at`` of its comments and, per
+    comment id, the labels of the rules which matched it are remembered, so
+    the next visit fetches (``since=``) and searches only new or edited
+    comments. An edited comment replaces its labels, a deleted one drops
+    them once a complete list of the comments is seen (see
+    :py:meth:`update`). Entries are bound to the fingerprint of the rule
+    set they were computed with and are not used once the rules change.
+    The least recently used issues are evicted first.
+
+    The cache can be shared by several threads.
+
+    Args:
+        max_issues (int): How many issues to remember
+    """
+
+    def __init__(self, max_issues=10000):
+        self.max_issues = max_issues
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, repo, issue, rules):
+        """Get the state of the issue's comments
+
+        Args:
+            repo (tuple): (repository_owner, repository_name)
+            issue (int): Issue's number
+            rules (RuleSet): Rules the labels have to come from
+        Returns:
+            tuple: (since, labels)
+
+                since (str): Timestamp of the newest searched comment or
+                    None if all comments have to be fetched
+                labels (dict): Labels matched by every searched comment,
+                    by comment id
+        """
+        key = (tuple(repo), issue)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry["rules"] != rules.fingerprint:
+                return None, {}
+            self.entries.move_to_end(key)
+            return entry["since"], dict(entry["labels"])
+
+    def update(self, repo, issue, rules, comments, labels, complete=False):
+        """Remember newly searched comments
+
+        Args:
+            repo (tuple): (repository_owner, repository_name)
+            issue (int): Issue's number
+            rules (RuleSet): Rules the labels come from
+            comments (list): Fetched comments
+            labels (dict): Labels matched by the searched comments, by
+                comment id, they replace what an earlier version of the
+                comment matched
+            complete (bool): True if ``comments`` are all comments of the
+                issue, the labels of the others are dropped, they were
+                deleted
+        Returns:
+            set: Labels matched by all known comments of the issue
+        """
+        key = (tuple(repo), issue)
+        with self.lock:
+            entry = self.entries.get(key)
+            fresh = entry is not None and entry["rules"] == rules.fingerprint
+            since = entry["since"] if fresh else None
+            known = dict(entry["labels"]) if fresh else {}
+            if complete:
+                ids = set(comment["id"] for comment in comments)
+                known = dict((id, found) for id, found in known.items() if id in ids)
+            for id, found in labels.items():
+                known[id] = frozenset(found)
+            for comment in comments:
+                since = max(since or "", comment["updated_at"])
+            self.entries[key] = {"since": since, "labels": known, "rules": rules.fingerprint}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_issues:
+                self.entries.popitem(last=False)
+            return set().union(*known.values())
+
+    def __len__(self):
+        return len(self.entries)
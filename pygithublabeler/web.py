@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import gc
+import hashlib
+import hmac
+import json
+import os
+import queue
+import time
+
+from flask import Flask, Response, abort, g, jsonify, request, redirect, render_template
+
+from . import engine, metrics, settings
+from .deliveries import open_delivery_cache
+from .github import CircuitOpenError
+from .rules import EvaluationAborted
+from .worker import Coalescer, WorkQueue
+
+port = int(os.getenv("PORT", 5000))
+debug = True if os.getenv("DEBUG", "") == "true" else False
+app = Flask(__name__)
+app.config.update({
+    "webhook_token": os.getenv("webhook_token", ""),
+    "hook_workers": int(os.getenv("HOOK_WORKERS", 4)),
+    "hook_queue_size": int(os.getenv("HOOK_QUEUE_SIZE", 1000)),
+    "hook_dedup_size": int(os.getenv("HOOK_DEDUP_SIZE", 10000)),
+    "hook_dedup_ttl": int(os.getenv("HOOK_DEDUP_TTL", 3600)),
+    "hook_dedup_db": os.getenv("HOOK_DEDUP_DB", ""),
+    "hook_coalesce_window": float(os.getenv("HOOK_COALESCE_WINDOW", 0)),
+})
+
+
+def validate_signature(headers, data, secret_key):
+    """Validate webhook request with a signature in X-Hub-Signature header
+    
+    More info at https://developer.github.com/webhooks/securing/ 
+    
+    Args:
+        headers (dict): Request's headers
+        data (str): Request's data
+        secret_key (str): Top secret webhook token
+    
+    Returns:
+        bool: True if signature is valid, False otherwise
+    """
+    # http://eli.thegreenplace.net/2014/07/09/payload-server-in-python-3-for-github-webhooks
+    # https://github.com/jirutka/github-pr-closer/blob/master/app.py
+    try:
+        sha_name, signature = headers["X-Hub-Signature"].split("=", 1)
+    except Exception as e:
+        return False
+
+    if sha_name != "sha1":
+        return False
+
+    computed_digest = hmac.new(secret_key.encode("utf-8"),
+                               msg=data,
+                               digestmod=hashlib.sha1).hexdigest()
+
+    return hmac.compare_digest(computed_digest, signature)
+
+
+def create_app(authconfig=None, repo=None, rules=None, freeze=True):
+    """Load the configuration and compile the rules before serving anything
+
+    Meant for WSGI servers, see wsgi.py. With ``gunicorn --preload`` the
+    app is created once in the master process and the forked workers share
+    the compiled rules copy-on-write. Nothing which can't cross a fork is
+    started: worker threads, the rules watcher and database connections
+    start lazily in every worker and no connection is opened yet.
+
+    Args:
+        authconfig (str): Path to the authorization config. LABELER_AUTHCONFIG
+            env variable or auth.cfg if None
+        repo (str): Repository in owner/name format. LABELER_REPO env variable
+            or slowbackspace/testrepo if None
+        rules (str): Path to the rules config. LABELER_RULES env variable or
+            rules.yml if None
+        freeze (bool): Move everything loaded so far to the permanent
+            generation of the garbage collector, so collections in the
+            workers don't touch (and copy) the shared pages
+    Returns:
+        :class:`flask.Flask`: Configured app
+    Raises:
+        :class:`settings.ConfigurationError`: If the configuration can't be loaded
+    """
+    started = time.perf_counter()
+    settings.load_configuration(
+        authconfig or os.getenv("LABELER_AUTHCONFIG", "auth.cfg"),
+        repo or os.getenv("LABELER_REPO", "slowbackspace/testrepo"),
+        rules=rules or os.getenv("LABELER_RULES", "rules.yml"))
+    app.config["startup_time"] = time.perf_counter() - started
+    if freeze and hasattr(gc, "freeze"):
+        gc.freeze()
+    return app
+
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+    metrics.registry.ensure_started()
+
+
+@app.after_request
+def record_first_request(response):
+    """Remember how long the first request of this process took"""
+    if "request_started" in g and app.config.get("first_request_pid") != os.getpid():
+        app.config["first_request_pid"] = os.getpid()
+        app.config["first_request_time"] = time.perf_counter() - g.request_started
+    return response
+
+
+@app.after_request
+def record_hook_duration(response):
+    """Observe how long answering a webhook took"""
+    if request.endpoint == "hook" and request.method == "POST" and "request_started" in g:
+        metrics.hook_seconds.observe(time.perf_counter() - g.request_started,
+                                     status=response.status_code)
+    return response
+
+
+@app.route('/')
+def index():
+    """ Index page """
+    return render_template("help.html")
+    # return "Hello World! I am running on port {}".format(int(os.getenv("PORT")))
+
+
+@app.route('/hook', methods=["POST", "GET"])
+def hook():
+    """Handler for the GitHub webhook
+    Supports 3 types of GitHub events - issues, issue comment, pull request.
+    Validates requests and verifies signature using :py:func:`validate_signature`.
+    Then text of the issue/comment 
+    Then it will find and add missing labels to the issue. 
+
+    Labelling is done by :py:func:`label_issue` in a background worker
+    and the handler answers 202 right away. If HOOK_WORKERS is 0 the
+    labels are added before the handler answers.
+
+    Deliveries already handled (the same X-GitHub-Delivery id or the same
+    content of the same issue) are answered right away without any work,
+    see :py:func:`delivery_keys`. If HOOK_COALESCE_WINDOW is set, events of
+    the same issue arriving within the window are merged by
+    :py:func:`merge_jobs` and the issue is labelled once.
+
+    While the circuit breaker of the GitHub transport is open events are
+    still accepted and the workers hold them until GitHub takes requests
+    again, see :py:func:`label_issue`. GitHub doesn't redeliver failed
+    deliveries on its own, so only without workers (HOOK_WORKERS 0) the
+    handler answers 503 with ``Retry-After``, the event is lost unless it
+    is redelivered by hand.
+    """
+    if request.method == "GET":
+        return render_template("help.html")
+
+    if not settings.config.get("scope", None):
+        # the app wasn't created by create_app, load the configuration now
+        try:
+            settings.load_configuration()
+        except settings.ConfigurationError as e:
+            print(e)
+            return "Labeler is not configured", 503
+    settings.watch_rules()
+    scope = settings.config["scope"]
+
+    try:
+        data = request.get_json()
+    except Exception as e:
+        return abort(400)
+
+    if not data:
+        return "Invalid data", 400
+    if data.get("action", "") not in ["opened", "created", "edited"]:
+        return "Invalid action", 501
+    issue = data.get("issue", None) or data.get("pull_request", None)
+    if issue is None:
+        return "Invalid requests", 400
+
+    # Validate request
+    if not debug:
+        if app.config["webhook_token"] == "":
+            print("Missing webhook_token env variable. Webhook endpoint not secured.")
+        else:
+            start = time.perf_counter()
+            valid = validate_signature(request.headers, request.data, app.config["webhook_token"])
+            metrics.signature_seconds.observe(time.perf_counter() - start, valid=valid)
+            if not valid:
+                return "Invalid signature", 403
+
+    repo_owner, repo_name = settings.get_repo(data.get("repository", {}).get("full_name"))
+    comment = data.get("comment", None)
+    current_labels = [label["name"] for label in issue.get("labels", [])]
+    searched_content = []
+    # skip PR if they aren't in the scope
+    if data.get("pull_request", None) and "pull_requests" not in scope:
+        return "PR not in scope", 400
+
+    # aply rules to issues's body if it's in the scope
+    if "issue_body" in scope:
+        searched_content.append(issue["body"])
+
+    # check comments if needed
+    if "issue_comments" in scope and comment is not None:
+        searched_content.append(comment["body"])
+
+    job = {
+        "repo": (repo_owner, repo_name),
+        "issue": issue["number"],
+        "current_labels": current_labels,
+        "searched_content": searched_content,
+        "delivery_keys": delivery_keys(request.headers, (repo_owner, repo_name),
+                                       issue["number"], searched_content, current_labels,
+                                       settings.config.get("rules", None)),
+    }
+    # without workers nothing can hold the event until GitHub recovers
+    breaker = settings.config.get("breaker", None)
+    if breaker is not None and breaker.is_open() and app.config["hook_workers"] <= 0:
+        return "GitHub is unavailable", 503, {"Retry-After": str(int(breaker.blocked_for()) + 1)}
+
+    if delivery_cache is not None and delivery_cache.is_duplicate(job["delivery_keys"]):
+        return "Duplicate delivery", 200
+
+    if app.config["hook_workers"] <= 0:
+        missing_labels = label_issue(job)
+        return "{}".format(missing_labels), 200
+
+    if coalescer is not None:
+        coalescer.add((job["repo"], job["issue"]), job)
+        return "Accepted", 202
+
+    try:
+        enqueue_job(job)
+    except queue.Full:
+        return "Too many pending requests", 503
+    return "Accepted", 202
+
+
+def enqueue_job(job):
+    """Submit the job to the background workers
+
+    Raises:
+        queue.Full: If too many jobs are waiting, the delivery is forgotten
+    """
+    try:
+        hook_queue.submit(job)
+    except queue.Full:
+        if delivery_cache is not None:
+            delivery_cache.forget(job["delivery_keys"])
+        raise
+
+
+def merge_jobs(held, new):
+    """Merge two jobs of the same issue
+
+    Texts of both are searched, the labels of the issue are taken from
+    the newer one.
+
+    Args:
+        held (dict): Older job, see :py:func:`hook`
+        new (dict): Newer job
+    Returns:
+        dict: Merged job
+    """
+    searched_content = list(held["searched_content"])
+    for text in new["searched_content"]:
+        if text not in searched_content:
+            searched_content.append(text)
+    merged = dict(new)
+    merged["searched_content"] = searched_content
+    merged["delivery_keys"] = held["delivery_keys"] + new["delivery_keys"]
+    return merged
+
+
+def delivery_keys(headers, repo, issue, searched_content, current_labels, rules=None):
+    """Keys identifying a webhook delivery in the delivery cache
+
+    The X-GitHub-Delivery id catches redeliveries, the hash of the content
+    catches bursts of events which would label the issue the same way. The
+    hash includes the fingerprint of the rules, so the same content is
+    labelled again after the rules are reloaded.
+
+    Args:
+        headers (dict): Request headers
+        repo (tuple): (repository_owner, repository_name)
+        issue (int): Issue's number
+        searched_content (list): Texts the rules are applied to
+        current_labels (list): Labels of the issue
+        rules (RuleSet): Rules the content is checked against
+    Returns:
+        list: Keys
+    """
+    fingerprint = rules.fingerprint if rules is not None else None
+    content = json.dumps([searched_content, sorted(current_labels), fingerprint])
+    keys = ["content:{}/{}#{}:{}".format(repo[0], repo[1], issue,
+                                         hashlib.sha1(content.encode("utf-8")).hexdigest())]
+    if headers.get("X-GitHub-Delivery"):
+        keys.append("delivery:{}".format(headers["X-GitHub-Delivery"]))
+    return keys
+
+
+def wait_for_github(breaker):
+    """Block while the circuit breaker refuses requests to GitHub"""
+    while breaker.is_open():
+        time.sleep(min(breaker.blocked_for(), 0.5))
+
+
+def label_issue(job):
+    """Apply the rules to a webhook's content and attach the missing labels
+
+    While the circuit breaker is open the labels are held until GitHub
+    takes requests again, a job is never dropped because GitHub is
+    failing. If labelling fails otherwise, or the rule guard didn't
+    evaluate every rule in time (only the labels found are attached then),
+    the delivery is forgotten, so a redelivery (from the webhook's
+    settings on GitHub) is handled again.
+
+    Args:
+        job (dict): repo, issue, current_labels, searched_content and
+            delivery_keys extracted from the webhook by :py:func:`hook`
+    Returns:
+        set: Labels attached to the issue
+    """
+    breaker = settings.config.get("breaker", None)
+    try:
+        try:
+            match, missing_labels = engine.check_rules(settings.config["rules"],
+                                                       job["searched_content"],
+                                                       job["current_labels"],
+                                                       settings.config["fallback_label"])
+        except EvaluationAborted as e:
+            # the labels found are right, without the fallback label
+            engine.label_batcher.add(settings.config["session"], job["repo"], job["issue"],
+                                     e.labels, job["current_labels"])
+            raise
+        while True:
+            if breaker is not None:
+                wait_for_github(breaker)
+            try:
+                engine.label_batcher.add(settings.config["session"], job["repo"], job["issue"],
+                                         missing_labels, job["current_labels"])
+                break
+            except Exception as e:
+                # another request is finding out whether GitHub recovered, or it didn't
+                if breaker is None or not (isinstance(e, CircuitOpenError) or breaker.is_open()):
+                    raise
+                print(e)
+    except Exception:
+        if delivery_cache is not None and job.get("delivery_keys"):
+            delivery_cache.forget(job["delivery_keys"])
+        raise
+    return missing_labels
+
+
+hook_queue = WorkQueue(label_issue, app.config["hook_workers"], app.config["hook_queue_size"])
+# HOOK_DEDUP_DB shares the handled deliveries between gunicorn workers
+delivery_cache = open_delivery_cache(app.config["hook_dedup_size"], app.config["hook_dedup_ttl"],
+                                     app.config["hook_dedup_db"])
+coalescer = None
+if app.config["hook_coalesce_window"] > 0 and app.config["hook_workers"] > 0:
+    coalescer = Coalescer(enqueue_job, merge_jobs, app.config["hook_coalesce_window"])
+
+
+@app.route('/status')
+def status():
+    """Webhook queue, coalescer, delivery cache, rules, rule memo, rule profiler, rule guard, circuit breaker and label batcher statistics"""
+    memo = settings.config.get("rule_memo", None)
+    profiler = settings.config.get("rule_profiler", None)
+    guard = settings.config.get("rule_guard", None)
+    rules = settings.config.get("rules", None)
+    watcher = settings.config.get("rules_watcher", None)
+    breaker = settings.config.get("breaker", None)
+    first_request = None
+    if app.config.get("first_request_pid") == os.getpid():
+        first_request = app.config.get("first_request_time")
+    return jsonify({
+        "startup": {
+            "startup_time": app.config.get("startup_time", None),
+            "first_request_time": first_request,
+        },
+        "rules": {
+            "count": len(rules) if rules is not None else 0,
+            "fingerprint": rules.fingerprint if rules is not None else None,
+            "reload": watcher.stats() if watcher is not None else None,
+        },
+        "queue": hook_queue.stats(),
+        "coalescer": coalescer.stats() if coalescer is not None else None,
+        "deliveries": delivery_cache.stats() if delivery_cache is not None else None,
+        "rule_memo": memo.stats() if memo is not None else None,
+        "rule_profile": profiler.stats() if profiler is not None else None,
+        "rule_guard": guard.stats() if guard is not None else None,
+        "github": breaker.stats() if breaker is not None else None,
+        "labels": engine.label_batcher.stats(),
+    })
+
+
+@app.route('/rules/profile')
+def rules_profile():
+    """Rules in use ranked by the time spent in them, sampled by the rule
+    profiler of this worker if RULE_PROFILE_RATE is set"""
+    profiler = settings.config.get("rule_profiler", None)
+    if profiler is None:
+        return jsonify({"enabled": False, "rules": []})
+    return jsonify({
+        "enabled": True,
+        "stats": profiler.stats(),
+        "rules": profiler.report(settings.config.get("rules", None)),
+    })
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Metrics in the Prometheus text format, added up over all gunicorn
+    workers sharing METRICS_DIR"""
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
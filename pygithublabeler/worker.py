@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import queue
+import threading
+import time
+
+
+class WorkQueue(object):
+    """Bounded queue of jobs drained by a pool of background threads
+
+    Threads are started lazily by the first :py:meth:`submit` in every
+    process, so the queue keeps working in forked gunicorn workers.
+
+    Args:
+        handler (callable): Function called with every job
+        workers (int): Number of worker threads
+        maxsize (int): Maximum of waiting jobs, unbounded if 0
+    """
+
+    def __init__(self, handler, workers=4, maxsize=0):
+        self.handler = handler
+        self.workers = workers
+        self.queue = queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.pid = None
+        self.processed = 0
+        self.failed = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # threads don't survive fork, start them in every process
+            self.pid = os.getpid()
+            self.queue = queue.Queue(self.queue.maxsize)
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, args=(self.queue,),
+                                          name="labeler-worker-{}".format(i))
+                thread.daemon = True
+                thread.start()
+
+    def submit(self, job):
+        """Enqueue a job without waiting
+
+        Args:
+            job: Argument for the handler
+        Raises:
+            queue.Full: If the queue is full
+        """
+        self._ensure_started()
+        self.queue.put_nowait((time.time(), job))
+
+    def join(self):
+        """Block until all submitted jobs are done"""
+        self.queue.join()
+
+    def _work(self, jobs):
+        while True:
+            enqueued, job = jobs.get()
+            lag = time.time() - enqueued
+            try:
+                self.handler(job)
+            except Exception as e:
+                print(e)
+                with self.lock:
+                    self.failed += 1
+            finally:
+                with self.lock:
+                    self.processed += 1
+                    self.lag = lag
+                    self.max_lag = max(self.max_lag, lag)
+                jobs.task_done()
+
+    def stats(self):
+        """Queue depth, processed jobs and queueing delay
+
+        Returns:
+            dict: depth, workers, processed, failed, lag (delay of the last
+            started job in seconds) and max_lag
+        """
+        with self.lock:
+            return {
+                "depth": self.queue.qsize(),
+                "workers": self.workers,
+                "processed": self.processed,
+                "failed": self.failed,
+                "lag": self.lag,
+                "max_lag": self.max_lag,
+            }
+
+
+class Coalescer(object):
+    """Merges bursts of jobs with the same key before they are handled
+
+    A job is held until no other job with the same key arrived for
+    ``window`` seconds, but at most ``max_wait`` seconds after the first
+    one. Jobs arriving meanwhile are merged into it, then the merged job is
+    passed to the sink by a background thread. The thread is started lazily
+    in every process, like the threads of :class:`WorkQueue`.
+
+    Args:
+        sink (callable): Function called with every merged job
+        merge (callable): Function merging two jobs, called with the held
+            job and the new one, returns the merged job
+        window (float): Quiet window in seconds
+        max_wait (float): Longest time a job is held, five windows if None
+    """
+
+    def __init__(self, sink, merge, window=2, max_wait=None):
+        self.sink = sink
+        self.merge = merge
+        self.window = window
+        self.max_wait = max_wait if max_wait is not None else window * 5
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.pid = None
+        self.received = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.dropped = 0
+
+    def _ensure_started(self):
+        with self.condition:
+            if self.pid == os.getpid():
+                return
+            # threads don't survive fork, start the thread in every process
+            self.pid = os.getpid()
+            self.pending = {}
+            thread = threading.Thread(target=self._work, name="labeler-coalescer")
+            thread.daemon = True
+            thread.start()
+
+    def add(self, key, job):
+        """Hold a job, merging it into a held job with the same key
+
+        Args:
+            key: Jobs with equal keys are merged
+            job: Argument for the sink
+        """
+        self._ensure_started()
+        now = time.time()
+        with self.condition:
+            self.received += 1
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = {"first": now, "due": now + self.window, "job": job}
+            else:
+                entry["job"] = self.merge(entry["job"], job)
+                entry["due"] = min(now + self.window, entry["first"] + self.max_wait)
+                self.coalesced += 1
+            self.condition.notify()
+
+    def _take(self, force=False):
+        now = time.time()
+        due = [key for key, entry in self.pending.items() if force or entry["due"] <= now]
+        return [self.pending.pop(key)["job"] for key in due]
+
+    def _work(self):
+        while True:
+            with self.condition:
+                jobs = self._take()
+                while not jobs:
+                    timeout = None
+                    if self.pending:
+                        timeout = min(entry["due"] for entry in self.pending.values())
+                        timeout = max(0, timeout - time.time())
+                    self.condition.wait(timeout)
+                    jobs = self._take()
+            self._deliver(jobs)
+
+    def _deliver(self, jobs):
+        for job in jobs:
+            try:
+                self.sink(job)
+            except Exception as e:
+                print(e)
+                with self.condition:
+                    self.dropped += 1
+            else:
+                with self.condition:
+                    self.flushed += 1
+
+    def flush(self):
+        """Pass all held jobs to the sink right away"""
+        with self.condition:
+            jobs = self._take(force=True)
+        self._deliver(jobs)
+
+    def stats(self):
+        """Held jobs and how many jobs were merged
+
+        Returns:
+            dict: pending, window, received, coalesced (jobs merged into
+            another one, every one saved a round of rule evaluation and
+            label requests), flushed and dropped (refused by the sink)
+        """
+        with self.condition:
+            return {
+                "pending": len(self.pending),
+                "window": self.window,
+                "received": self.received,
+                "coalesced": self.coalesced,
+                "flushed": self.flushed,
+                "dropped": self.dropped,
+            }
@@ -5,7 +5,7 @@ with open('README.rst') as f:
 
 setup(
     setup_requires=['pytest-runner'],
-    tests_require=['pytest', 'betamax'],
+    tests_require=['pytest', 'betamax', 'aiohttp'],
     name='pygithublabeler',
     version='0.5.1',
     description='Magically (and with the power of regular expressions) attach labels to your github repository issues.',
@@ -18,9 +18,12 @@ setup(
     packages=find_packages(),
     package_data={'pygithublabeler': ['rules.yml', "templates/*.html"]},
     install_requires=['Flask', 'click>=6', 'PyYAML', 'requests'],
+    extras_require={
+        'async': ['aiohttp'],
+    },
     entry_points={
           'console_scripts': [
-              'pygithublabeler = pygithublabeler.run:cli'
+              'pygithublabeler = pygithublabeler.cli:cli'
           ]
       },
     classifiers=[
@@ -1,4 +1,7 @@
 #!/bin/bash
 if [ -z ${PORT+x} ]; then PORT=5000; else echo "PORT is set to '$PORT'"; fi
 
-exec gunicorn --bind 0.0.0.0:$PORT wsgi:application
+# metrics of workers of a previous run would be added up too
+if [ -n "$METRICS_DIR" ]; then mkdir -p "$METRICS_DIR" && rm -f "$METRICS_DIR"/metrics-*.json; fi
+
+exec gunicorn --preload --bind 0.0.0.0:$PORT wsgi:application
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+import pytest
+import pygithublabeler.run as pygithublabeler
+from pygithublabeler import settings
+from pygithublabeler.fakegithub import FakeGitHub
+from pygithublabeler.state import CursorStore
+
+aio = pytest.importorskip("pygithublabeler.aio")
+
+TEST_REPOSITORY = ("owner", "repo")
+OTHER_REPOSITORY = ("owner", "other")
+
+
+def make_issue(number, body=""):
+    return {"number": number, "title": "Issue {}".format(number), "body": body,
+            "labels": [], "updated_at": "2017-01-{:02d}T00:00:00Z".format(number)}
+
+
+@pytest.fixture
+def fake_github(monkeypatch):
+    issues = {
+        TEST_REPOSITORY: [make_issue(number) for number in range(1, 8)],
+        OTHER_REPOSITORY: [make_issue(1, "robot:bug")],
+    }
+    comments = {TEST_REPOSITORY + (2,): [{"id": 1, "body": "robot:bug"}]}
+    with FakeGitHub(issues, comments, per_page=3) as server:
+        monkeypatch.setattr(settings, "API_URL", server.url)
+        yield server
+
+
+@pytest.fixture
+def config():
+    return {
+        "token": "token",
+        "scope": ["issue_body", "issue_comments"],
+        "rules": pygithublabeler.RuleSet([{"pattern": "robot:bug", "label": "bug"}]),
+        "fallback_label": "wontfix",
+        "interval": 0,
+    }
+
+
+def labels_of(fake_github, repo):
+    return dict((issue["number"], [label["name"] for label in issue["labels"]])
+                for issue in fake_github.issues[repo])
+
+
+def test_watch_all(fake_github, config):
+    cursors = CursorStore()
+    aio.main(config, [TEST_REPOSITORY, OTHER_REPOSITORY], cursors, concurrency=2, cycles=1)
+
+    labels = labels_of(fake_github, TEST_REPOSITORY)
+    assert labels[2] == ["bug"]
+    assert all(labels[number] == ["wontfix"] for number in labels if number != 2)
+    assert labels_of(fake_github, OTHER_REPOSITORY) == {1: ["bug"]}
+    assert cursors.get(OTHER_REPOSITORY) >= "2017-01-01T00:00:00Z"
+
+
+def test_watch_all_conditional(fake_github, config):
+    config["scope"] = ["issue_body"]
+    fake_github.issues[TEST_REPOSITORY] = [make_issue(1, "robot:bug")]
+    fake_github.issues[TEST_REPOSITORY][0]["labels"] = [{"name": "bug"}]
+    aio.main(config, [TEST_REPOSITORY], CursorStore(), cycles=3)
+
+    # the second poll asks for issues since the first one, the third poll
+    # repeats the same request and is answered with 304
+    assert fake_github.stats()["not_modified"] == 1
+
+
+def test_guarded_rules_run_off_the_event_loop():
+    class Guarded(object):
+        guard = object()
+    loop = asyncio.new_event_loop()
+    try:
+        # a guarded evaluation may wait for the whole budget
+        thread = loop.run_until_complete(aio.run_rules(Guarded(), threading.current_thread))
+        assert thread is not threading.current_thread()
+        rules = pygithublabeler.RuleSet([{"pattern": "robot:bug", "label": "bug"}])
+        assert loop.run_until_complete(aio.run_rules(rules, rules.match, "robot:bug")) == {"bug"}
+    finally:
+        loop.close()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+from click.testing import CliRunner
+from pygithublabeler import bench, settings, web
+from pygithublabeler.rules import RuleSet
+
+
+def test_corpora():
+    body = bench.make_body(bench.KB, triggers=bench.default_triggers(30))
+    assert len(body) == bench.KB
+    assert bench.make_body(bench.KB) == bench.make_body(bench.KB)
+    rules = RuleSet(bench.make_rules(30))
+    assert len(rules) == 30
+    # every kind of rule is there
+    assert rules.literal and rules.standalone
+    assert len(rules.match(body)) == 3
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert bench.percentile(values, 0.5) == 50
+    assert bench.percentile(values, 0.99) == 99
+    assert bench.percentile([], 0.5) == 0.0
+
+
+def test_measure():
+    calls = []
+    result = bench.measure(lambda: calls.append(1), min_time=0, min_runs=10, size=bench.KB)
+    assert result["runs"] == 10 and len(calls) == 11
+    assert result["p50"] <= result["p90"] <= result["p99"] <= result["max"]
+    assert result["ops_per_s"] > 0 and result["mb_per_s"] > 0
+
+
+def test_compare():
+    baseline = {"a": {"ops_per_s": 100.0, "p50": 0.01}, "b": {"ops_per_s": 100.0, "p50": 0.01}}
+    results = {"a": {"ops_per_s": 90.0, "p50": 0.011},
+               "b": {"ops_per_s": 50.0, "p50": 0.02},
+               "new": {"ops_per_s": 1.0, "p50": 1.0}}
+    regressions = bench.compare(results, baseline, threshold=0.2)
+    assert len(regressions) == 2
+    assert all(regression.startswith("b:") for regression in regressions)
+
+
+def test_bench_cli_baseline(tmpdir):
+    runner = CliRunner()
+    baseline = str(tmpdir.join("baseline.json"))
+    args = ["-k", "validate_signature/body=1KB", "--quick", "--min-time", "0.01"]
+    result = runner.invoke(bench.main, args + ["--save", baseline])
+    assert result.exit_code == 0, result.output
+    assert "validate_signature/body=1KB" in result.output
+
+    # a baseline way faster than this machine can be
+    with open(baseline) as f:
+        saved = json.load(f)
+    for entry in saved["results"].values():
+        entry["ops_per_s"] *= 1000
+    with open(baseline, "w") as f:
+        json.dump(saved, f)
+    result = runner.invoke(bench.main, args + ["--baseline", baseline])
+    assert result.exit_code == 1
+    assert "REGRESSION" in result.output
+
+
+def test_bench_hook(monkeypatch):
+    # the benchmark reconfigures the labeler, keep it from leaking into other tests
+    for key in ["scope", "rules", "fallback_label", "session", "breaker"]:
+        monkeypatch.setitem(settings.config, key, settings.config.get(key))
+    for key in ["webhook_token", "hook_workers"]:
+        monkeypatch.setitem(web.app.config, key, web.app.config[key])
+    post = bench.bench_hook(bench.KB)
+    post()
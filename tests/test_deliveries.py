@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import time
+import pytest
+from pygithublabeler.deliveries import DeliveryCache, SQLiteDeliveryCache, open_delivery_cache
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_cache(request, tmpdir):
+    def make(max_entries=10000, ttl=3600):
+        if request.param == "memory":
+            return DeliveryCache(max_entries, ttl)
+        return SQLiteDeliveryCache(str(tmpdir.join("deliveries.db")), max_entries, ttl)
+    return make
+
+
+def test_duplicate(make_cache):
+    cache = make_cache()
+    assert not cache.is_duplicate(["delivery:1", "content:a"])
+    assert cache.is_duplicate(["delivery:1", "content:b"])
+    assert cache.is_duplicate(["delivery:2", "content:a"])
+    assert not cache.is_duplicate(["delivery:3", "content:c"])
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (2, 2, 4)
+
+
+def test_forget(make_cache):
+    cache = make_cache()
+    cache.is_duplicate(["delivery:1", "content:a"])
+    cache.forget(["delivery:1", "content:a"])
+    assert not cache.is_duplicate(["delivery:1", "content:a"])
+
+
+def test_ttl(make_cache):
+    cache = make_cache(ttl=0.05)
+    cache.is_duplicate(["delivery:1"])
+    time.sleep(0.1)
+    assert not cache.is_duplicate(["delivery:1"])
+
+
+def test_max_entries(make_cache):
+    cache = make_cache(max_entries=2)
+    for key in ["a", "b", "c"]:
+        cache.is_duplicate([key])
+        time.sleep(0.01)
+    assert cache.stats()["size"] == 2
+    assert not cache.is_duplicate(["a"])
+    assert cache.is_duplicate(["c"])
+
+
+def test_sqlite_shared(tmpdir):
+    filename = str(tmpdir.join("deliveries.db"))
+    # e.g. two gunicorn workers
+    first, second = SQLiteDeliveryCache(filename), SQLiteDeliveryCache(filename)
+    assert not first.is_duplicate(["delivery:1"])
+    assert second.is_duplicate(["delivery:1"])
+
+
+def test_open_delivery_cache(tmpdir):
+    assert open_delivery_cache(0) is None
+    assert type(open_delivery_cache(10)) is DeliveryCache
+    assert isinstance(open_delivery_cache(10, filename=str(tmpdir.join("d.db"))),
+                      SQLiteDeliveryCache)
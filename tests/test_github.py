@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import concurrent.futures
+import threading
+import time
+import pytest
+import pygithublabeler.run as pygithublabeler
+from pygithublabeler import engine, settings
+from pygithublabeler.fakegithub import FakeGitHub
+import requests
+from pygithublabeler.github import CircuitBreaker, CircuitOpenError, ConditionalCache, JitterRetry, Transport
+from pygithublabeler.labels import LabelBatcher
+from pygithublabeler.scheduler import PollScheduler, RateLimitTracker
+from pygithublabeler.state import CommentCache, CursorStore
+
+TEST_REPOSITORY = ("owner", "repo")
+
+
+def make_issue(number, body="", labels=(), updated_at=None):
+    return {"number": number, "title": "Issue {}".format(number), "body": body,
+            "labels": [{"name": label} for label in labels],
+            "updated_at": updated_at or "2017-01-{:02d}T00:00:00Z".format(number)}
+
+
+def make_comment(id, body=None):
+    return {"id": id, "body": body or "comment {}".format(id),
+            "updated_at": "2017-02-{:02d}T00:00:00Z".format(id + 1)}
+
+
+@pytest.fixture
+def fake_github(monkeypatch):
+    issues = {TEST_REPOSITORY: [make_issue(number) for number in range(1, 8)]}
+    comments = {TEST_REPOSITORY + (1,): [make_comment(i) for i in range(5)]}
+    with FakeGitHub(issues, comments, per_page=3) as server:
+        monkeypatch.setattr(settings, "API_URL", server.url)
+        yield server
+
+
+def test_fetch_issues_all_pages(fake_github):
+    session = pygithublabeler.get_session("token")
+    issues = list(pygithublabeler.fetch_issues(session, TEST_REPOSITORY))
+    assert [issue["number"] for issue in issues] == list(range(1, 8))
+    assert fake_github.stats()["requests"] == 3
+
+
+def test_fetch_issues_lazy(fake_github):
+    session = pygithublabeler.get_session("token")
+    issues = pygithublabeler.fetch_issues(session, TEST_REPOSITORY)
+    assert fake_github.stats()["requests"] == 0
+    next(issues)
+    assert fake_github.stats()["requests"] == 1
+
+
+def test_fetch_issues_per_page(fake_github):
+    session = pygithublabeler.get_session("token")
+    issues = list(pygithublabeler.fetch_issues(session, TEST_REPOSITORY, per_page=5))
+    assert len(issues) == 7
+    assert fake_github.stats()["requests"] == 2
+
+
+def test_fetch_comments_all_pages(fake_github):
+    session = pygithublabeler.get_session("token")
+    comments = list(pygithublabeler.fetch_comments(session, TEST_REPOSITORY, 1))
+    assert [comment["id"] for comment in comments] == list(range(5))
+
+
+def test_conditional_requests(fake_github):
+    session = pygithublabeler.get_session("token")
+    cache = ConditionalCache()
+    first = list(pygithublabeler.fetch_issues(session, TEST_REPOSITORY, cache))
+    sent = fake_github.stats()["bytes_sent"]
+
+    second = list(pygithublabeler.fetch_issues(session, TEST_REPOSITORY, cache))
+    assert second == first
+    assert fake_github.stats()["bytes_sent"] == sent
+    assert fake_github.stats()["not_modified"] == 3
+    stats = cache.stats()
+    assert stats["requests"] == 6 and stats["not_modified"] == 3
+    assert stats["bytes_saved"] == sent
+
+
+def test_conditional_requests_changed(fake_github):
+    session = pygithublabeler.get_session("token")
+    cache = ConditionalCache()
+    list(pygithublabeler.fetch_issues(session, TEST_REPOSITORY, cache))
+    pygithublabeler.add_labels(session, TEST_REPOSITORY, 7, ["bug"])
+
+    issues = list(pygithublabeler.fetch_issues(session, TEST_REPOSITORY, cache))
+    assert issues[-1]["labels"] == [{"name": "bug"}]
+    assert cache.stats()["not_modified"] == 2
+
+
+def test_not_modified_without_cache_entry(fake_github):
+    session = pygithublabeler.get_session("token")
+    cache = ConditionalCache()
+    first = list(pygithublabeler.fetch_issues(session, TEST_REPOSITORY, cache))
+    etag = next(iter(cache.entries.values()))["etag"]
+    # the session validates the first page on its own, the new cache knows nothing
+    session.headers["If-None-Match"] = etag
+    assert list(pygithublabeler.fetch_issues(session, TEST_REPOSITORY, ConditionalCache())) == first
+    assert fake_github.stats()["not_modified"] == 1
+
+
+def test_conditional_cache_eviction():
+    cache = ConditionalCache(max_entries=2)
+
+    for url in ["a", "b", "a", "c"]:
+        cache.store(url, {"ETag": '"x"'}, 2, [], None)
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.headers("a") == {"If-None-Match": '"x"'}
+    assert cache.headers("b") == {}
+
+
+def test_fetch_issues_since(fake_github):
+    session = pygithublabeler.get_session("token")
+    issues = list(pygithublabeler.fetch_issues(session, TEST_REPOSITORY,
+                                               since="2017-01-05T00:00:00Z"))
+    assert [issue["number"] for issue in issues] == [5, 6, 7]
+
+
+@pytest.fixture
+def labeler_config():
+    settings.config.update({
+        "scope": ["issue_body", "issue_comments"],
+        "rules": pygithublabeler.RuleSet([{"pattern": "robot:bug", "label": "bug"}]),
+        "fallback_label": "wontfix",
+    })
+    engine.label_batcher.clear()
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_poll_repository(fake_github, labeler_config, workers):
+    fake_github.issues[TEST_REPOSITORY][1]["body"] = "robot:bug"
+    session = pygithublabeler.get_session("token")
+    cursors = CursorStore()
+    executor, limit = None, None
+    if workers > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        limit = threading.BoundedSemaphore(2)
+
+    processed = pygithublabeler.poll_repository(session, TEST_REPOSITORY, cursors,
+                                                executor=executor, limit=limit)
+    assert processed == 7
+    labels = dict((issue["number"], [label["name"] for label in issue["labels"]])
+                  for issue in fake_github.issues[TEST_REPOSITORY])
+    assert labels[2] == ["bug"]
+    assert all(labels[number] == ["wontfix"] for number in labels if number != 2)
+    assert cursors.get(TEST_REPOSITORY) >= "2017-01-07T00:00:00Z"
+
+
+def test_poll_repository_failure_keeps_cursor(fake_github, labeler_config, monkeypatch):
+    session = pygithublabeler.get_session("token")
+    cursors = CursorStore()
+
+    def add_labels(session, repo, issue, labels):
+        if issue == 3:
+            raise IOError("failed")
+    monkeypatch.setattr(engine, "add_labels", add_labels)
+
+    pygithublabeler.poll_repository(session, TEST_REPOSITORY, cursors)
+    assert cursors.get(TEST_REPOSITORY) == "2017-01-03T00:00:00Z"
+
+
+def test_poll_repository_write_behind_keeps_cursor(fake_github, labeler_config, monkeypatch):
+    session = pygithublabeler.get_session("token")
+    cursors = CursorStore()
+    calls = []
+
+    def add_labels(session, repo, issue, labels):
+        calls.append(issue)
+        if issue == 3:
+            raise IOError("failed")
+    monkeypatch.setattr(engine, "add_labels", add_labels)
+    monkeypatch.setattr(engine, "label_batcher", LabelBatcher(
+        lambda *args: engine.add_labels(*args), interval=0.05, retries=2))
+
+    pygithublabeler.poll_repository(session, TEST_REPOSITORY, cursors)
+    # all labels were sent before the cursor moved, the dropped ones hold it back
+    assert sorted(set(calls)) == [1, 2, 3, 4, 5, 6, 7] and calls.count(3) == 3
+    assert cursors.get(TEST_REPOSITORY) == "2017-01-03T00:00:00Z"
+
+
+def test_watch_repositories(fake_github, labeler_config, monkeypatch):
+    other = ("owner", "other")
+    fake_github.issues[other] = [make_issue(1, "robot:bug")]
+    session = pygithublabeler.get_session("token")
+    cursors = CursorStore()
+    scheduler = PollScheduler(RateLimitTracker(), 0, 0, 0)
+    polled = []
+    poll_repository = pygithublabeler.poll_repository
+
+    def record(session, repo, *args):
+        polled.append(repo)
+        return poll_repository(session, repo, *args)
+
+    monkeypatch.setattr(engine, "poll_repository", record)
+    pygithublabeler.watch_repositories(session, [TEST_REPOSITORY, other], cursors,
+                                       scheduler, cycles=2)
+
+    # repositories take turns
+    assert polled == [TEST_REPOSITORY, other, TEST_REPOSITORY, other]
+    assert [label["name"] for label in fake_github.issues[other][0]["labels"]] == ["bug"]
+    assert cursors.get(other) is not None
+
+
+def test_load_repos(tmpdir):
+    filename = tmpdir.join("repos.txt")
+    filename.write("# watched repositories\nowner/repo\n\n  owner/other  \n")
+    assert pygithublabeler.load_repos(str(filename)) == ["owner/repo", "owner/other"]
+
+
+def test_process_issue_comment_cache(fake_github, labeler_config):
+    session = pygithublabeler.get_session("token")
+    comment_cache = CommentCache()
+    comments = fake_github.comments[TEST_REPOSITORY + (1,)]
+    comments[1]["body"] = "robot:bug"
+    issue = fake_github.issues[TEST_REPOSITORY][0]
+
+    assert pygithublabeler.process_issue(session, TEST_REPOSITORY, issue,
+                                         comment_cache=comment_cache) == {"bug"}
+    assert comment_cache.get(TEST_REPOSITORY, 1, settings.config["rules"]) == \
+        ("2017-02-05T00:00:00Z", {0: set(), 1: {"bug"}, 2: set(), 3: set(), 4: set()})
+
+    # only the newest comment is fetched again, the label still comes from the cache
+    # and isn't sent again, it was just added
+    issue["labels"] = []
+    comments.append(make_comment(5))
+    requests = fake_github.stats()["requests"]
+    assert pygithublabeler.process_issue(session, TEST_REPOSITORY, issue,
+                                         comment_cache=comment_cache) == {"bug"}
+    assert fake_github.stats()["requests"] == requests + 1
+    assert comment_cache.get(TEST_REPOSITORY, 1, settings.config["rules"])[0] == \
+        "2017-02-06T00:00:00Z"
+
+
+def test_process_issue_comment_cache_edits_and_deletions(fake_github, labeler_config):
+    settings.config["rules"] = pygithublabeler.RuleSet([{"pattern": "robot:bug", "label": "bug"},
+                                                        {"pattern": "robot:question",
+                                                         "label": "question"}])
+    session = pygithublabeler.get_session("token")
+    comment_cache = CommentCache()
+    comments = fake_github.comments[TEST_REPOSITORY + (1,)]
+    comments[1]["body"] = "robot:bug"
+    comments[2]["body"] = "robot:question"
+    issue = fake_github.issues[TEST_REPOSITORY][0]
+    issue["comments"] = 5
+    assert pygithublabeler.process_issue(session, TEST_REPOSITORY, issue,
+                                         comment_cache=comment_cache) == {"bug", "question"}
+
+    # the edit replaces what the comment matched before
+    issue["labels"] = []
+    comments[1].update(body="fixed", updated_at="2017-03-01T00:00:00Z")
+    assert pygithublabeler.process_issue(session, TEST_REPOSITORY, issue,
+                                         comment_cache=comment_cache) == {"question"}
+
+    # the count tells that a comment is gone, all of them are fetched again
+    issue["labels"] = []
+    del comments[2]
+    issue["comments"] = 4
+    requests = fake_github.stats()["requests"]
+    assert pygithublabeler.process_issue(session, TEST_REPOSITORY, issue,
+                                         comment_cache=comment_cache) == {"wontfix"}
+    assert fake_github.stats()["requests"] == requests + 3
+
+
+def test_transport_retries_server_errors(fake_github):
+    session = pygithublabeler.get_session("token", transport=Transport(backoff=0))
+    fake_github.fail(503, times=2, headers={"Retry-After": "0"})
+    issues = list(pygithublabeler.fetch_issues(session, TEST_REPOSITORY, per_page=10))
+    assert len(issues) == 7
+    assert fake_github.stats()["requests"] == 3
+
+
+def test_transport_gives_up(fake_github):
+    session = pygithublabeler.get_session("token", transport=Transport(retries=1, backoff=0))
+    fake_github.fail(502, times=2)
+    with pytest.raises(requests.HTTPError):
+        list(pygithublabeler.fetch_issues(session, TEST_REPOSITORY))
+    assert fake_github.stats()["requests"] == 2
+
+
+def test_add_labels_raises(fake_github):
+    session = pygithublabeler.get_session("token", transport=Transport(retries=0))
+    fake_github.fail(422)
+    with pytest.raises(requests.HTTPError):
+        pygithublabeler.add_labels(session, TEST_REPOSITORY, 1, ["bug"])
+
+
+def test_transport_default_timeout():
+    adapter = Transport(connect_timeout=1, read_timeout=2).adapter()
+    assert adapter.timeout == (1, 2)
+    assert adapter.max_retries.status_forcelist == (429, 500, 502, 503, 504)
+
+
+def test_jitter_retry():
+    retry = JitterRetry(total=5, backoff_factor=1)
+    for _ in range(4):
+        retry = retry.increment(method="GET", url="/")
+    # the fourth retry waits between half of and the full exponential backoff
+    for _ in range(20):
+        assert 4 <= retry.get_backoff_time() <= 8
+
+
+def test_circuit_breaker_sheds_requests(fake_github):
+    breaker = CircuitBreaker(failures=2, reset_timeout=60)
+    session = pygithublabeler.get_session("token", transport=Transport(retries=0,
+                                                                        breaker=breaker))
+    fake_github.fail(500, times=2)
+    for _ in range(2):
+        with pytest.raises(requests.HTTPError):
+            list(pygithublabeler.fetch_issues(session, TEST_REPOSITORY))
+    assert breaker.is_open() and breaker.blocked_for() > 59
+    with pytest.raises(CircuitOpenError):
+        list(pygithublabeler.fetch_issues(session, TEST_REPOSITORY))
+    assert fake_github.stats()["requests"] == 2
+    assert breaker.stats() == {"open": True, "failed": 2, "opened": 1}
+
+
+def test_circuit_breaker_half_open():
+    breaker = CircuitBreaker(failures=1, reset_timeout=0.05)
+    breaker.record(False)
+    assert not breaker.allow()
+    time.sleep(0.06)
+    # one trial request, the others wait for its outcome
+    assert breaker.allow()
+    assert not breaker.allow()
+    # the others keep waiting while the trial request is in flight
+    assert breaker.is_open() and breaker.blocked_for() > 0
+    breaker.record(True)
+    assert breaker.allow() and not breaker.is_open()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import pytest
+from pygithublabeler import engine, graphql, settings
+from pygithublabeler.fakegithub import FakeGitHub
+from pygithublabeler.github import get_session
+from pygithublabeler.rules import RuleSet
+from pygithublabeler.state import CommentCache, CursorStore
+
+TEST_REPOSITORY = ("owner", "repo")
+RECORDED = os.path.join(os.path.dirname(__file__), "fixtures", "graphql", "issues.json")
+
+
+@pytest.fixture
+def fake_github(monkeypatch):
+    with open(RECORDED) as f:
+        exchanges = json.load(f)
+    issues = {TEST_REPOSITORY: [{"number": number, "labels": [], "updated_at": ""}
+                                for number in (1, 2, 3)]}
+    with FakeGitHub(issues, graphql=exchanges) as server:
+        monkeypatch.setattr(settings, "API_URL", server.url)
+        yield server
+
+
+@pytest.fixture
+def labeler_config(monkeypatch):
+    monkeypatch.setitem(settings.config, "scope", ["issue_body", "issue_comments"])
+    monkeypatch.setitem(settings.config, "rules",
+                        RuleSet([{"pattern": "robot:bug", "label": "bug"}]))
+    monkeypatch.setitem(settings.config, "fallback_label", "wontfix")
+    engine.label_batcher.clear()
+
+
+def test_graphql_url(monkeypatch):
+    monkeypatch.setattr(settings, "API_URL", "https://api.github.com")
+    assert graphql.graphql_url() == "https://api.github.com/graphql"
+    monkeypatch.setattr(settings, "API_URL", "https://github.example.com/api/v3")
+    assert graphql.graphql_url() == "https://github.example.com/api/graphql"
+
+
+def test_fetch_issues(fake_github):
+    issues = list(graphql.fetch_issues(get_session("token"), TEST_REPOSITORY, per_page=2))
+    assert [issue["number"] for issue in issues] == [1, 2, 3]
+    assert issues[1]["labels"] == [{"name": "question"}]
+    # the third comment of issue 2 didn't fit into the page
+    assert [comment["body"] for comment in issues[1]["fetched_comments"]] == \
+        ["me too", "same here", "robot:bug"]
+    assert fake_github.stats()["requests"] == 3
+
+
+def test_fetch_issues_errors(fake_github):
+    with pytest.raises(graphql.GraphQLError):
+        list(graphql.fetch_issues(get_session("token"), ("owner", "unknown"), per_page=2))
+
+
+def pull_request_page(numbers, updated, after=None, next_cursor=None):
+    nodes = [{"number": number, "title": "PR {}".format(number), "body": "robot:bug",
+              "updatedAt": updated_at, "url": "https://github.com/owner/repo/pull/{}".format(number),
+              "labels": {"nodes": []},
+              "comments": {"nodes": [], "pageInfo": {"hasNextPage": False, "endCursor": None}}}
+             for number, updated_at in zip(numbers, updated)]
+    return {"variables": {"owner": "owner", "name": "repo", "first": 2, "after": after},
+            "response": {"data": {"repository": {"pullRequests": {
+                "nodes": nodes,
+                "pageInfo": {"hasNextPage": next_cursor is not None, "endCursor": next_cursor}}}}}}
+
+
+def test_fetch_pull_requests(fake_github, monkeypatch):
+    fake_github.graphql.extend([
+        pull_request_page([5, 4], ["2017-01-05T00:00:00Z", "2017-01-04T00:00:00Z"],
+                          next_cursor="page2"),
+        pull_request_page([6], ["2016-12-01T00:00:00Z"], after="page2"),
+    ])
+    monkeypatch.setitem(settings.config, "scope", ["issue_body"])
+    issues = list(graphql.fetch_issues(get_session("token"), TEST_REPOSITORY, per_page=2))
+    assert [issue["number"] for issue in issues] == [1, 2, 3]
+
+    monkeypatch.setitem(settings.config, "scope", ["issue_body", "pull_requests"])
+    issues = list(graphql.fetch_issues(get_session("token"), TEST_REPOSITORY, per_page=2))
+    assert [issue["number"] for issue in issues] == [1, 2, 3, 5, 4, 6]
+    assert [issue["number"] for issue in issues if issue.get("pull_request")] == [5, 4, 6]
+
+    # newest first, the pull requests older than the last poll aren't fetched
+    requests = fake_github.stats()["requests"]
+    issues = list(graphql.fetch_issues(get_session("token"), TEST_REPOSITORY, per_page=2,
+                                       since="2017-01-03T00:00:00Z"))
+    assert [issue["number"] for issue in issues] == [3, 5, 4]
+    assert fake_github.stats()["requests"] == requests + 3
+
+
+@pytest.mark.parametrize("comment_cache", [None, CommentCache()])
+def test_poll_repository(fake_github, labeler_config, monkeypatch, comment_cache):
+    monkeypatch.setattr(settings, "PER_PAGE", 2)
+    cursors = CursorStore()
+    processed = engine.poll_repository(get_session("token"), TEST_REPOSITORY, cursors,
+                                       comment_cache=comment_cache,
+                                       fetch=graphql.fetch_issues)
+    assert processed == 3
+    labels = dict((issue["number"], [label["name"] for label in issue["labels"]])
+                  for issue in fake_github.issues[TEST_REPOSITORY])
+    assert labels == {1: ["bug"], 2: ["bug"], 3: ["wontfix"]}
+    # no REST request for comments, only the label POSTs
+    assert fake_github.stats()["requests"] == 3 + 3
+    assert cursors.get(TEST_REPOSITORY) == "2017-01-03T00:00:00Z"
+
+    # the next poll asks only for issues updated since then
+    assert engine.poll_repository(get_session("token"), TEST_REPOSITORY, cursors,
+                                  comment_cache=comment_cache,
+                                  fetch=graphql.fetch_issues) == 0
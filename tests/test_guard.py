@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import time
+import pytest
+from pygithublabeler import engine, settings
+from pygithublabeler.fakegithub import FakeGitHub
+from pygithublabeler.github import get_session
+from pygithublabeler.guard import Budget, RuleGuard
+from pygithublabeler.rules import EvaluationAborted, MatchMemo, RuleSet
+from pygithublabeler.state import CursorStore
+
+RULES = [
+    {"pattern": "robot:bug", "label": "bug"},
+    {"pattern": "robot:q[a-z]+", "label": "question"},
+    {"pattern": "(a|aa)+$", "label": "hang"},
+    {"pattern": "(robot):(docs)", "label": "docs"},
+]
+# the third rule would backtrack for hours
+EVIL = "robot:bug robot:question robot:docs " + "a" * 60 + "!"
+
+
+@pytest.fixture
+def guard():
+    guard = RuleGuard(timeout=0.2, budget=20, quarantine_after=2, processes=1)
+    yield guard
+    while not guard.idle.empty():
+        guard.idle.get().kill()
+
+
+def test_guarded_rules_match_like_unguarded(guard):
+    rules = RuleSet(RULES, guard=guard)
+    texts = ["robot:bug", "robot:question robot:docs", "nothing", "aaaa"]
+    for text in texts:
+        assert rules.evaluate(text) == RuleSet(RULES).evaluate(text)
+    assert rules.evaluate("robot:docs robot:bug", first=True) == {"bug"}
+    assert guard.stats()["timeouts"] == 0
+
+
+def test_slow_rule_aborted_and_quarantined(guard, capsys):
+    rules = RuleSet(RULES, guard=guard)
+    for attempt in range(2):
+        start = time.time()
+        assert rules.evaluate(EVIL) == {"bug", "question", "docs"}
+        assert time.time() - start < 10
+    out = capsys.readouterr().out
+    assert out.count("Rule hang '(a|aa)+$' aborted") == 2
+    assert "Quarantined rule hang '(a|aa)+$': exceeded the timeout of 0.2 s 2 times" in out
+
+    stats = guard.stats()
+    assert (stats["timeouts"], stats["restarts"]) == (2, 2)
+    assert [rule["label"] for rule in stats["quarantined"]] == ["hang"]
+    # not evaluated anymore, so no more timeouts
+    assert rules.evaluate(EVIL) == {"bug", "question", "docs"}
+    assert guard.stats()["timeouts"] == 2
+
+
+def test_request_budget(capsys):
+    guard = RuleGuard(timeout=30, budget=1, processes=1)
+    rules = RuleSet(RULES, guard=guard)
+    budget = guard.budget()
+    start = time.time()
+    # the literal rule is matched in this process
+    assert rules.evaluate(EVIL, budget=budget) == {"bug"}
+    assert time.time() - start < 5
+    assert budget.aborted
+    assert guard.stats()["exhausted"] == 1
+    assert "Rule budget of 1 s exhausted" in capsys.readouterr().out
+    # the budget is spent, nothing but literals is evaluated anymore
+    assert rules.evaluate("robot:question", budget=budget) == set()
+
+
+def test_aborted_results_not_memoized(guard):
+    memo = MatchMemo()
+    rules = RuleSet(RULES, memo=memo, guard=guard)
+    with pytest.raises(EvaluationAborted):
+        engine.check_rules(rules, [EVIL], [], "wontfix")
+    assert memo.stats()["size"] == 0
+    with pytest.raises(EvaluationAborted):
+        rules.match(EVIL)
+    assert memo.stats()["size"] == 0
+    assert engine.check_rules(rules, ["robot:bug"], [], "wontfix") == (True, {"bug"})
+    assert memo.stats()["size"] == 1
+
+
+def test_cold_start_not_charged_to_budget():
+    guard = RuleGuard(timeout=0.1, budget=0.05, processes=1)
+    rules = RuleSet([{"pattern": r"bug\s+\d+", "label": "bug"}], guard=guard)
+    try:
+        for _ in range(3):
+            assert engine.check_rules(rules, ["bug 12"], [], "needs-triage") == (True, {"bug"})
+        assert guard.stats()["exhausted"] == 0
+    finally:
+        while not guard.idle.empty():
+            guard.idle.get().kill()
+
+
+def test_aborted_evaluation_without_fallback(guard):
+    rules = RuleSet(RULES, guard=guard)
+    with pytest.raises(EvaluationAborted) as e:
+        engine.check_rules(rules, [EVIL], [], "wontfix")
+    assert e.value.labels == {"bug", "question", "docs"}
+
+
+def test_aborted_issue_retried(guard, monkeypatch):
+    repo = ("owner", "repo")
+    issues = {repo: [{"number": 1, "title": "Issue 1", "body": EVIL, "labels": [],
+                      "updated_at": "2017-01-01T00:00:00Z"}]}
+    with FakeGitHub(issues) as github:
+        monkeypatch.setattr(settings, "API_URL", github.url)
+        monkeypatch.setitem(settings.config, "scope", ["issue_body"])
+        monkeypatch.setitem(settings.config, "rules", RuleSet(RULES, guard=guard))
+        monkeypatch.setitem(settings.config, "fallback_label", "wontfix")
+        engine.label_batcher.clear()
+        cursors = CursorStore()
+        engine.poll_repository(get_session("token"), repo, cursors)
+    # the labels found are added, the fallback label isn't
+    assert sorted(label["name"] for label in issues[repo][0]["labels"]) == \
+        ["bug", "docs", "question"]
+    # the cursor didn't move, the next poll evaluates the issue again
+    assert not cursors.get(repo)
+    assert not cursors.is_processed(repo, issues[repo][0])
+
+
+def test_issue_exhausting_budget_given_up(monkeypatch, capsys):
+    guard = RuleGuard(timeout=30, budget=0.5, quarantine_after=2, processes=1)
+    repo = ("owner", "repo")
+    issues = {repo: [{"number": 1, "title": "Issue 1", "body": EVIL, "labels": [],
+                      "updated_at": "2017-01-01T00:00:00Z"}]}
+    try:
+        with FakeGitHub(issues) as github:
+            monkeypatch.setattr(settings, "API_URL", github.url)
+            monkeypatch.setitem(settings.config, "scope", ["issue_body"])
+            monkeypatch.setitem(settings.config, "rules", RuleSet(RULES, guard=guard))
+            monkeypatch.setitem(settings.config, "fallback_label", "wontfix")
+            engine.label_batcher.clear()
+            cursors = CursorStore()
+            engine.poll_repository(get_session("token"), repo, cursors)
+            assert not cursors.get(repo)
+            # no rule is to blame, the second poll in a row gives the issue up
+            engine.poll_repository(get_session("token"), repo, cursors)
+    finally:
+        while not guard.idle.empty():
+            guard.idle.get().kill()
+    # the labels found are the answer, the fallback label isn't added
+    assert cursors.is_processed(repo, issues[repo][0])
+    assert [label["name"] for label in issues[repo][0]["labels"]] == ["bug"]
+    stats = guard.stats()
+    assert (stats["timeouts"], stats["exhausted"], stats["given_up"]) == (0, 2, 1)
+    assert "Giving up on issue #1" in capsys.readouterr().out
+
+
+def test_budget():
+    assert Budget(0).remaining() == float("inf")
+    assert 0 < Budget(1).remaining() <= 1
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+import pytest
+
+# generous, the benchmark catches heavy imports sneaking in, not noise
+IMPORT_TIME_BUDGET = float(os.getenv("IMPORT_TIME_BUDGET", 1.0))
+
+
+def import_times(module):
+    """Cumulative import time in seconds of every module imported by
+    ``python -X importtime -c 'import module'``"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        if not fields[1].strip().isdigit():
+            continue
+        times[fields[2].strip()] = int(fields[1]) / 1e6
+    return times
+
+
+@pytest.mark.parametrize("module", ["pygithublabeler.cli", "pygithublabeler.engine"])
+def test_console_does_not_import_flask(module):
+    times = import_times(module)
+    assert module in times
+    assert not [name for name in times if name.split(".")[0] in ("flask", "werkzeug", "jinja2")]
+
+
+def test_import_time():
+    cli = import_times("pygithublabeler.cli")["pygithublabeler.cli"]
+    web = import_times("pygithublabeler.web")["pygithublabeler.web"]
+    assert cli < IMPORT_TIME_BUDGET, "import time: cli {:.3f}s, web {:.3f}s".format(cli, web)
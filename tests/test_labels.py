@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import threading
+import time
+import pytest
+from pygithublabeler.labels import LabelBatcher
+
+REPO = ("owner", "repo")
+
+
+class Sender(object):
+    def __init__(self, delay=0, fail=0):
+        self.calls = []
+        self.delay = delay
+        self.fail = fail
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def __call__(self, session, repo, issue, labels):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+            self.calls.append((repo, issue, set(labels)))
+            if self.fail > 0:
+                self.fail -= 1
+                raise IOError("failed")
+        return [{"name": label} for label in labels]
+
+
+def test_batcher_skips_known_labels():
+    send = Sender()
+    batcher = LabelBatcher(send)
+    assert batcher.add(None, REPO, 1, {"bug", "question"}, ["bug"]) == {"question"}
+    # an older copy of the issue doesn't know about the question label yet
+    assert batcher.add(None, REPO, 1, {"question"}, ["bug"]) == set()
+    assert batcher.add(None, REPO, 1, set(), []) == set()
+    assert send.calls == [(REPO, 1, {"question"})]
+    stats = batcher.stats()
+    assert (stats["requests"], stats["sent"], stats["skipped"]) == (1, 1, 2)
+
+
+def test_batcher_ttl():
+    send = Sender()
+    batcher = LabelBatcher(send, ttl=0.05)
+    batcher.add(None, REPO, 1, {"bug"}, [])
+    time.sleep(0.06)
+    # the label was removed meanwhile
+    assert batcher.add(None, REPO, 1, {"bug"}, []) == {"bug"}
+    assert len(send.calls) == 2
+
+
+def test_batcher_skips_labels_in_flight():
+    send = Sender(delay=0.1)
+    batcher = LabelBatcher(send)
+    thread = threading.Thread(target=batcher.add, args=(None, REPO, 1, {"bug"}, []))
+    thread.start()
+    time.sleep(0.05)
+    assert batcher.add(None, REPO, 1, {"bug"}, []) == set()
+    thread.join()
+    assert len(send.calls) == 1
+
+
+def test_batcher_sync_failure():
+    batcher = LabelBatcher(Sender(fail=1))
+    with pytest.raises(IOError):
+        batcher.add(None, REPO, 1, {"bug"}, [])
+    # nothing is known about the label, it is sent again
+    assert batcher.add(None, REPO, 1, {"bug"}, []) == {"bug"}
+    assert batcher.stats()["failed"] == 1
+
+
+def test_batcher_write_behind():
+    send = Sender(delay=0.05)
+    batcher = LabelBatcher(send, interval=60, workers=2)
+    for issue in range(1, 6):
+        batcher.add(None, REPO, issue, {"bug"}, [])
+        batcher.add(None, REPO, issue, {"bug", "question"}, [])
+    assert send.calls == []
+    assert batcher.stats()["pending"] == 10
+
+    batcher.flush()
+    # one request per issue, at most two at a time
+    assert sorted(send.calls) == [(REPO, issue, {"bug", "question"}) for issue in range(1, 6)]
+    assert send.max_running == 2
+    assert batcher.stats()["pending"] == 0
+    assert batcher.add(None, REPO, 1, {"bug"}, []) == set()
+
+
+def test_batcher_write_behind_flushes_periodically():
+    send = Sender()
+    batcher = LabelBatcher(send, interval=0.05)
+    batcher.add(None, REPO, 1, {"bug"}, [])
+    deadline = time.time() + 2
+    while not send.calls and time.time() < deadline:
+        time.sleep(0.01)
+    assert send.calls == [(REPO, 1, {"bug"})]
+
+
+def test_batcher_write_behind_retries():
+    send = Sender(fail=3)
+    batcher = LabelBatcher(send, interval=60, retries=1)
+    batcher.add(None, REPO, 1, {"bug"}, [])
+    batcher.add(None, REPO, 2, {"bug"}, [])
+    batcher.flush()
+    assert batcher.stats()["pending"] == 2
+    batcher.flush()
+    # the third failure was the last retry of one issue, the other one succeeded
+    stats = batcher.stats()
+    assert (stats["pending"], stats["dropped"], stats["failed"], stats["sent"]) == (0, 1, 3, 1)
+
+
+def test_batcher_settle():
+    send = Sender()
+
+    def failing(session, repo, issue, labels):
+        if issue == 2:
+            raise IOError("failed")
+        return send(session, repo, issue, labels)
+    batcher = LabelBatcher(failing, interval=60, retries=1)
+    for issue in [1, 2, 3]:
+        batcher.add(None, REPO, issue, {"bug"}, [])
+    assert batcher.settle(REPO, [1, 2]) == {2}
+    assert sorted(call[1] for call in send.calls) == [1, 3]
+    stats = batcher.stats()
+    assert (stats["pending"], stats["dropped"], stats["failed"]) == (0, 1, 2)
+    # the dropped labels are reported once
+    assert batcher.settle(REPO, [2]) == set()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import pytest
+import requests
+from pygithublabeler import loadtest, settings, web
+from pygithublabeler.fakegithub import FakeGitHub
+
+CASSETTES = os.path.join(os.path.dirname(__file__), "fixtures", "cassettes")
+TEST_REPOSITORY = ("slowbackspace", "testrepo")
+RULES = os.path.join(os.path.dirname(__file__), os.pardir, "rules.yml")
+
+
+@pytest.fixture
+def labeler_state(monkeypatch):
+    # the harness reconfigures the labeler, keep it from leaking into other tests
+    monkeypatch.setattr(settings, "API_URL", settings.API_URL)
+    for key in ["rules", "scope", "fallback_label", "transport", "breaker", "session"]:
+        monkeypatch.setitem(settings.config, key, settings.config.get(key))
+    for key in ["webhook_token", "hook_workers"]:
+        monkeypatch.setitem(web.app.config, key, web.app.config[key])
+    web.delivery_cache.clear()
+
+
+def test_from_cassettes():
+    github = FakeGitHub.from_cassettes(CASSETTES)
+    issues = github.issues[TEST_REPOSITORY]
+    assert len(issues) == 19
+    assert any(issue["labels"] for issue in issues)
+    assert len(github.comments[TEST_REPOSITORY + (2,)]) > 0
+
+    github = FakeGitHub.from_cassettes(CASSETTES, copies=3, keep_labels=False)
+    issues = github.issues[TEST_REPOSITORY]
+    assert len(issues) == 57
+    assert len(set(issue["number"] for issue in issues)) == 57
+    assert not any(issue["labels"] for issue in issues)
+    assert github.comments[TEST_REPOSITORY + (22,)] == github.comments[TEST_REPOSITORY + (2,)]
+
+
+def test_injected_errors_and_rate_limit():
+    with FakeGitHub(error_rate=1) as github:
+        assert requests.get(github.url + "/repos/a/b/issues").status_code == 502
+        assert github.stats()["errors"] == 1
+
+    with FakeGitHub({("a", "b"): []}, rate_limit=2) as github:
+        url = github.url + "/repos/a/b/issues"
+        r = requests.get(url)
+        assert r.status_code == 200 and r.headers["X-RateLimit-Remaining"] == "1"
+        requests.get(url)
+        r = requests.get(url)
+        assert r.status_code == 403 and r.headers["X-RateLimit-Remaining"] == "0"
+        stats = github.stats()
+        assert stats["rate_limited"] == 1 and stats["calls"] == {"GET issues": 3}
+
+
+def test_run_webhooks(labeler_state):
+    with FakeGitHub.from_cassettes(CASSETTES, keep_labels=False) as github:
+        report = loadtest.run_webhooks(github, count=20, concurrency=2, hook_workers=0,
+                                       rules=RULES)
+    assert report["count"] == 20 and report["statuses"] == {"200": 20}
+    assert report["p50"] <= report["p99"] <= report["max"]
+    assert report["github"]["calls"]["POST labels"] > 0
+    assert "20 webhooks" in loadtest.format_report(report)[0]
+
+
+def test_run_console(labeler_state):
+    with FakeGitHub.from_cassettes(CASSETTES, keep_labels=False, latency=0.001) as github:
+        report = loadtest.run_console(github, cycles=2, workers=2, rules=RULES)
+    assert report["count"] == 2 and report["issues"] == 19
+    calls = report["github"]["calls"]
+    assert calls["GET issues"] == 2
+    # every issue is labelled by the first cycle
+    assert calls["POST labels"] == 19
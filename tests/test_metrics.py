@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+import threading
+import pytest
+from pygithublabeler import engine, metrics, settings
+from pygithublabeler.fakegithub import FakeGitHub
+from pygithublabeler.github import Transport, endpoint, get_session
+from pygithublabeler.labels import LabelBatcher
+from pygithublabeler.rules import RuleSet
+
+
+@pytest.fixture
+def registry():
+    metrics.registry.reset()
+    yield metrics.registry
+    metrics.registry.reset()
+
+
+def values(metric):
+    return dict(metric.values)
+
+
+def test_render():
+    registry = metrics.Registry()
+    counter = registry.counter("things_total", "Things", ["kind"])
+    histogram = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+    counter.inc(kind='a "quoted"\nthing')
+    counter.inc(2, kind='a "quoted"\nthing')
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    assert registry.render().splitlines() == [
+        "# HELP things_total Things",
+        "# TYPE things_total counter",
+        'things_total{kind="a \\"quoted\\"\\nthing"} 3.0',
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 1.0',
+        'latency_seconds_bucket{le="1.0"} 2.0',
+        'latency_seconds_bucket{le="+Inf"} 3.0',
+        "latency_seconds_sum 5.55",
+        "latency_seconds_count 3.0",
+    ]
+
+
+def test_summary():
+    registry = metrics.Registry()
+    registry.counter("things_total", "Things").inc(3)
+    histogram = registry.histogram("latency_seconds", "Latency", ["path"], buckets=(0.01, 0.1))
+    for _ in range(99):
+        histogram.observe(0.002, path="/hook")
+    histogram.observe(0.05, path="/hook")
+    assert registry.summary() == [
+        "things_total 3",
+        'latency_seconds{path="/hook"} count 100 avg 2.5 ms p99 <= 10 ms',
+    ]
+
+
+def test_processes_add_up(tmpdir):
+    directory = str(tmpdir)
+    worker = metrics.Registry(directory)
+    worker.counter("things_total", "Things", ["kind"]).inc(2, kind="a")
+    worker.histogram("latency_seconds", "Latency", buckets=(1,)).observe(0.5)
+    worker.write()
+    # pretend the snapshot comes from another worker, which is still running
+    os.rename(worker._filename(), tmpdir.join("metrics-1-token.json"))
+    tmpdir.join("metrics-1-broken.json").write("{broken")
+
+    scraped = metrics.Registry(directory)
+    scraped.counter("things_total", "Things", ["kind"]).inc(kind="a")
+    scraped.histogram("latency_seconds", "Latency", buckets=(1,)).observe(2)
+    lines = scraped.render().splitlines()
+    assert 'things_total{kind="a"} 3.0' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 1.0' in lines
+    assert "latency_seconds_count 2.0" in lines
+    assert os.path.basename(scraped._filename()) in os.listdir(directory)
+
+
+def exited_pid():
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    return process.pid
+
+
+def test_exited_processes_folded(tmpdir):
+    directory = str(tmpdir)
+    for token in ["first", "second"]:
+        # two workers which got the same pid, one after the other
+        worker = metrics.Registry(directory)
+        worker.counter("things_total", "Things").inc(2)
+        worker.write()
+        os.rename(worker._filename(), tmpdir.join("metrics-{}-{}.json".format(exited_pid(), token)))
+
+    scraped = metrics.Registry(directory)
+    scraped.counter("things_total", "Things").inc()
+    assert "things_total 5.0" in scraped.render().splitlines()
+    assert sorted(os.listdir(directory)) == sorted([
+        "metrics-aggregate.json", "metrics.lock", os.path.basename(scraped._filename())])
+    # nothing is counted twice
+    assert "things_total 5.0" in scraped.render().splitlines()
+
+    # the next exited worker is added to the aggregate
+    worker = metrics.Registry(directory)
+    worker.counter("things_total", "Things").inc()
+    worker.write()
+    os.rename(worker._filename(), tmpdir.join("metrics-{}-third.json".format(exited_pid())))
+    assert "things_total 6.0" in scraped.render().splitlines()
+
+
+def test_forked_process_forgets_values():
+    registry = metrics.Registry()
+    counter = registry.counter("things_total", "Things")
+    counter.inc()
+    registry.ensure_started()
+    assert values(counter) == {(): 1}
+    # as if ensure_started ran in a child process
+    registry.started_pid = None
+    registry.pid = -1
+    registry.ensure_started()
+    assert values(counter) == {}
+
+
+def test_reporter():
+    registry = metrics.Registry()
+    registry.counter("things_total", "Things").inc()
+    lines = []
+    metrics.Reporter(registry, write=lines.append).report()
+    assert lines == ["things_total 1"]
+
+
+def test_endpoint():
+    assert endpoint("https://api.github.com/repos/a/b/issues/12/labels") == \
+        "/repos/{owner}/{repo}/issues/{number}/labels"
+    assert endpoint("https://api.github.com/repos/a/b/issues?page=2") == "/repos/{owner}/{repo}/issues"
+    assert endpoint("https://api.github.com/graphql") == "/graphql"
+
+
+def test_github_requests(registry):
+    issues = {("owner", "repo"): [{"number": 1, "body": "", "labels": []}]}
+    with FakeGitHub(issues) as github:
+        session = get_session("token", transport=Transport(retries=1, backoff=0))
+        github.fail(status=502, times=1)
+        session.get(github.url + "/repos/owner/repo/issues")
+        session.post(github.url + "/repos/owner/repo/issues/1/labels", data='["bug"]')
+    labels = ("GET", "/repos/{owner}/{repo}/issues", "200")
+    assert sum(values(metrics.github_seconds)[labels][:-1]) == 1
+    assert ("POST", "/repos/{owner}/{repo}/issues/{number}/labels", "200") in \
+        values(metrics.github_seconds)
+    assert values(metrics.github_retries) == {("GET", "/repos/{owner}/{repo}/issues", "502"): 1}
+
+
+def test_labels_applied_and_skipped(registry):
+    batcher = LabelBatcher(lambda *args: None)
+    batcher.add(None, ("owner", "repo"), 1, {"bug", "question"}, ["bug"])
+    assert values(metrics.labels) == {("applied",): 1, ("skipped",): 1}
+
+
+def test_rule_metrics(registry, monkeypatch):
+    rules = RuleSet([{"pattern": "robot:bug", "label": "bug"},
+                     {"pattern": "(robot):(question)", "label": "question"}])
+    monkeypatch.setitem(settings.config, "rules", rules)
+    engine.check_rules(rules, ["robot:bug robot:question"], [], "wontfix")
+    engine.check_rules(rules, ["nothing"], [], "wontfix")
+    metrics.registry.snapshot()
+
+    assert sum(values(metrics.rules_seconds)[()][:-1]) == 2
+    question = ("question", "(robot):(question)")
+    # the prefilter skipped the regex for the second text
+    assert values(metrics.rule_evaluations) == {question: 1}
+    assert values(metrics.rule_matches) == {("bug", "robot:bug"): 1, question: 1}
+    assert metrics.rule_seconds.values[question] > 0
+    # only the changes are counted again
+    metrics.registry.snapshot()
+    assert values(metrics.rule_evaluations) == {question: 1}
+
+
+def test_rule_stats_taken_once():
+    rules = RuleSet([{"pattern": "(robot):(question)", "label": "question"}])
+    for i in range(1000):
+        rules.evaluate("robot:question")
+    taken = []
+
+    def take():
+        for i in range(100):
+            taken.extend(evaluations for rule, evaluations, hits, seconds in rules.take_stats())
+    threads = [threading.Thread(target=take) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for i in range(1000):
+        rules.evaluate("robot:question")
+    for thread in threads:
+        thread.join()
+    taken.extend(evaluations for rule, evaluations, hits, seconds in rules.take_stats())
+    # concurrent collectors never count the same evaluations twice
+    assert sum(taken) == 2000
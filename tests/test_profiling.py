@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from click.testing import CliRunner
+from pygithublabeler import cli, settings
+from pygithublabeler.profiling import RuleProfiler, format_report
+from pygithublabeler.rules import RuleSet
+
+RULES = [
+    {"pattern": "robot:bug", "label": "bug"},
+    {"pattern": "robot:q[a-z]+", "label": "question"},
+    {"pattern": "(robot):(docs)", "label": "docs"},
+    {"pattern": "(?:a|aa)+$", "label": "slow"},
+]
+# backtracks exponentially in the last rule
+SLOW_TEXT = "robot:bug " + "a" * 22 + "!"
+
+
+def test_profile_ranks_and_flags_slow_rule(capsys):
+    profiler = RuleProfiler(1, check_every=10)
+    rules = RuleSet(RULES, profiler=profiler)
+    for _ in range(10):
+        assert rules.decide([SLOW_TEXT], []) == (True, {"bug"})
+
+    report = profiler.report(rules)
+    assert [entry["label"] for entry in report][0] == "slow"
+    slow, others = report[0], report[1:]
+    assert slow["slow"] and slow["kind"] == "standalone" and slow["samples"] == 10
+    assert not any(entry["slow"] for entry in others)
+    assert [entry["hit_rate"] for entry in report if entry["label"] == "bug"] == [1.0]
+    assert abs(sum(entry["share"] for entry in report) - 1) < 1e-9
+    # printed once, by the check after the tenth sample
+    assert capsys.readouterr().out.count("Slow rule slow") == 1
+    assert profiler.check(rules) == []
+
+    lines = format_report(report)
+    assert len(lines) == 5 and lines[1].endswith("SLOW")
+
+
+def test_profile_sampling():
+    profiler = RuleProfiler(0.1, seed=1)
+    rules = RuleSet(RULES, profiler=profiler)
+    for i in range(1000):
+        rules.decide(["robot:bug {}".format(i)], [])
+    assert 50 < profiler.stats()["samples"] < 150
+
+
+def test_profile_reports_rules_in_use():
+    profiler = RuleProfiler(1)
+    profiler.profile(RuleSet(RULES), "robot:bug")
+    assert len(profiler.report()) == 4
+    assert len(profiler.report(RuleSet(RULES[:2]))) == 2
+    profiler.clear()
+    assert profiler.report() == [] and profiler.stats()["samples"] == 0
+
+
+def test_swap_rules_keeps_profiler(monkeypatch):
+    profiler = RuleProfiler(1)
+    monkeypatch.setitem(settings.config, "rule_profiler", profiler)
+    monkeypatch.setitem(settings.config, "rules", None)
+    settings.swap_rules(RuleSet(RULES))
+    assert settings.config["rules"].profiler is profiler
+
+
+def test_profile_cli(tmpdir, monkeypatch):
+    monkeypatch.setattr(settings, "config", {})
+    tmpdir.join("auth.cfg").write("[github]\ntoken = token\n")
+    tmpdir.join("rules.yml").write("".join("- pattern: '{pattern}'\n  label: {label}\n".format(**rule)
+                                           for rule in RULES))
+    tmpdir.join("issue.txt").write(SLOW_TEXT)
+    result = CliRunner().invoke(cli.cli, [
+        "--authconfig", str(tmpdir.join("auth.cfg")), "--rules", str(tmpdir.join("rules.yml")),
+        "--rules-reload", "0", "profile", "--repeat", "10", str(tmpdir.join("issue.txt"))])
+    assert result.exit_code == 0, result.output
+    lines = result.output.splitlines()
+    assert len(lines) == 5
+    assert "'(?:a|aa)+$' (standalone)  SLOW" in lines[1]
@@ -3,9 +3,15 @@
 from io import StringIO
 import os
 import json
+import threading
+import time
 import pytest
 import betamax
 import pygithublabeler.run as pygithublabeler
+from pygithublabeler import engine, settings, web
+from pygithublabeler.github import CircuitBreaker, CircuitOpenError
+from pygithublabeler.profiling import RuleProfiler
+from pygithublabeler.worker import Coalescer
 
 TEST_REPOSITORY = ("slowbackspace", "testrepo")  # Repository in (owner, name) format
 TEST_REPO_FULL = "{}/{}".format(TEST_REPOSITORY[0], TEST_REPOSITORY[1])
@@ -32,7 +38,8 @@ with betamax.Betamax.configure() as config:
 @pytest.fixture
 def testapp():
     pygithublabeler.app.config['TESTING'] = True
-    pygithublabeler.app.config['scope'] = ["all"]
+    settings.config['scope'] = ["all"]
+    engine.label_batcher.clear()
     return pygithublabeler.app.test_client()
 
 
@@ -58,7 +65,9 @@ def testapp_with_session(betamax_session, tmpdir):
                                         repo=TEST_REPO_FULL,
                                         rules=str(rulescfg))
     session = pygithublabeler.get_session(TOKEN, betamax_session)
-    pygithublabeler.app.config['session'] = session
+    settings.config['session'] = session
+    pygithublabeler.delivery_cache.clear()
+    engine.label_batcher.clear()
     return pygithublabeler.app.test_client()
 
 
@@ -66,14 +75,14 @@ def test_fetch_issues(betamax_session):
     session = pygithublabeler.get_session(TOKEN, betamax_session)
     issues = pygithublabeler.fetch_issues(session, 
                                           TEST_REPOSITORY)
-    assert issues[0].get("number", None) is not None
+    assert next(issues).get("number", None) is not None
 
 
 def test_fetch_comments(betamax_session):
     session = pygithublabeler.get_session(TOKEN, betamax_session)
     comments = pygithublabeler.fetch_comments(session, 
                                           TEST_REPOSITORY, 2)
-    assert comments[0].get("body", None) is not None
+    assert next(comments).get("body", None) is not None
 
 
 def test_add_labels(betamax_session):
@@ -111,7 +120,9 @@ def test_hook_post(testapp_with_session, betamax_session):
     assert r.status_code == 400 and "Invalid requests" in res_content
 
 
-def test_hook_post_fake_issue(testapp_with_session):
+@pytest.mark.parametrize(["hook_workers", "status_code"], [(0, 200), (2, 202)])
+def test_hook_post_fake_issue(testapp_with_session, hook_workers, status_code):
+    pygithublabeler.app.config["hook_workers"] = hook_workers
     # fake issue
     data = {
         "action": "opened", 
@@ -122,6 +133,243 @@ def test_hook_post_fake_issue(testapp_with_session):
         },
         "repository": {"full_name": TEST_REPO_FULL}
         }
+    processed = pygithublabeler.hook_queue.stats()["processed"]
     r = testapp_with_session.post('/hook', data=json.dumps(data), content_type="application/json")
     res_content = r.data.decode('utf-8')
-    assert r.status_code == 200 and "bug" in res_content
\ No newline at end of file
+    assert r.status_code == status_code
+    if hook_workers == 0:
+        assert "bug" in res_content
+    else:
+        pygithublabeler.hook_queue.join()
+        stats = pygithublabeler.hook_queue.stats()
+        assert stats["processed"] == processed + 1 and stats["failed"] == 0
+
+
+def test_hook_post_duplicate_delivery(testapp, monkeypatch):
+    monkeypatch.setitem(pygithublabeler.app.config, "hook_workers", 0)
+    monkeypatch.setitem(settings.config, "rules", pygithublabeler.RuleSet(
+        [{"pattern": "robot:bug", "label": "bug"}]))
+    monkeypatch.setitem(settings.config, "fallback_label", "wontfix")
+    monkeypatch.setitem(settings.config, "session", None)
+    monkeypatch.setitem(settings.config, "scope", ["issue_body"])
+    pygithublabeler.delivery_cache.clear()
+    calls = []
+    monkeypatch.setattr(engine, "add_labels", lambda *args: calls.append(args))
+    data = {
+        "action": "edited",
+        "issue": {"number": TEST_ISSUE, "labels": [], "body": "robot:bug"},
+        "repository": {"full_name": TEST_REPO_FULL}
+        }
+
+    def post(delivery, data):
+        return testapp.post('/hook', data=json.dumps(data), content_type="application/json",
+                            headers={"X-GitHub-Delivery": delivery})
+
+    assert post("1", data).status_code == 200
+    # redelivery and the same content in another delivery
+    assert post("1", data).data.decode('utf-8') == "Duplicate delivery"
+    assert post("2", data).data.decode('utf-8') == "Duplicate delivery"
+    data["issue"]["body"] = "robot:question"
+    assert post("3", data).status_code == 200
+    assert len(calls) == 2
+    # the same content is labelled again after the rules are reloaded
+    monkeypatch.setitem(settings.config, "rules", pygithublabeler.RuleSet(
+        [{"pattern": "robot:question", "label": "question"}]))
+    assert post("4", data).status_code == 200
+    assert len(calls) == 3
+
+
+def test_hook_post_coalesced(testapp, monkeypatch):
+    monkeypatch.setitem(pygithublabeler.app.config, "hook_workers", 2)
+    monkeypatch.setitem(settings.config, "rules", pygithublabeler.RuleSet(
+        [{"pattern": "robot:bug", "label": "bug"}, {"pattern": "robot:question", "label": "question"}]))
+    monkeypatch.setitem(settings.config, "fallback_label", "wontfix")
+    monkeypatch.setitem(settings.config, "session", None)
+    monkeypatch.setitem(settings.config, "scope", ["issue_body", "issue_comments"])
+    coalescer = Coalescer(pygithublabeler.enqueue_job, pygithublabeler.merge_jobs, window=60)
+    monkeypatch.setattr(web, "coalescer", coalescer)
+    pygithublabeler.delivery_cache.clear()
+    calls = []
+    monkeypatch.setattr(engine, "add_labels", lambda *args: calls.append(args))
+
+    issue = {"number": TEST_ISSUE, "labels": [], "body": "robot:bug"}
+    for body in ["robot:question", "me too"]:
+        data = {"action": "created", "issue": issue, "comment": {"body": body},
+                "repository": {"full_name": TEST_REPO_FULL}}
+        r = testapp.post('/hook', data=json.dumps(data), content_type="application/json")
+        assert r.status_code == 202
+    coalescer.flush()
+    pygithublabeler.hook_queue.join()
+
+    assert len(calls) == 1
+    assert calls[0][3] == {"bug", "question"}
+    assert coalescer.stats()["coalesced"] == 1
+
+
+def test_hook_post_circuit_open(testapp, monkeypatch):
+    breaker = CircuitBreaker(failures=1, reset_timeout=60)
+    breaker.record(False)
+    monkeypatch.setitem(settings.config, "breaker", breaker)
+    monkeypatch.setitem(settings.config, "scope", ["issue_body"])
+    monkeypatch.setitem(settings.config, "rules",
+                        pygithublabeler.RuleSet([{"pattern": "robot:bug", "label": "bug"}]))
+    monkeypatch.setitem(settings.config, "fallback_label", "wontfix")
+    monkeypatch.setitem(pygithublabeler.app.config, "hook_workers", 1)
+    monkeypatch.setattr(web, "coalescer", None)
+    pygithublabeler.delivery_cache.clear()
+    calls = []
+    monkeypatch.setattr(engine, "add_labels", lambda *args: calls.append(args))
+    data = {"action": "opened", "issue": {"number": TEST_ISSUE, "labels": [], "body": "robot:bug"},
+            "repository": {"full_name": TEST_REPO_FULL}}
+    r = testapp.post('/hook', data=json.dumps(data), content_type="application/json")
+    # the event is held, GitHub wouldn't deliver it again
+    assert r.status_code == 202
+    stats = json.loads(testapp.get('/status').data.decode('utf-8'))
+    assert stats["github"]["open"]
+    time.sleep(0.2)
+    assert calls == []
+
+    breaker.record(True)
+    pygithublabeler.hook_queue.join()
+    assert [call[3] for call in calls] == [{"bug"}]
+
+
+def test_hook_post_circuit_open_without_workers(testapp, monkeypatch):
+    breaker = CircuitBreaker(failures=1, reset_timeout=60)
+    breaker.record(False)
+    monkeypatch.setitem(settings.config, "breaker", breaker)
+    monkeypatch.setitem(settings.config, "scope", ["issue_body"])
+    monkeypatch.setitem(pygithublabeler.app.config, "hook_workers", 0)
+    pygithublabeler.delivery_cache.clear()
+    monkeypatch.setattr(engine, "add_labels", lambda *args: pytest.fail("GitHub called"))
+    data = {"action": "opened", "issue": {"number": TEST_ISSUE, "labels": [], "body": "robot:bug"},
+            "repository": {"full_name": TEST_REPO_FULL}}
+    r = testapp.post('/hook', data=json.dumps(data), content_type="application/json")
+    assert r.status_code == 503
+    assert int(r.headers["Retry-After"]) > 0
+
+
+def test_label_issue_retries_while_circuit_open(monkeypatch):
+    breaker = CircuitBreaker(failures=1, reset_timeout=0.01)
+    breaker.record(False)
+    monkeypatch.setitem(settings.config, "breaker", breaker)
+    monkeypatch.setitem(settings.config, "rules",
+                        pygithublabeler.RuleSet([{"pattern": "robot:bug", "label": "bug"}]))
+    monkeypatch.setitem(settings.config, "fallback_label", "wontfix")
+    engine.label_batcher.clear()
+    calls = []
+
+    def add_labels(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            # the trial request fails, the circuit opens again
+            breaker.record(False)
+            raise CircuitOpenError("GitHub is failing")
+    monkeypatch.setattr(engine, "add_labels", add_labels)
+    job = {"repo": TEST_REPOSITORY, "issue": TEST_ISSUE, "current_labels": [],
+           "searched_content": ["robot:bug"], "delivery_keys": []}
+    assert web.label_issue(job) == {"bug"}
+    assert len(calls) == 2
+
+
+def test_label_issue_waits_for_trial_request(monkeypatch):
+    breaker = CircuitBreaker(failures=1, reset_timeout=0.01)
+    breaker.record(False)
+    time.sleep(0.02)
+    # another request holds the half-open trial
+    assert breaker.allow()
+    monkeypatch.setitem(settings.config, "breaker", breaker)
+    monkeypatch.setitem(settings.config, "session", None)
+    monkeypatch.setitem(settings.config, "rules",
+                        pygithublabeler.RuleSet([{"pattern": "robot:bug", "label": "bug"}]))
+    monkeypatch.setitem(settings.config, "fallback_label", "wontfix")
+    engine.label_batcher.clear()
+    calls = []
+
+    def add_labels(*args):
+        calls.append(args)
+        if not breaker.allow():
+            raise CircuitOpenError("GitHub is failing")
+    monkeypatch.setattr(engine, "add_labels", add_labels)
+    timer = threading.Timer(0.3, breaker.record, [True])
+    timer.start()
+    job = {"repo": TEST_REPOSITORY, "issue": TEST_ISSUE, "current_labels": [],
+           "searched_content": ["robot:bug"], "delivery_keys": []}
+    assert web.label_issue(job) == {"bug"}
+    timer.join()
+    # nothing was sent until the trial request succeeded
+    assert len(calls) == 1
+
+
+def test_create_app(tmpdir, monkeypatch):
+    authcfg = tmpdir.join("auth.cfg")
+    authcfg.write("[github]\ntoken = {}\n".format(TOKEN))
+    rulescfg = tmpdir.join("rules.yml")
+    rulescfg.write("- pattern: robot:bug\n  label: bug\n")
+    monkeypatch.setitem(settings.config, "session", None)
+    monkeypatch.setitem(pygithublabeler.app.config, "hook_workers", 0)
+    monkeypatch.setenv("LABELER_AUTHCONFIG", str(authcfg))
+    monkeypatch.setenv("LABELER_RULES", str(rulescfg))
+    app = pygithublabeler.create_app(freeze=False)
+    assert app.config["startup_time"] > 0
+    assert settings.config["rules"].match("robot:bug") == {"bug"}
+
+    # the first request doesn't load anything
+    def load_rules(filename):
+        raise AssertionError("rules loaded by a request")
+    monkeypatch.setattr(settings, "load_rules", load_rules)
+    monkeypatch.setattr(engine, "add_labels", lambda *args: None)
+    pygithublabeler.delivery_cache.clear()
+    client = app.test_client()
+    data = {"action": "opened", "issue": {"number": TEST_ISSUE, "labels": [], "body": "robot:bug"},
+            "repository": {"full_name": TEST_REPO_FULL}}
+    r = client.post('/hook', data=json.dumps(data), content_type="application/json")
+    assert r.status_code == 200 and "bug" in r.data.decode('utf-8')
+    stats = json.loads(client.get('/status').data.decode('utf-8'))
+    assert stats["startup"]["startup_time"] == app.config["startup_time"]
+    assert stats["startup"]["first_request_time"] > 0
+
+
+def test_create_app_bad_configuration(tmpdir):
+    with pytest.raises(pygithublabeler.ConfigurationError):
+        pygithublabeler.create_app(authconfig=str(tmpdir.join("missing.cfg")), freeze=False)
+
+
+def test_hook_not_configured(testapp, monkeypatch):
+    monkeypatch.setitem(settings.config, "scope", None)
+
+    def load_configuration():
+        raise pygithublabeler.ConfigurationError("no configuration")
+    monkeypatch.setattr(settings, "load_configuration", load_configuration)
+    r = testapp.post('/hook', data=json.dumps({"action": "opened"}), content_type="application/json")
+    assert r.status_code == 503
+
+
+def test_status(testapp):
+    stats = json.loads(testapp.get('/status').data.decode('utf-8'))
+    assert stats["queue"]["depth"] == 0
+
+
+def test_metrics(testapp):
+    r = testapp.get('/metrics')
+    assert r.status_code == 200
+    assert r.content_type.startswith("text/plain")
+    lines = r.data.decode("utf-8").splitlines()
+    assert "# TYPE labeler_hook_duration_seconds histogram" in lines
+    assert "# TYPE labeler_labels_total counter" in lines
+
+
+def test_rules_profile(testapp, monkeypatch):
+    monkeypatch.setitem(settings.config, "rule_profiler", None)
+    assert json.loads(testapp.get('/rules/profile').data.decode('utf-8'))["enabled"] is False
+
+    rules = pygithublabeler.RuleSet([{"pattern": "robot:bug", "label": "bug"},
+                                     {"pattern": "robot:question", "label": "question"}])
+    profiler = RuleProfiler(1)
+    profiler.profile(rules, "robot:bug")
+    monkeypatch.setitem(settings.config, "rules", rules)
+    monkeypatch.setitem(settings.config, "rule_profiler", profiler)
+    profile = json.loads(testapp.get('/rules/profile').data.decode('utf-8'))
+    assert profile["stats"]["samples"] == 1
+    assert sorted((rule["label"], rule["hits"]) for rule in profile["rules"]) == \
+        [("bug", 1), ("question", 0)]
@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 from io import StringIO
+import itertools
 import os
+import re
+import time
 import pytest
 import pygithublabeler.run as pygithublabeler
+from pygithublabeler import settings
+from pygithublabeler.rules import MatchMemo, RuleSet, RulesWatcher, extract_literal, strip_wildcards
 
 
 def test_load_rules(tmpdir):
@@ -75,3 +80,276 @@ def test_check_rules_without_rules_text():
     fallback_label = "wontfix"
     match, labels = pygithublabeler.check_rules(rules, text_list, current_labels, fallback_label)
     assert match is False and fallback_label in labels
+
+
+def test_load_rules_compiles_ruleset(tmpdir):
+    p = tmpdir.join("rules.txt")
+    p.write("- pattern: .*robot:bug.*\n"
+            "  label: bug\n")
+
+    rules = pygithublabeler.load_rules(str(p))
+    assert isinstance(rules, RuleSet)
+    assert rules.match("robot:bug") == {"bug"}
+
+
+def test_load_rules_invalid_pattern(tmpdir):
+    p = tmpdir.join("rules.txt")
+    p.write("- pattern: robot:(bug\n"
+            "  label: bug\n")
+
+    with pytest.raises(re.error):
+        pygithublabeler.load_rules(str(p))
+
+
+def test_ruleset_overlapping_matches():
+    rules = RuleSet([{"pattern": ".*robot:bug.*", "label": "bug"},
+                     {"pattern": ".*robot:question.*", "label": "question"}])
+    assert rules.match("robot:bug robot:question") == {"bug", "question"}
+    assert rules.match("robot:question\nrobot:bug") == {"bug", "question"}
+    assert rules.match("nothing here") == set()
+
+
+def test_ruleset_standalone_patterns():
+    rules = RuleSet([{"pattern": "(?i)robot:bug", "label": "bug"},
+                     {"pattern": r"(robot)-\1", "label": "twice"},
+                     {"pattern": "robot:q.estion", "label": "question"}])
+    assert rules.standalone == [0, 1, 2]
+    assert rules.match("ROBOT:BUG robot-robot") == {"bug", "twice"}
+
+
+@pytest.mark.parametrize("pattern", ["^robot", "robot$", "(?<=x)robot", "a|robot", ""])
+def test_ruleset_match_equals_search(pattern):
+    rules = RuleSet([{"pattern": pattern, "label": "l"}])
+    for text in ["robot", "xrobot", "a robot", "b", "robot\n", "\nrobot", ""]:
+        expected = {"l"} if re.search(pattern, text) else set()
+        assert rules.match(text) == expected
+
+
+@pytest.mark.parametrize(["pattern", "expected"], [
+    (".*robot:bug.*", "robot:bug"),
+    (".*?robot:bug.*?", "robot:bug"),
+    (".*.*robot:bug", "robot:bug"),
+    (r"robot:bug\.*", r"robot:bug\.*"),
+    (r"robot:bug\\.*", r"robot:bug\\"),
+    (".*+robot", ".*+robot"),
+    ("^.*robot", "^.*robot"),
+])
+def test_strip_wildcards(pattern, expected):
+    assert strip_wildcards(pattern) == expected
+
+
+@pytest.mark.parametrize(["pattern", "literal", "exact"], [
+    ("robot:bug", "robot:bug", True),
+    (r"robot\.bug", "robot.bug", True),
+    ("robot:b.g", "robot:b", False),
+    (r"\d+ robot:bug", " robot:bug", False),
+    ("ab*cd", "cd", False),
+    ("ab{2}cd", "cd", False),
+    ("x(robot:bug)?y", "x", False),
+    ("robot:bug|robot:question", None, False),
+    ("(?i)robot:bug", None, False),
+    ("[robot]+", None, False),
+])
+def test_extract_literal(pattern, literal, exact):
+    assert extract_literal(pattern, re.compile(pattern).flags) == (literal, exact)
+
+
+@pytest.mark.parametrize(["pattern", "literal", "text"], [
+    (r"\x41bc", "bc", "Abc"),
+    (r"\u0041bc", "bc", "Abc"),
+    (r"\U00000041bc", "bc", "Abc"),
+    (r"\012abc", "abc", "\nabc"),
+    (r"\101bc", "bc", "Abc"),
+    (r"\N{LATIN SMALL LETTER A}bc\d", "bc", "abc1"),
+    (r"(a)\1bc", "bc", "aabc"),
+])
+def test_extract_literal_skips_escape_payload(pattern, literal, text):
+    assert extract_literal(pattern) == (literal, False)
+    assert RuleSet([{"pattern": pattern, "label": "l"}]).match(text) == {"l"}
+
+
+def test_ruleset_prefilters():
+    rules = RuleSet([{"pattern": ".*robot:bug.*", "label": "bug"},
+                     {"pattern": r"robot:q\w+", "label": "question"},
+                     {"pattern": r"(robot)-\1", "label": "twice"}])
+    assert rules.literal == [0]
+    assert rules.prefilters == ["robot:bug", "robot:q", "-"]
+    assert rules.match("robot:bug robot:question robot-robot") == {"bug", "question", "twice"}
+    assert rules.match("robot:q robot-") == set()
+
+
+def test_ruleset_report():
+    rules = RuleSet([{"pattern": ".*robot:bug.*", "label": "bug"},
+                     {"pattern": "robot|bot", "label": "question"}])
+    report = rules.report()
+    assert len(report) == 2
+    assert report[0].startswith("bug '.*robot:bug.*': optimized")
+    assert report[1].startswith("question 'robot|bot': not optimized")
+
+
+def test_ruleset_fingerprint():
+    rules = [{"pattern": "robot:bug", "label": "bug"}]
+    assert RuleSet(rules).fingerprint == RuleSet(rules).fingerprint
+    assert RuleSet(rules).fingerprint != RuleSet([{"pattern": "robot:bug", "label": "x"}]).fingerprint
+
+
+def test_match_memo():
+    memo = MatchMemo()
+    rules = RuleSet([{"pattern": "robot:b.g", "label": "bug"}], memo)
+    assert rules.match("robot:bug") == {"bug"}
+    assert rules.match("robot:bug") == {"bug"}
+    assert rules.match("nothing") == set()
+    assert memo.stats() == {"size": 2, "max_entries": 4096, "hits": 1, "misses": 2}
+
+    # another rule set doesn't see the results
+    other = RuleSet([{"pattern": "robot:b.g", "label": "other"}], memo)
+    assert other.match("robot:bug") == {"other"}
+    assert memo.stats()["misses"] == 3
+
+
+def test_match_memo_eviction_and_ttl(monkeypatch):
+    memo = MatchMemo(max_entries=2, ttl=10)
+    rules = RuleSet([{"pattern": "robot:b.g", "label": "bug"}], memo)
+    for text in ["a", "b", "a", "c"]:
+        rules.match(text)
+    assert memo.stats()["size"] == 2
+    rules.match("b")
+    assert memo.stats()["hits"] == 1
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 20)
+    rules.match("b")
+    assert memo.stats()["hits"] == 1
+
+
+def test_check_rules_memoized():
+    memo = MatchMemo()
+    rules = RuleSet([{"pattern": ".*robot:bug.*", "label": "bug"}], memo)
+    for i in range(3):
+        assert pygithublabeler.check_rules(rules, ["robot:bug"], [], "wontfix") == (True, {"bug"})
+    assert memo.stats()["hits"] == 2
+
+
+DECIDE_RULES = [
+    {"pattern": "robot:bug", "label": "bug"},
+    {"pattern": "robot:(bug|crash)", "label": "bug"},
+    {"pattern": "robot:q[a-z]+", "label": "question"},
+    {"pattern": "(?i)help", "label": "question"},
+    {"pattern": "(robot)-\\1", "label": "twice"},
+    {"pattern": "urgent", "label": "priority"},
+]
+
+
+def reference_check(rules, text_list, current_labels, fallback_label, matched=None):
+    matched = set(matched or ())
+    for text in text_list:
+        for rule in rules:
+            if re.search(rule["pattern"], text):
+                matched.add(rule["label"])
+    labels = set(label for label in matched if label not in current_labels)
+    if not matched and fallback_label not in current_labels:
+        labels.add(fallback_label)
+    return len(matched) > 0, labels
+
+
+@pytest.mark.parametrize("memo", [None, MatchMemo()])
+def test_check_rules_same_as_every_rule_on_every_text(memo):
+    rules = RuleSet(DECIDE_RULES, memo)
+    texts = ["robot:crash", "HELP me", "robot-robot urgent", "nothing", "robot:question"]
+    labels = ["bug", "question", "twice", "priority", "wontfix"]
+    for size in range(3):
+        for text_list in itertools.permutations(texts, size):
+            for current in itertools.combinations(labels, 2):
+                for matched in (None, {"bug"}):
+                    assert pygithublabeler.check_rules(rules, list(text_list), list(current),
+                                                       "wontfix", matched) == \
+                        reference_check(DECIDE_RULES, text_list, current, "wontfix", matched)
+
+
+def test_decide_skips_decided_rules():
+    rules = RuleSet([{"pattern": "(a)b", "label": "ab"}, {"pattern": "(c)d", "label": "cd"}])
+    # the issue has the label, but whether any rule matches is still open
+    assert rules.decide(["ab cd"], ["cd"]) == (True, {"ab"})
+    assert rules.evaluations == [1, 0]
+    # the first text decides everything, the second one isn't searched
+    assert rules.decide(["ab", "cd"], ["cd"], matched={"ab"}) == (True, {"ab"})
+    assert rules.decide(["ab", "cd"], [], matched=None) == (True, {"ab", "cd"})
+    assert rules.evaluations == [2, 1]
+
+
+def test_evaluate_skip_compiles_nothing(monkeypatch):
+    rules = RuleSet([{"pattern": "robot:b[a-z]+", "label": "bug"},
+                     {"pattern": "robot:q[a-z]+", "label": "question"},
+                     {"pattern": "robot:d[a-z]+", "label": "docs"}])
+    compiled = []
+    monkeypatch.setattr(re, "compile", lambda *args: compiled.append(args))
+    text = "robot:bug robot:question robot:docs"
+    for size in range(4):
+        for skip in itertools.combinations(["bug", "question", "docs"], size):
+            assert rules.evaluate(text, skip=set(skip)) == {"bug", "question", "docs"} - set(skip)
+    assert compiled == []
+
+
+def test_decide_orders_rules_by_hit_rate():
+    rules = RuleSet([{"pattern": "(never)", "label": "never"},
+                     {"pattern": "(often)", "label": "often"}])
+    assert rules.order == [0, 1]
+    for i in range(300):
+        rules.evaluate("often")
+    assert rules.order == [1, 0]
+    assert rules.evaluate("often never", skip={"never"}, first=True) == {"often"}
+
+
+def test_decide_memo():
+    memo = MatchMemo()
+    rules = RuleSet(DECIDE_RULES, memo)
+    # a labelled issue is remembered too and hits the memo on its next event
+    assert rules.decide(["robot:bug urgent"], ["bug"]) == (True, {"priority"})
+    assert memo.stats()["size"] == 1
+    assert rules.decide(["robot:bug urgent"], ["bug"]) == (True, {"priority"})
+    assert rules.decide(["robot:bug urgent"], []) == (True, {"bug", "priority"})
+    assert memo.stats()["hits"] == 2
+
+
+def test_rules_watcher(tmpdir):
+    filename = tmpdir.join("rules.yml")
+    filename.write("- pattern: robot:bug\n  label: bug\n")
+    rules = pygithublabeler.load_rules(str(filename))
+    swapped = []
+    watcher = RulesWatcher(str(filename), pygithublabeler.load_rules, swapped.append, rules)
+    assert not watcher.check()
+
+    filename.write("- pattern: robot:bug\n  label: bug\n- pattern: robot:question\n  label: question\n")
+    os.utime(str(filename), (0, 0))
+    assert watcher.check()
+    assert len(swapped) == 1 and swapped[0].match("robot:question") == {"question"}
+    stats = watcher.stats()
+    assert (stats["version"], stats["fingerprint"]) == (2, swapped[0].fingerprint)
+
+    # broken rules keep the current ones
+    filename.write("- pattern: [unclosed\n")
+    assert not watcher.check()
+    assert len(swapped) == 1 and watcher.stats()["error"]
+
+
+def test_rules_reload_in_background(tmpdir, monkeypatch):
+    authcfg = tmpdir.join("auth.cfg")
+    authcfg.write("[github]\ntoken = token\n")
+    filename = tmpdir.join("rules.yml")
+    filename.write("- pattern: robot:bug\n  label: bug\n")
+    # the rules, watcher and memo loaded here don't leak into other tests
+    monkeypatch.setattr(settings, "config", dict(settings.config, session=None))
+    pygithublabeler.load_configuration(str(authcfg), rules=str(filename), rules_reload=0.01)
+    watcher = settings.config["rules_watcher"]
+    try:
+        pygithublabeler.watch_rules()
+        filename.write("- pattern: robot:question\n  label: question\n")
+        os.utime(str(filename), (0, 0))
+        deadline = time.time() + 2
+        while watcher.stats()["version"] == 1 and time.time() < deadline:
+            time.sleep(0.01)
+        rules = settings.config["rules"]
+        assert rules.match("robot:question") == {"question"}
+        assert rules.memo is settings.config["rule_memo"]
+    finally:
+        watcher.stop()
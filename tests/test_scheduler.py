@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import email.utils
+import time
+import pytest
+from pygithublabeler.scheduler import PollScheduler, RateLimitTracker, parse_retry_after
+
+TEST_REPOSITORY = ("owner", "repo")
+URL = "https://api.github.com/repos/owner/repo/issues"
+
+
+def test_tracker_reads_headers():
+    tracker = RateLimitTracker()
+    tracker.update(200, {"X-RateLimit-Remaining": "4999", "X-RateLimit-Reset": "1500000000",
+                         "X-RateLimit-Limit": "5000"}, URL)
+    assert (tracker.remaining, tracker.reset, tracker.limit) == (4999, 1500000000, 5000)
+    assert tracker.blocked_for() == 0
+
+
+def test_tracker_costs():
+    tracker = RateLimitTracker()
+    tracker.update(200, {}, URL)
+    tracker.update(304, {}, URL)
+    tracker.update(200, {}, "https://api.github.com/repos/owner/repo/issues/1/labels")
+    tracker.update(200, {}, "https://api.github.com/repos/owner/other/issues")
+    assert tracker.take_cost(TEST_REPOSITORY) == 2
+    assert tracker.take_cost(TEST_REPOSITORY) == 0
+
+
+def test_tracker_retry_after():
+    tracker = RateLimitTracker()
+    tracker.update(403, {"Retry-After": "30"}, URL)
+    assert 29 < tracker.blocked_for() <= 30
+
+
+def test_tracker_retry_after_date():
+    tracker = RateLimitTracker()
+    tracker.update(429, {"Retry-After": email.utils.formatdate(time.time() + 30, usegmt=True)}, URL)
+    assert 28 < tracker.blocked_for() <= 30
+
+
+def test_tracker_retry_after_unparseable():
+    tracker = RateLimitTracker(backoff=10)
+    tracker.update(429, {"Retry-After": "soon"}, URL)
+    # treated like a refusal without a hint
+    assert 9 < tracker.blocked_for() <= 10
+
+
+@pytest.mark.parametrize(["value", "expected"], [
+    ("120", 120),
+    (" 5 ", 5),
+    ("Wed, 21 Oct 2015 07:28:30 GMT", 30),
+    ("Wed, 21 Oct 2015 07:28:30 -0000", 30),
+    ("Wed, 21 Oct 2015 07:27:00 GMT", 0),
+    ("-1", None),
+    ("soon", None),
+    (None, None),
+])
+def test_parse_retry_after(value, expected):
+    now = email.utils.parsedate_to_datetime("Wed, 21 Oct 2015 07:28:00 GMT").timestamp()
+    assert parse_retry_after(value, now) == expected
+
+
+def test_tracker_exhausted():
+    tracker = RateLimitTracker()
+    reset = int(time.time()) + 100
+    tracker.update(403, {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(reset)}, URL)
+    assert 98 < tracker.blocked_for() <= 100
+
+
+def test_tracker_secondary_limit_backoff():
+    tracker = RateLimitTracker(backoff=10, max_backoff=30)
+    body = "You have exceeded a secondary rate limit."
+    tracker.update(403, {"X-RateLimit-Remaining": "4000"}, URL, body)
+    assert 9 < tracker.blocked_for() <= 10
+    tracker.update(403, {"X-RateLimit-Remaining": "4000"}, URL, body)
+    assert 19 < tracker.blocked_for() <= 20
+    tracker.update(403, {"X-RateLimit-Remaining": "4000"}, URL, body)
+    tracker.update(403, {"X-RateLimit-Remaining": "4000"}, URL, body)
+    assert tracker.backoff == 30
+
+    tracker.update(200, {}, URL)
+    assert tracker.backoff == 10
+
+
+def test_tracker_forbidden_is_not_rate_limit():
+    tracker = RateLimitTracker()
+    tracker.update(403, {"X-RateLimit-Remaining": "4000"}, URL, "Resource not accessible")
+    assert tracker.blocked_for() == 0
+
+
+def test_scheduler_adapts_to_activity():
+    scheduler = PollScheduler(RateLimitTracker(), interval=8, min_interval=2, max_interval=32)
+    assert scheduler.next_delay(TEST_REPOSITORY, 5) == 4
+    assert scheduler.next_delay(TEST_REPOSITORY, 5) == 2
+    assert scheduler.next_delay(TEST_REPOSITORY, 5) == 2
+    assert [scheduler.next_delay(TEST_REPOSITORY, 0) for i in range(5)] == [4, 8, 16, 32, 32]
+    # other repositories are independent
+    assert scheduler.next_delay(("owner", "other"), 0) == 16
+
+
+def test_scheduler_spreads_budget():
+    tracker = RateLimitTracker()
+    scheduler = PollScheduler(tracker, interval=1, min_interval=1, max_interval=1)
+    tracker.update(200, {"X-RateLimit-Remaining": "100",
+                         "X-RateLimit-Reset": str(int(time.time()) + 1000)}, URL)
+    for i in range(9):
+        tracker.update(200, {}, "https://api.github.com/repos/owner/other/issues")
+    scheduler.next_delay(("owner", "other"), 1)
+
+    # 10 requests per round of both repositories, 100 requests left for 1000 seconds
+    assert scheduler.next_delay(TEST_REPOSITORY, 1) == pytest.approx(100, abs=1)
+
+
+def test_scheduler_waits_while_blocked():
+    tracker = RateLimitTracker()
+    scheduler = PollScheduler(tracker, interval=1)
+    tracker.update(429, {"Retry-After": "60"}, URL)
+    assert scheduler.next_delay(TEST_REPOSITORY, 1) > 59
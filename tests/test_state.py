@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+from pygithublabeler.rules import RuleSet
+from pygithublabeler.state import CommentCache, CursorStore, comments_deleted
+
+TEST_REPOSITORY = ("owner", "repo")
+
+
+def test_cursor_store_persists(tmpdir):
+    filename = str(tmpdir.join("state.json"))
+    cursors = CursorStore(filename)
+    assert cursors.get(TEST_REPOSITORY) is None
+
+    cursors.set(TEST_REPOSITORY, "2017-01-01T00:00:00Z")
+    cursors.save()
+    assert json.load(open(filename)) == {"cursors": {"owner/repo": "2017-01-01T00:00:00Z"},
+                                         "seen": {"owner/repo": []}}
+
+    assert CursorStore(filename).get(TEST_REPOSITORY) == "2017-01-01T00:00:00Z"
+
+
+def test_cursor_store_reset(tmpdir):
+    filename = str(tmpdir.join("state.json"))
+    cursors = CursorStore(filename)
+    cursors.set(TEST_REPOSITORY, "2017-01-01T00:00:00Z")
+    cursors.save()
+
+    cursors.reset(TEST_REPOSITORY)
+    cursors.save()
+    assert CursorStore(filename).get(TEST_REPOSITORY) is None
+
+
+def test_cursor_store_in_memory():
+    cursors = CursorStore()
+    cursors.set(TEST_REPOSITORY, "2017-01-01T00:00:00Z")
+    cursors.save()
+    assert cursors.get(TEST_REPOSITORY) == "2017-01-01T00:00:00Z"
+
+
+def issue(number, updated_at):
+    return {"number": number, "updated_at": updated_at}
+
+
+def test_cursor_store_advance():
+    cursors = CursorStore()
+    cursors.advance(TEST_REPOSITORY, [issue(1, "2017-01-01"), issue(2, "2017-01-02"),
+                                      issue(3, "2017-01-02")])
+    assert cursors.get(TEST_REPOSITORY) == "2017-01-02"
+    assert cursors.is_processed(TEST_REPOSITORY, issue(2, "2017-01-02"))
+    assert not cursors.is_processed(TEST_REPOSITORY, issue(4, "2017-01-02"))
+    assert not cursors.is_processed(TEST_REPOSITORY, issue(2, "2017-01-03"))
+
+    # nothing new
+    cursors.advance(TEST_REPOSITORY, [issue(4, "2017-01-02")])
+    assert cursors.seen["owner/repo"] == [2, 3, 4]
+
+
+def test_cursor_store_advance_failed():
+    cursors = CursorStore()
+    cursors.advance(TEST_REPOSITORY, [issue(1, "2017-01-01")])
+    cursors.advance(TEST_REPOSITORY, [issue(2, "2017-01-02"), issue(3, "2017-01-03")],
+                    [issue(1, "2017-01-01")])
+    assert cursors.get(TEST_REPOSITORY) == "2017-01-01"
+    assert not cursors.is_processed(TEST_REPOSITORY, issue(1, "2017-01-01"))
+
+
+def test_comment_cache():
+    rules = RuleSet([{"pattern": "robot:bug", "label": "bug"}])
+    cache = CommentCache()
+    assert cache.get(TEST_REPOSITORY, 1, rules) == (None, {})
+
+    assert cache.update(TEST_REPOSITORY, 1, rules, [{"id": 1, "updated_at": "2017-01-02"},
+                                                    {"id": 2, "updated_at": "2017-01-01"}],
+                        {1: {"bug"}, 2: set()}) == {"bug"}
+    assert cache.get(TEST_REPOSITORY, 1, rules) == ("2017-01-02", {1: {"bug"}, 2: set()})
+
+    # nothing new keeps the timestamp
+    assert cache.update(TEST_REPOSITORY, 1, rules, [], {3: {"question"}}) == {"bug", "question"}
+    assert cache.get(TEST_REPOSITORY, 1, rules)[0] == "2017-01-02"
+
+    # other rules can't use the labels
+    assert cache.get(TEST_REPOSITORY, 1, RuleSet([])) == (None, {})
+    assert cache.get(TEST_REPOSITORY, 1, RuleSet(list(rules)))[0] == "2017-01-02"
+
+
+def test_comment_cache_edits_and_deletions():
+    rules = RuleSet([{"pattern": "robot:bug", "label": "bug"}])
+    cache = CommentCache()
+    comments = [{"id": 1, "updated_at": "2017-01-01"}, {"id": 2, "updated_at": "2017-01-02"}]
+    assert cache.update(TEST_REPOSITORY, 1, rules, comments, {1: {"bug"}, 2: {"question"}},
+                        complete=True) == {"bug", "question"}
+
+    # the edited comment doesn't match anymore
+    edited = [{"id": 1, "updated_at": "2017-01-03"}]
+    assert cache.update(TEST_REPOSITORY, 1, rules, edited, {1: set()}) == {"question"}
+    assert cache.get(TEST_REPOSITORY, 1, rules)[0] == "2017-01-03"
+
+    # the second comment is gone from the complete list
+    assert cache.update(TEST_REPOSITORY, 1, rules, edited, {}, complete=True) == set()
+    assert cache.get(TEST_REPOSITORY, 1, rules)[1] == {1: set()}
+
+
+def test_comments_deleted():
+    known = {1: set(), 2: set()}
+    assert not comments_deleted({"comments": 3}, known, [{"id": 3}])
+    assert not comments_deleted({"comments": 2}, known, [{"id": 2}])
+    assert comments_deleted({"comments": 1}, known, [])
+    # the count is unknown
+    assert not comments_deleted({}, known, [])
+
+
+def test_comment_cache_eviction():
+    rules = RuleSet([])
+    cache = CommentCache(max_issues=2)
+    for issue in [1, 2, 1, 3]:
+        cache.update(TEST_REPOSITORY, issue, rules, [{"updated_at": "2017-01-01"}], {})
+    assert len(cache) == 2
+    assert cache.get(TEST_REPOSITORY, 2, rules) == (None, {})
+    assert cache.get(TEST_REPOSITORY, 1, rules) == ("2017-01-01", {})
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import time
+from pygithublabeler.worker import Coalescer
+
+
+def merge(held, new):
+    return held + new
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_coalescer_merges_burst():
+    handled = []
+    coalescer = Coalescer(handled.append, merge, window=0.1)
+    for i in range(5):
+        coalescer.add(("owner", "repo", 1), [i])
+    coalescer.add(("owner", "repo", 2), ["other"])
+    assert handled == []
+    assert wait_for(lambda: len(handled) == 2)
+    assert sorted(handled, key=len) == [["other"], [0, 1, 2, 3, 4]]
+    stats = coalescer.stats()
+    assert (stats["received"], stats["coalesced"], stats["flushed"]) == (6, 4, 2)
+
+
+def test_coalescer_max_wait():
+    handled = []
+    coalescer = Coalescer(handled.append, merge, window=0.1, max_wait=0.15)
+    start = time.time()
+    # the burst never goes quiet, but the job is not held forever
+    while not handled and time.time() - start < 2:
+        coalescer.add("key", [1])
+        time.sleep(0.02)
+    assert handled and time.time() - start < 0.5
+
+
+def test_coalescer_flush_and_dropped():
+    def sink(job):
+        raise ValueError("full")
+    coalescer = Coalescer(sink, merge, window=60)
+    coalescer.add("key", [1])
+    coalescer.flush()
+    stats = coalescer.stats()
+    assert (stats["pending"], stats["dropped"]) == (0, 1)
@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-from run import app as application
+from pygithublabeler.run import create_app
+
+# configuration is loaded and rules are compiled before any request,
+# run gunicorn with --preload to share them between the workers
+application = create_app()
 
 if __name__ == "__main__":
     application.run()